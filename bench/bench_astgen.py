@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+Benchmarks `astgen.ModuleWalker` on a large generated PyRRHIC source.
+
+The source mixes module definitions with plain Python helpers (the bulk of a
+typical generator library), and the transform is timed with and without
+pruning of subtrees that contain no PyRRHIC constructs.
+
+    $> python bench/bench_astgen.py [n_modules] [n_helpers]
+"""
+import ast, os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.builder import astgen
+
+MODULE = '''
+class Gen%(n)d(Module):
+  def __init__(self, width):
+    self.io = Wire(UInt(width))
+    acc = Reg(UInt(width))
+    cnt = Reg(UInt(8))
+    self.io //= acc
+    if When(cnt == Lit(%(n)d)):
+      acc //= Lit(0)
+    elif When(self.io):
+      acc //= acc + Lit(1)
+      cnt //= cnt + Lit(1)
+'''
+
+HELPER = '''
+def helper%(n)d(xs, k=%(n)d):
+    total = 0
+    for i, x in enumerate(xs):
+        if x %% 3 == 0 and i > k:
+            total += x * i - (k << 2) + len(str(x))
+        elif x in (1, 2, 3):
+            total -= [y for y in xs if y > x][0] if xs else 0
+        else:
+            total ^= dict(a=x, b=i).get("a", 0) + abs(-x)
+    return {"total": total, "k": k, "name": "helper%(n)d"}
+'''
+
+def make_source(n_modules, n_helpers):
+    parts = []
+    for n in range(max(n_modules, n_helpers)):
+        if n < n_modules:
+            parts.append(MODULE % {"n": n})
+        if n < n_helpers:
+            parts.append(HELPER % {"n": n})
+    return "".join(parts)
+
+def time_transform(src, prune):
+    tree = ast.parse(src)
+    start = time.time()
+    astgen.ModuleWalker(src, prune = prune).visit(tree)
+    return time.time() - start
+
+if __name__ == "__main__":
+    n_modules = 2000
+    n_helpers = 8000
+    if len(sys.argv) > 1:
+        n_modules = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_helpers = int(sys.argv[2])
+    src = make_source(n_modules, n_helpers)
+    print "source: %.1f MB, %d modules, %d helpers" % \
+        (len(src) / 1e6, n_modules, n_helpers)
+
+    start = time.time()
+    ast.parse(src)
+    print "ast.parse:          %.3f s" % (time.time() - start)
+    full = min(time_transform(src, False) for _ in range(3))
+    pruned = min(time_transform(src, True) for _ in range(3))
+    print "transform (full):   %.3f s" % full
+    print "transform (pruned): %.3f s  (%.1fx, including the pre-scan)" % \
+        (pruned, full / pruned)
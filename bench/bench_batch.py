@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+Simulates the scaled-up `Counter` design of `bench_sim.py` with `n`
+counters for many independent stimulus streams at once, each starting the
+counters at random cycles, with the NumPy batch simulator at several lane
+counts, and with the compiled simulator one stream after another.  Reports
+the lane-cycles simulated per second by each, and checks a few lanes of
+the batch against the compiled simulator.
+
+    $> python bench/bench_batch.py [n] [cycles]
+"""
+import os, random, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.sim import BatchSimulator, Simulator
+from bench_sim import elaborate
+import numpy
+
+def stimulus(lanes, cycles):
+    """
+    Returns a (cycles, lanes) array of the start pulses of every lane.
+    """
+    rng = random.Random(1)
+    starts = numpy.zeros((cycles, lanes), numpy.uint64)
+    for lane in range(lanes):
+        for c in range(0, cycles, 8):
+            if rng.random() < 0.1:
+                starts[c, lane] = 1
+    return starts
+
+def outputs(sim, n):
+    return [sim.peek("self_io.finished[%d]" % i) for i in range(n)]
+
+if __name__ == "__main__":
+    n = 100
+    cycles = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        cycles = int(sys.argv[2])
+    mdecs = elaborate(n)
+
+    # One stream after another, each on a simulator built beforehand, since
+    # the batch timings don't count building either
+    starts = stimulus(10, cycles)
+    start = time.time()
+    sims = [Simulator(mdecs, "Counters") for lane in range(10)]
+    built = time.time()
+    for (lane, sim) in enumerate(sims):
+        for c in range(cycles):
+            sim.poke("self_io.start", int(starts[c, lane]))
+            sim.step()
+    done = time.time()
+    print "compiled, 10 lanes: built in %.3f s, %.0f lane-cycles/s" % \
+        (built - start, 10 * cycles / (done - built))
+
+    for lanes in (10, 100, 1000, 10000):
+        starts = stimulus(lanes, cycles)
+        start = time.time()
+        batch = BatchSimulator(mdecs, lanes, "Counters")
+        built = time.time()
+        for c in range(cycles):
+            batch.poke("self_io.start", starts[c])
+            batch.step()
+        done = time.time()
+        print "batch, %d lanes: built in %.3f s, %.0f lane-cycles/s" % \
+            (lanes, built - start, lanes * cycles / (done - built))
+        finished = outputs(batch, n)
+
+    # The batch agrees with the compiled simulator on a few lanes
+    for lane in (0, lanes // 2, lanes - 1):
+        sim = Simulator(mdecs, "Counters")
+        for c in range(cycles):
+            sim.poke("self_io.start", int(starts[c, lane]))
+            sim.step()
+        assert outputs(sim, n) == [int(f[lane]) for f in finished]
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""
+Compares the binary IR format of `pyrast/binary.py` with the text form and
+with `cPickle` (as used for `--state`) on a large synthetic design: encoded
+size, time to write, and time to load.
+
+There is no parser for the text form, so its load time is that of merely
+splitting every line into tokens, a lower bound for any real parser.
+
+    $> python bench/bench_binary.py [n_modules] [n_regs]
+"""
+import os, sys, time, zlib
+import cPickle as pickle
+from cStringIO import StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder
+from pyrrhic.builder import astgen, ElaborationSession, elaborate_all_instances
+from pyrrhic.pyrast import binary, emit
+
+MODULE = '''
+class Gen%(n)d(Module):
+  def __init__(self):
+    self.io = Wire(UInt(16))
+    prev = self.io
+    for i in range(%(regs)d):
+      r = Reg(UInt(16))
+      if When(prev == Lit(i)):
+        r //= prev + Lit(%(n)d)
+      else:
+        r //= ~(prev - r)
+      prev = r
+    self.io //= prev
+g%(n)d = Module(Gen%(n)d())
+'''
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return (res, time.time() - start)
+
+def to_text(mdecs):
+    out = StringIO()
+    emitter = emit.Emitter(out)
+    for m in mdecs:
+        emitter.emit_module(m)
+        out.write("\n")
+    return out.getvalue()
+
+def tokenize(text):
+    n = 0
+    for line in text.splitlines():
+        n += len(line.split())
+    return n
+
+def to_pickle(mdecs):
+    # `io` refers to builder objects, which aren't part of the IR
+    return pickle.dumps([(m.idt, m.stmts) for m in mdecs],
+                        pickle.HIGHEST_PROTOCOL)
+
+if __name__ == "__main__":
+    n_modules = 200
+    n_regs = 50
+    if len(sys.argv) > 1:
+        n_modules = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_regs = int(sys.argv[2])
+    src = "from pyrrhic.builder.bdast import *\n" + \
+        "".join([MODULE % {"n": n, "regs": n_regs} for n in range(n_modules)])
+    code = astgen.compile_pyrrhic_source(src, "<synthetic>")
+    with ElaborationSession() as session:
+        exec code in {"__name__": "__main__", "builder": builder}
+        elaborate_all_instances()
+    mdecs = session.elaborated_instances.values()
+
+    (text, t_text) = timed(to_text, mdecs)
+    (_, l_text) = timed(tokenize, text)
+    (data, t_bin) = timed(binary.dumps, mdecs)
+    (back, l_bin) = timed(binary.loads, data)
+    (pick, t_pick) = timed(to_pickle, mdecs)
+    (_, l_pick) = timed(pickle.loads, pick)
+    assert to_text(back) == text
+
+    print "%-8s %12s %12s %10s %10s" % ("format", "size (B)", "gzip (B)",
+                                        "write (s)", "load (s)")
+    for (name, s, w, l) in [("text", text, t_text, l_text),
+                            ("binary", data, t_bin, l_bin),
+                            ("pickle", pick, t_pick, l_pick)]:
+        print "%-8s %12d %12d %10.3f %10.3f" % \
+            (name, len(s), len(zlib.compress(s, 6)), w, l)
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+"""
+Folds the constants of synthetic modules at two sizes, each holding a
+DAG-shaped expression whose every level reads the one below twice (a tree
+of exponential size if it were unshared), a chain of wires each driven by
+the previous one plus a literal, and a non-constant DAG of the same shape,
+and reports the time taken per level at each size.
+
+    $> python bench/bench_constfold.py [n_levels]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.pyrast import *
+from pyrrhic.passes import fold_constants
+
+def dag_module(n):
+    """
+    Returns a `ModuleDec` with the expressions described above, `n` levels
+    deep each.
+    """
+    io = Id("io")
+    en = Id("en")
+    stmts = [WireDec(io, UInt(8)), WireDec(en, UInt(8))]
+    const = Lit(1, 8)
+    var = en
+    for i in range(n):
+        const = Bits(const + const, 7, 0)
+        var = Bits(Mux(var == Lit(i % 256), var + var, var), 7, 0)
+    prev = Lit(0, 8)
+    for i in range(n):
+        w = Id("w%d" % i)
+        stmts.append(WireDec(w, UInt(8)))
+        stmts.append(ConnectStmt(w, Bits(prev + Lit(1), 7, 0)))
+        prev = w
+    stmts.append(ConnectStmt(io, Cat(const, prev, var)))
+    return ModuleDec("Dag", io, stmts)
+
+if __name__ == "__main__":
+    n = 50000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for levels in (n, 2 * n):
+        mdec = dag_module(levels)
+        start = time.time()
+        folded = fold_constants([mdec])
+        done = time.time() - start
+        rval = mdec.stmts[-1].rval
+        print "%d levels: %d nodes folded in %.3f s (%.1f us per level), " \
+            "io := Cat(%s, %s, ...)" % (levels, folded, done,
+                                        done * 1e6 / levels,
+                                        rval.exprs[0], rval.exprs[1])
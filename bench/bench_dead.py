@@ -0,0 +1,48 @@
+#!/usr/bin/python
+"""
+Removes the dead code of synthetic modules at two sizes, each made of two
+long chains of wires, one of them driving the module's ``io`` and the
+other one read by nothing, with every 8th connection of both inside a
+`when`, and reports the time taken per statement at each size.
+
+    $> python bench/bench_dead.py [n_wires]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.pyrast import *
+from pyrrhic.passes import remove_dead_code
+
+def chains_module(n):
+    """
+    Returns a `ModuleDec` with two chains of `n` wires each, only one of
+    which reaches ``io``.
+    """
+    io = Id("io")
+    en = Id("en")
+    stmts = [WireDec(io, UInt(8)), WireDec(en, UInt(1))]
+    for chain in ("live", "dead"):
+        prev = en
+        for i in range(n):
+            w = Id("%s%d" % (chain, i))
+            stmts.append(WireDec(w, UInt(8)))
+            c = ConnectStmt(w, prev + Lit(1))
+            if i % 8 == 7:
+                c = WhenStmt(en, [c], [ConnectStmt(w, prev)])
+            stmts.append(c)
+            prev = w
+        if chain == "live":
+            stmts.append(ConnectStmt(io, prev))
+    return ModuleDec("Chains", io, stmts)
+
+if __name__ == "__main__":
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for size in (n, 2 * n):
+        mdec = chains_module(size)
+        before = len(mdec.stmts)
+        start = time.time()
+        report = remove_dead_code([mdec])
+        done = time.time() - start
+        print "%d statements in %.3f s (%.1f us each): %s" % \
+            (before, done, done * 1e6 / before, report)
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""
+Elaborates many instances of one module class that declares most of its
+state in the class body, and reports the time taken and how many update
+log entries the instance contexts hold, compared with giving every
+instance its own copy of the class updates.  Also checks that running the
+passes on one instance's `ModuleDec` leaves the others unchanged.
+
+    $> python bench/bench_instances.py [n_instances] [n_class_regs]
+"""
+import os, resource, sys, time
+from cStringIO import StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder, passes
+from pyrrhic.builder import astgen, elaborate_all_instances
+from pyrrhic.builder import context as ctx
+from pyrrhic.pyrast import emit
+
+HEADER = '''
+from pyrrhic.builder.bdast import *
+'''
+
+CLASS_REG = '''
+  r%(i)d = Reg(UInt(16))
+  r%(i)d //= io + Lit(%(i)d)
+'''
+
+MODULE = '''
+class Leaf(Module):
+  io = Wire(UInt(16))
+%(regs)s
+  def __init__(self, k):
+    out = Wire(UInt(16))
+    out //= Leaf.io + Lit(k)
+
+class Top(Module):
+  io = Wire(UInt(16))
+  def __init__(self, n):
+    self.leaves = []
+    for k in range(n):
+      self.leaves.append(Module(Leaf(k)))
+
+top = Module(Top(%(n)d))
+'''
+
+def emitted(mdec):
+    out = StringIO()
+    emit.Emitter(out).emit_module(mdec)
+    return out.getvalue()
+
+def check_independent(mdecs):
+    """
+    Runs the passes on the first of the `ModuleDec`s `mdecs` and asserts
+    that the second one is unchanged.
+    """
+    (first, second) = mdecs[:2]
+    (changed, before) = (emitted(first), emitted(second))
+    passes.fold_constants([first])
+    passes.remove_dead_code([first])
+    passes.infer_widths([first])
+    passes.expand_whens([first])
+    assert emitted(first) != changed
+    assert emitted(second) == before, "instances share statements"
+
+if __name__ == "__main__":
+    n_instances = 10000
+    n_regs = 20
+    if len(sys.argv) > 1:
+        n_instances = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_regs = int(sys.argv[2])
+    regs = "".join([CLASS_REG % {"i": i} for i in range(n_regs)])
+    src = HEADER + MODULE % {"regs": regs, "n": n_instances}
+    code = astgen.compile_pyrrhic_source(src, "<synthetic>")
+
+    start = time.time()
+    exec code in {"__name__": "__main__", "builder": builder}
+    built = time.time()
+    contexts = ctx.current().all_instance_contexts.values()
+    logged = 0
+    owned = 0
+    for ic in contexts:
+        logged += len(ic.updates)
+        owned += len(ic.updates.owned())
+    elaborate_all_instances()
+    done = time.time()
+
+    print "%d instances, %d modules elaborated" % \
+        (len(contexts), len(ctx.current().elaborated_instances))
+    print "build %.3f s, elaborate %.3f s" % (built - start, done - built)
+    print "update log entries: %d held by instances, %d if copied (%.1fx)" % \
+        (owned, logged, float(logged) / owned)
+    print "peak RSS: %.1f MB" % \
+        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+    leaves = [m for m in ctx.current().elaborated_instances.values()
+              if "Leaf" in str(m.idt)]
+    check_independent(leaves)
+    print "passes on one instance leave the others unchanged"
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""
+Reports the memory taken by the IR nodes of a large synthetic design.
+
+Every `Stmt`, `Expr`, `Type` and `Field` reachable from the elaborated
+`ModuleDec`s is counted, and its size compared with what the same node
+would take as an ordinary object carrying a `__dict__` with the same
+attributes (the representation used before nodes got `__slots__`).
+
+    $> python bench/bench_memory.py [n_modules] [n_regs]
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder
+from pyrrhic.builder import astgen, elaborate_all_instances
+from pyrrhic.builder import context as ctx
+from pyrrhic.pyrast import Expr, Stmt, Type, Field
+
+HEADER = '''
+from pyrrhic.builder.bdast import *
+'''
+
+MODULE = '''
+class Gen%(n)d(Module):
+  def __init__(self):
+    self.io = Wire(UInt(16))
+    prev = self.io
+    for i in range(%(regs)d):
+      r = Reg(UInt(16))
+      if When(prev == Lit(i)):
+        r //= prev + Lit(%(n)d)
+      else:
+        r //= ~(prev - r)
+      prev = r
+    self.io //= prev
+g%(n)d = Module(Gen%(n)d())
+'''
+
+def slot_names(cls):
+    names = []
+    for c in cls.__mro__:
+        for name in c.__dict__.get("__slots__", ()):
+            if name != "__weakref__":
+                names.append(name)
+    return names
+
+def walk(roots):
+    """
+    Yields every IR node reachable from `roots` once.
+    """
+    seen = set()
+    stack = list(roots)
+    while stack:
+        v = stack.pop()
+        if isinstance(v, (list, tuple)):
+            stack.extend(v)
+        elif isinstance(v, dict):
+            stack.extend(v.values())
+        elif isinstance(v, (Expr, Stmt, Type, Field)) and id(v) not in seen:
+            seen.add(id(v))
+            yield v
+            for name in slot_names(type(v)):
+                stack.append(getattr(v, name, None))
+
+def dict_size(n_attrs, cache={}):
+    """
+    Returns the size of a plain object with a `__dict__` of `n_attrs`
+    attributes.
+    """
+    if n_attrs not in cache:
+        Plain = type("Plain", (object,), {})
+        o = Plain()
+        for i in range(n_attrs):
+            setattr(o, "a%d" % i, None)
+        cache[n_attrs] = sys.getsizeof(o) + sys.getsizeof(o.__dict__)
+    return cache[n_attrs]
+
+if __name__ == "__main__":
+    n_modules = 200
+    n_regs = 50
+    if len(sys.argv) > 1:
+        n_modules = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_regs = int(sys.argv[2])
+    src = HEADER + "".join([MODULE % {"n": n, "regs": n_regs}
+                            for n in range(n_modules)])
+    code = astgen.compile_pyrrhic_source(src, "<synthetic>")
+
+    # The builder is chatty; keep its output out of the report.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        exec code in {"__name__": "__main__", "builder": builder}
+        elaborate_all_instances()
+    finally:
+        sys.stdout = stdout
+
+    counts = {}
+    for node in walk(ctx.current().elaborated_instances.values()):
+        cls = type(node)
+        if cls not in counts:
+            counts[cls] = 0
+        counts[cls] += 1
+
+    print "%-14s %9s %12s %12s" % ("node", "count", "slots B/node", "dict B/node")
+    total = 0
+    total_slots = 0
+    total_dict = 0
+    for cls in sorted(counts, key = lambda c: -counts[c]):
+        n = counts[cls]
+        slotted = sys.getsizeof(cls.__new__(cls))
+        plain = dict_size(len(slot_names(cls)))
+        print "%-14s %9d %12d %12d" % (cls.__name__, n, slotted, plain)
+        total += n
+        total_slots += n * slotted
+        total_dict += n * plain
+    print "%-14s %9d %12.1f %12.1f" % ("all", total,
+        float(total_slots) / total, float(total_dict) / total)
+    print "total: %.1f MB with slots, %.1f MB with dicts" % \
+        (total_slots / 1e6, total_dict / 1e6)
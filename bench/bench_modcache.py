@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+Elaborates a design made of many distinct instances of a leaf module
+generator twice with a fresh `modcache.ModuleCache`, and reports how long
+the cold run (which stores every leaf) and the warm run (which skips the
+leaves' constructors) take.
+
+    $> python bench/bench_modcache.py [n_instances] [depth]
+"""
+import os, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder
+from pyrrhic.builder import astgen, ElaborationSession, elaborate_all_instances
+from pyrrhic.builder.modcache import ModuleCache
+
+SOURCE = '''
+from pyrrhic.builder.bdast import *
+
+class Shift(Module):
+  def __init__(self, depth, k):
+    self.io = Wire(UInt(16))
+    r = self.io
+    for i in range(depth):
+      nxt = Reg(UInt(16))
+      if When(r == Lit(k)):
+        nxt //= r + Lit(i)
+      else:
+        nxt //= r
+      r = nxt
+    out = Wire(UInt(16))
+    out //= r
+
+class Top(Module):
+  io = Wire(UInt(16))
+  def __init__(self, n, depth):
+    self.shifts = []
+    for k in range(n):
+      self.shifts.append(Module(Shift(depth, k)))
+
+top = Module(Top(%(n)d, %(depth)d))
+'''
+
+def run(code, cache):
+    start = time.time()
+    with ElaborationSession() as session:
+        session.module_cache = cache
+        exec code in {"__name__": "__main__", "builder": builder}
+        elaborate_all_instances()
+    return (time.time() - start, session.elaborated_instances.values())
+
+if __name__ == "__main__":
+    n_instances = 500
+    depth = 20
+    if len(sys.argv) > 1:
+        n_instances = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        depth = int(sys.argv[2])
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "design.py")
+        f = open(path, "w")
+        f.write(SOURCE % {"n": n_instances, "depth": depth})
+        f.close()
+        code = astgen.compile_pyrrhic(path)
+        cache_dir = os.path.join(tmp, "modules")
+
+        (cold, cold_mdecs) = run(code, ModuleCache(cache_dir))
+        warm_cache = ModuleCache(cache_dir)
+        (warm, warm_mdecs) = run(code, warm_cache)
+        assert [str(m) for m in cold_mdecs] == [str(m) for m in warm_mdecs]
+
+        size = sum(os.path.getsize(os.path.join(cache_dir, e))
+                   for e in os.listdir(cache_dir))
+        print "%d instances of depth %d, %d cache hits, %d KB cached" % \
+            (n_instances, depth, warm_cache.hits, size / 1024)
+        print "cold %.3f s, warm %.3f s (%.1fx)" % (cold, warm, cold / warm)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""
+Simulates scaled-up versions of the `Counter` and `FIFO32` of `test.py`,
+a module holding `n` counters started together and a FIFO of `n` stages,
+with the compiled simulator, and reports how long building the simulator
+took and how many cycles (and signal updates) per second it runs.
+
+    $> python bench/bench_sim.py [n] [cycles]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder
+from pyrrhic.builder import ElaborationSession, astgen, elaborate_all_instances
+from pyrrhic.sim import Simulator
+
+SOURCE = '''
+from pyrrhic.builder.bdast import *
+from pyrrhic import Log2Up
+
+class ReadyValIO(BundleDec):
+    ready = Reverse(UInt(1))
+    valid = UInt(1)
+    def __init__(self, data):
+      self.data = data
+
+class FIFOIO(BundleDec):
+    def __init__(self, data):
+      self.input = ReadyValIO(data)
+      self.output = Reverse(ReadyValIO(data))
+
+class FIFO32(Module):
+    def __init__(self, stages):
+        self.io = Wire(FIFOIO(UInt(32)))
+        r = Wire(ReadyValIO(UInt(32)))
+        r //= self.io.input
+        for n in range(stages):
+            rnext = Reg(ReadyValIO(UInt(32)))
+            rnext //= r
+            r = rnext
+        self.io.output //= r
+
+class Counter(Module):
+  class CounterIO(BundleDec):
+    start     = UInt(1)
+    finished  = Reverse(UInt(1))
+
+  def __init__(self, max_val):
+    self.io = Wire(Counter.CounterIO())
+    cnt = Reg(UInt(width=Log2Up(max_val)))
+    fin = Reg(UInt(1))
+    self.io.finished //= fin
+    if When(self.io.start):
+      cnt //= Lit(0)
+      fin //= Lit(0)
+    elif When(cnt == Lit(max_val)):
+      fin //= Lit(1)
+    elif When(~fin):
+      cnt //= (cnt + Lit(1))
+
+class CountersIO(BundleDec):
+    def __init__(self, n):
+      self.start = UInt(1)
+      self.finished = Reverse(Vec(UInt(1), n))
+
+class Counters(Module):
+  def __init__(self, n):
+    self.io = Wire(CountersIO(n))
+    for i in range(n):
+      c = Module(Counter(9 + i %% 7))
+      c.io.start //= self.io.start
+      self.io.finished[Lit(i)] //= c.io.finished
+
+counters = Module(Counters(%(n)d))
+fifo = Module(FIFO32(%(n)d))
+'''
+
+def elaborate(n):
+    """
+    Returns the elaborated `ModuleDec`s of both designs, with `n` counters
+    and FIFO stages.
+    """
+    session = ElaborationSession()
+    with session:
+        code = astgen.compile_pyrrhic_source(SOURCE % {"n": n}, "<synthetic>")
+        exec code in {"__name__": "__main__", "builder": builder}
+    elaborate_all_instances(None, session)
+    return session.elaborated_instances.values()
+
+def run(mdecs, top, cycles, drive):
+    """
+    Builds a simulator of `top`, calls `drive(sim, cycle)` before each of
+    `cycles` cycles, and reports the timings.
+    """
+    start = time.time()
+    sim = Simulator(mdecs, top)
+    built = time.time()
+    for c in range(cycles):
+        drive(sim, c)
+        sim.step()
+    done = time.time()
+    n = sim.netlist
+    updates = (len(n.comb) + len(n.next)) * cycles
+    print "%s: %d signals, built in %.3f s, %d cycles in %.3f s " \
+        "(%.0f cycles/s, %.2fM updates/s)" % \
+        (top, len(n.names), built - start, cycles, done - built,
+         cycles / (done - built), updates / (done - built) / 1e6)
+    return sim
+
+if __name__ == "__main__":
+    n = 1000
+    cycles = 2000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        cycles = int(sys.argv[2])
+    mdecs = elaborate(n)
+
+    def start(sim, c):
+        sim.poke("self_io.start", int(c % 100 == 0))
+    sim = run(mdecs, "Counters", cycles, start)
+    # Every counter finishes within 16 cycles of being started
+    assert cycles % 100 < 17 or \
+        all(sim.peek("self_io.finished[%d]" % i) for i in range(n))
+
+    def feed(sim, c):
+        sim.poke("self_io.input.valid", 1)
+        sim.poke("self_io.input.data", c)
+    sim = run(mdecs, "FIFO32", cycles, feed)
+    assert sim.peek("self_io.output.data") == max(cycles - n, 0)
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+"""
+Measures elaboration throughput of a synthetic design with tracing off and
+with every trace category enabled (records written to /dev/null).
+
+    $> python bench/bench_trace.py [n_modules] [n_regs]
+"""
+import os, subprocess, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder, trace
+from pyrrhic.builder import astgen, elaborate_all_instances
+from pyrrhic.builder import context as ctx
+
+MODULE = '''
+class Gen%(n)d(Module):
+  def __init__(self):
+    self.io = Wire(UInt(16))
+    prev = self.io
+    for i in range(%(regs)d):
+      r = Reg(UInt(16))
+      if When(prev == Lit(i)):
+        r //= prev + Lit(%(n)d)
+      else:
+        r //= ~(prev - r)
+      prev = r
+    self.io //= prev
+g%(n)d = Module(Gen%(n)d())
+'''
+
+def run(mode, n_modules, n_regs):
+    """
+    Elaborates the design once in this process and returns the number of
+    updates logged and the time taken.
+    """
+    src = "from pyrrhic.builder.bdast import *\n" + \
+        "".join([MODULE % {"n": n, "regs": n_regs} for n in range(n_modules)])
+    code = astgen.compile_pyrrhic_source(src, "<synthetic>")
+    if mode == "text":
+        trace.configure("all")
+        trace._sink.stream = open(os.devnull, "w")
+    elif mode == "json":
+        trace.configure("all", os.devnull)
+
+    start = time.time()
+    exec code in {"__name__": "__main__", "builder": builder}
+    updates = sum([len(ic.updates) for ic in ctx.current().all_instance_contexts.values()])
+    elaborate_all_instances()
+    elapsed = time.time() - start
+    trace.disable()
+    return (updates, elapsed)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        # Child process measuring a single mode, so that each run starts
+        # from a fresh builder
+        (updates, elapsed) = run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        print updates, elapsed
+        sys.exit(0)
+
+    n_modules = "200"
+    n_regs = "50"
+    if len(sys.argv) > 1:
+        n_modules = sys.argv[1]
+    if len(sys.argv) > 2:
+        n_regs = sys.argv[2]
+    for mode in ["off", "json", "text"]:
+        out = subprocess.check_output([sys.executable, __file__, "--run", mode,
+                                       n_modules, n_regs])
+        (updates, elapsed) = out.split()
+        updates = int(updates)
+        elapsed = float(elapsed)
+        print "tracing %-4s: %7d updates in %.3f s, %9.0f updates/s" % \
+            (mode, updates, elapsed, updates / elapsed)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+"""
+Lowers a wide `BundleDec` many times, then resolves the type of a deep
+``io.f.f.f...`` path into a nested bundle, first from scratch and then with
+the types cached along the path, and reports the times taken.
+
+    $> python bench/bench_types.py [n_fields] [depth]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.builder.bdast import *
+from pyrrhic.builder import context as ctx
+from pyrrhic.pyrast.expr import resolve_type
+
+def wide_bundle(n):
+    """
+    Returns a `BundleDec` class with `n` class-level fields.
+    """
+    attrs = dict(("f%d" % i, UInt(i + 1)) for i in range(n))
+    return BundleBuilder("Wide", (BundleDec,), attrs)
+
+def nested_type(depth):
+    """
+    Returns a bundle type nesting `depth` bundles through their field ``f``.
+    """
+    t = UInt(8)
+    for i in range(depth):
+        t = Bundle({"f": Field(Field.Default, "f", t),
+                    "g": Field(Field.Reverse, "g", UInt(1))})
+    return t
+
+if __name__ == "__main__":
+    n_fields = 50
+    depth = 20
+    if len(sys.argv) > 1:
+        n_fields = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        depth = int(sys.argv[2])
+    n_lower = 10000
+    n_queries = 100000
+
+    cls = wide_bundle(n_fields)
+    start = time.time()
+    for i in xrange(n_lower):
+        cls().__as_lower_type__()
+    lowered = time.time() - start
+
+    with ctx.ElaborationSession():
+        io = BuilderId(Id("io"))
+        io.__type__ = nested_type(depth)
+        paths = []
+        for i in xrange(n_queries / depth):
+            p = io
+            for j in range(depth):
+                p = SubField(p, "f")
+            paths.append(p)
+
+        # Every node of a fresh path is resolved once
+        start = time.time()
+        for p in paths:
+            resolve_type(p)
+        cold = (time.time() - start) / len(paths)
+        start = time.time()
+        for p in paths:
+            for j in xrange(depth):
+                resolve_type(p)
+        warm = (time.time() - start) / (len(paths) * depth)
+
+    print "lowered a %d-field bundle %d times in %.3f s" % \
+        (n_fields, n_lower, lowered)
+    print "type of a %d-deep path: %.1f us fresh, %.2f us cached" % \
+        (depth, cold * 1e6, warm * 1e6)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+Elaborates a module driving a wide vector register element by element with
+``//=``, and the same module using `Tabulate` and `MapElements`, then
+emits both, and reports the times taken and the number of statements each
+elaborated module holds.
+
+    $> python bench/bench_vec.py [n_elements]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic import builder
+from pyrrhic.builder import astgen, ElaborationSession, elaborate_all_instances
+from pyrrhic.pyrast import walk_stmts
+from pyrrhic.pyrast.emit import Emitter
+
+SOURCE = '''
+from pyrrhic.builder.bdast import *
+
+class PerElement(Module):
+  io = Wire(UInt(1))
+  def __init__(self, n):
+    r = Reg(Vec(UInt(16), n))
+    w = Wire(Vec(UInt(16), n))
+    for i in range(n):
+      r[Lit(i)] //= Lit(i) + Lit(1)
+    for i in range(n):
+      w[Lit(i)] //= r[Lit(i)] + r[Lit(i)]
+
+class Bulk(Module):
+  io = Wire(UInt(1))
+  def __init__(self, n):
+    r = Reg(Vec(UInt(16), n))
+    w = Wire(Vec(UInt(16), n))
+    Tabulate(r, lambda i: i + Lit(1))
+    MapElements(w, lambda e: e + e, r)
+
+m = Module(%(cls)s(%(n)d))
+'''
+
+class NullStream(object):
+    def write(self, s):
+        pass
+
+def run(code):
+    """
+    Returns the elaboration and emission times of `code`, and the number of
+    statements of the module it elaborates.
+    """
+    start = time.time()
+    with ElaborationSession() as session:
+        exec code in {"__name__": "__main__", "builder": builder}
+        elaborate_all_instances()
+    elaborated = time.time() - start
+    mdec = session.elaborated_instances.values()[-1]
+    start = time.time()
+    Emitter(NullStream()).emit_module(mdec)
+    emitted = time.time() - start
+    return (elaborated, emitted, len(mdec.stmts), mdec)
+
+if __name__ == "__main__":
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    results = {}
+    for cls in ("PerElement", "Bulk"):
+        code = astgen.compile_pyrrhic_source(SOURCE % {"cls": cls, "n": n},
+                                             cls + ".py")
+        results[cls] = run(code)
+        (elaborated, emitted, n_stmts, _) = results[cls]
+        print "%-10s elaborated in %.3f s (%d statements), emitted in " \
+            "%.3f s, %.3f s total" % (cls, elaborated, n_stmts, emitted,
+                                    elaborated + emitted)
+    # Both forms stand for the same connections
+    flat = [[str(s) for s in walk_stmts(results[cls][3].stmts)
+             if type(s).__name__ == "ConnectStmt"]
+            for cls in ("PerElement", "Bulk")]
+    assert flat[0] == flat[1]
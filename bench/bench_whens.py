@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""
+Expands the `WhenStmt`s of synthetic modules made of one long chain of
+nested ``elif``s, like `Counter`'s, at two depths, and reports the time
+taken per `when` at each to show that it stays flat.
+
+    $> python bench/bench_whens.py [depth]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.pyrast import *
+from pyrrhic.passes import expand_whens
+
+def chain_module(n):
+    """
+    Returns a `ModuleDec` with a chain of `n` nested `when`s, each one
+    connecting the registers ``cnt`` and ``fin`` in its if branch and
+    holding the rest of the chain in its else branch.
+    """
+    cnt = Id("cnt")
+    fin = Id("fin")
+    stmts = [WireDec(Id("sel"), UInt(16)), RegDec(cnt, UInt(16)),
+             RegDec(fin, UInt(1))]
+    body = stmts
+    for i in range(n):
+        if_stmts = [ConnectStmt(cnt, cnt + Lit(i))]
+        if i % 2 == 0:
+            if_stmts.append(ConnectStmt(fin, Lit(i % 3 == 0)))
+        when = WhenStmt(Id("sel") == Lit(i), if_stmts, [])
+        body.append(when)
+        body = when.else_stmts
+    return ModuleDec("Chain", None, stmts)
+
+if __name__ == "__main__":
+    n = 50000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for depth in (n, 2 * n):
+        mdec = chain_module(depth)
+        start = time.time()
+        expand_whens([mdec])
+        done = time.time() - start
+        print "%d nested whens expanded in %.3f s (%.1f us each), " \
+            "%d statements left" % (depth, done, done * 1e6 / depth,
+                                    len(mdec.stmts))
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""
+Infers the widths of a synthetic module with a long chain of registers of
+unknown width, each one holding its value through a `Mux` feedback loop
+and widened by an adder from the previous one, and reports the time taken.
+
+    $> python bench/bench_widths.py [n_regs]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pyrrhic.pyrast import *
+from pyrrhic.passes import infer_widths
+
+def chain_module(n):
+    """
+    Returns a `ModuleDec` with `n` chained registers, each one connected
+    as ``r_i := Mux(en, r_i, r_(i-1) + 1)``, except that every 16th one
+    takes the low byte of the previous one instead.
+    """
+    en = Id("en")
+    stmts = [WireDec(Id("en"), UInt(1)), WireDec(Id("in"), UInt(8))]
+    prev = Id("in")
+    for i in range(n):
+        r = Id("r%d" % i)
+        stmts.append(RegDec(r, UInt()))
+        if i % 16 == 15:
+            # Keep the widths from growing with `n`
+            src = Bits(prev, 7, 0)
+        else:
+            src = Add(prev, Lit(1))
+        stmts.append(ConnectStmt(r, Mux(en, r, src)))
+        prev = r
+    stmts.append(WireDec(Id("out"), UInt()))
+    stmts.append(ConnectStmt(Id("out"), Cat(prev, en)))
+    return ModuleDec("Chain", None, stmts)
+
+if __name__ == "__main__":
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    mdec = chain_module(n)
+    start = time.time()
+    inferred = infer_widths([mdec])
+    done = time.time()
+    print "%d declarations inferred in %.3f s (%.1f us each)" % \
+        (inferred, done - start, (done - start) * 1e6 / inferred)
+    print str(mdec.stmts[-1]), ":", str(mdec.stmts[-2].type)
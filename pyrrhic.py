@@ -3,23 +3,201 @@
 Compiles a PyRRHIC Source File.
 """
 from pyrrhic import builder
-from pyrrhic.builder import elaborate_all_instances
-from pyrrhic.builder import context as ctx
-from pyrrhic.builder import astgen
-import sys
-
-if len(sys.argv) < 2:
-  print "Usage: pyrric [sources]"
-  sys.exit(-1)
-
-for a in sys.argv[1:]:
-  code = astgen.compile_pyrrhic(a)
-  exec(code)
-
-elaborate_all_instances()
-
-print "\n\n---------------\n"
-for c in ctx.elaborated_instances:
-    mdec = ctx.elaborated_instances[c]
-    print str(mdec)
-    print "\n"
+from pyrrhic.builder import ElaborationSession, elaborate_all_instances
+from pyrrhic.builder import astgen, importer
+from pyrrhic.builder.incremental import DependencyGraph
+from pyrrhic.builder.modcache import ModuleCache
+from pyrrhic import passes, server, trace
+from pyrrhic.pyrast import emit, expr
+import argparse, os, sys, time, traceback
+
+DefaultStatePath = ".pyrrhic-state"
+
+def compile_design(args):
+  """
+  Compiles, executes and elaborates the sources named by `args`, then
+  writes the resulting IR to stdout or to the file given with ``-o``.
+  """
+  # Sources may import other PyRRHIC modules living next to them.
+  roots = []
+  for a in args.sources:
+    root = os.path.dirname(os.path.abspath(a))
+    if root not in roots:
+      roots.append(root)
+  hook = importer.install(roots, use_cache = not args.no_cache)
+  if args.trace != None:
+    trace.configure(args.trace, args.trace_file)
+  if args.hash_cons:
+    expr.enable_hash_consing()
+
+  # Compilation may run in parallel, but sources are always executed in the
+  # order they were given, sharing one namespace.
+  session = ElaborationSession()
+  session.capture_locations = args.locations
+  if args.module_cache or args.module_cache_dir != None:
+    session.module_cache = ModuleCache(args.module_cache_dir,
+                                       args.module_cache_size << 20)
+  env = {"__name__": "__main__", "builder": builder,
+         "__builtins__": importer.builtins()}
+  with session:
+    for code in astgen.compile_all(args.sources, args.jobs, hook.cache):
+      exec code in env
+
+  graph = None
+  if args.state != None:
+    graph = DependencyGraph(args.state)
+  elaborate_all_instances(graph, session)
+  if graph != None:
+    graph.save()
+    sys.stderr.write("pyrrhic: %d modules elaborated, %d reused\n" % \
+                     (graph.elaborated, graph.reused))
+  if session.module_cache != None:
+    sys.stderr.write("pyrrhic: module cache: %d hits, %d stored\n" % \
+                     (session.module_cache.hits, session.module_cache.stored))
+
+  trace.disable()
+
+  mdecs = session.elaborated_instances.values()
+  if args.fold_constants:
+    passes.fold_constants(mdecs)
+  if args.remove_dead:
+    report = passes.remove_dead_code(mdecs)
+    sys.stderr.write("pyrrhic: dead code: %s\n" % report)
+  if args.infer_widths:
+    passes.infer_widths(mdecs)
+  if args.expand_whens:
+    passes.expand_whens(mdecs)
+  if args.top != None:
+    try:
+      mdecs = emit.modules_under(mdecs, args.top)
+    except KeyError, e:
+      parser.error(e.args[0])
+  if args.output != None:
+    emit.write_output(args.output, mdecs)
+  else:
+    print "\n\n---------------\n"
+    emitter = emit.Emitter(sys.stdout)
+    for mdec in mdecs:
+      emitter.emit_module(mdec)
+      sys.stdout.write("\n\n\n")
+
+def watched_files(args):
+  """
+  Returns the modification times of the sources and of every file the
+  modules of the last run depended on.
+  """
+  files = set(os.path.abspath(a) for a in args.sources)
+  for rec in DependencyGraph(args.state).previous.values():
+    files.update(rec["files"])
+  stamps = {}
+  for f in files:
+    try:
+      stamps[f] = os.stat(f).st_mtime
+    except OSError:
+      stamps[f] = None
+  return stamps
+
+def watch(args):
+  """
+  Recompiles the design whenever one of its inputs changes.  Each run
+  happens in a forked child, so the builder always starts from a clean
+  state while the dependency graph carries over between runs.
+  """
+  while True:
+    pid = os.fork()
+    if pid == 0:
+      status = 0
+      try:
+        compile_design(args)
+      except SystemExit, e:
+        status = e.code
+      except:
+        traceback.print_exc()
+        status = 1
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+    os.waitpid(pid, 0)
+
+    stamps = watched_files(args)
+    while watched_files(args) == stamps:
+      time.sleep(args.watch_interval)
+
+parser = argparse.ArgumentParser(prog = "pyrrhic")
+parser.add_argument("sources", nargs = "*", help = "PyRRHIC sources")
+parser.add_argument("-j", "--jobs", type = int, default = 1, metavar = "N",
+                    help = "compile sources in N parallel processes")
+parser.add_argument("-o", "--output", metavar = "FILE",
+                    help = "write the IR to FILE instead of to stdout: "
+                           "gzip-compressed if FILE ends in .gz, in binary "
+                           "form if it ends in .pyrb")
+parser.add_argument("--top", metavar = "MODULE",
+                    help = "only output MODULE and the modules under it")
+parser.add_argument("--no-cache", action = "store_true",
+                    help = "don't use the on-disk cache of compiled sources")
+parser.add_argument("--hash-cons", action = "store_true",
+                    help = "share one node between structurally equal "
+                           "expressions")
+parser.add_argument("--locations", action = "store_true",
+                    help = "annotate the IR with @[file line] source "
+                           "locations")
+parser.add_argument("--infer-widths", action = "store_true",
+                    help = "infer the widths of UInt() and SInt() "
+                           "declarations from their drivers")
+parser.add_argument("--fold-constants", action = "store_true",
+                    help = "replace constant expressions with literals, "
+                           "and propagate them through wires")
+parser.add_argument("--remove-dead", action = "store_true",
+                    help = "remove wires and registers that don't affect "
+                           "any module's io or instances")
+parser.add_argument("--expand-whens", action = "store_true",
+                    help = "replace when statements with multiplexers "
+                           "driving each target once")
+parser.add_argument("--trace", metavar = "SPEC",
+                    help = "trace the builder; SPEC is a comma-separated "
+                           "list of CATEGORY[:LEVEL] (categories: %s, all; "
+                           "levels: info, debug)" % ", ".join(trace.Categories))
+parser.add_argument("--trace-file", metavar = "FILE",
+                    help = "write trace records to FILE as JSON lines "
+                           "instead of to stderr")
+parser.add_argument("--state", metavar = "FILE",
+                    help = "reuse unchanged modules elaborated by the last "
+                           "run, as recorded in FILE")
+parser.add_argument("--module-cache", action = "store_true",
+                    help = "reuse leaf modules elaborated by earlier runs "
+                           "with the same source and arguments")
+parser.add_argument("--module-cache-dir", metavar = "DIR",
+                    help = "store the module cache in DIR instead of under "
+                           "the code cache (implies --module-cache)")
+parser.add_argument("--module-cache-size", type = int, default = 256,
+                    metavar = "MB",
+                    help = "evict the least recently used modules once the "
+                           "module cache exceeds MB megabytes")
+parser.add_argument("--watch", action = "store_true",
+                    help = "recompile whenever an input changes (implies "
+                           "--state)")
+parser.add_argument("--watch-interval", type = float, default = 1.0,
+                    metavar = "SECONDS",
+                    help = "poll the inputs of --watch every SECONDS")
+parser.add_argument("--serve", action = "store_true",
+                    help = "run a compile server (see pyrrhic_client.py)")
+parser.add_argument("--socket", metavar = "PATH",
+                    help = "Unix socket of the --serve server (default: %s)" \
+                           % server.default_socket_path())
+args = parser.parse_args()
+if args.trace != None:
+  try:
+    args.trace = trace.parse_spec(args.trace)
+  except ValueError, e:
+    parser.error(str(e))
+
+if args.serve:
+  server.serve(args.socket, use_cache = not args.no_cache)
+elif not args.sources:
+  parser.error("no sources given")
+elif args.watch:
+  if args.state == None:
+    args.state = DefaultStatePath
+  watch(args)
+else:
+  compile_design(args)
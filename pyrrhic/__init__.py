@@ -2,6 +2,7 @@
 PyRRHIC: Python Rtl Refactoring and High-level Ic Construction language.
 """
 __all__ = ['builder', 'pyrast']
+__version__ = "0.1.3"
 
 from pyrast import *
 import builder
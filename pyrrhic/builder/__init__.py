@@ -1,19 +1,97 @@
 from pyrrhic.builder import context as ctx
+from pyrrhic.builder.context import ElaborationSession
 from pyrrhic.pyrast import ModuleDec
 
-def elaborate_all_instances():
+from collections import OrderedDict
+
+def share_identical_instances(session = None):
+    """
+    Names every instance context, giving instances of the same class built
+    from structurally equal parameters, whose bodies are verified to be
+    identical, the name of (and a `definition` link to) the first such
+    instance instead of a definition of their own.  Works on `session`, by
+    default the current `ctx.ElaborationSession`.
+
+    Contexts are visited in instantiation order, so contained instances are
+    resolved before the instances containing them, and parents of shared
+    instances can be shared in turn.
+    """
+    if session == None:
+        session = ctx.current()
+    # Maps structural keys to lists of [digest, context] candidates.  The
+    # digest of the first candidate is only computed once a second instance
+    # with the same key shows up.
+    candidates = {}
+    for inst in session.all_instance_contexts:
+        ic = session.all_instance_contexts[inst]
+        key = ic.structural_key()
+        if key != None:
+            if key in candidates:
+                digest = ic.body_digest()
+                for cand in candidates[key]:
+                    if cand[0] == None:
+                        cand[0] = cand[1].body_digest()
+                    if cand[0] == digest:
+                        ic.definition = cand[1]
+                        break
+                if ic.definition != None:
+                    ic.name = ic.definition.name
+                    continue
+                candidates[key].append([digest, ic])
+            else:
+                candidates[key] = [[None, ic]]
+        ic.rename(session)
+
+def elaborate_all_instances(graph = None, session = None):
+    """
+    Elaborates every module instance of `session` (by default the current
+    `ctx.ElaborationSession`) into a `ModuleDec`, stored in its
+    `elaborated_instances`.
+
+    Instances found in the session's `module_cache` when they were
+    constructed use the cached `ModuleDec`; the others are stored there.
+
+    Every `ModuleDec` gets statements of its own, including those elaborated
+    from the updates an instance shares with its class context, so passes
+    may modify one without affecting the others.  Expression nodes are
+    shared, and are never modified.
+
+    Parameters
+    ----------
+    graph (incremental.DependencyGraph): If given, instances whose inputs
+        are unchanged since the run recorded in `graph` reuse the stored
+        `ModuleDec` instead of being elaborated again, and `graph` is
+        updated with this run's results.
+    session (ctx.ElaborationSession): Session to elaborate
+    """
+    if session == None:
+        session = ctx.current()
     # All instance contexts must be renamed before elaboration
     # so that the new names are propagated into the PyRRHIC AST nodes.
-    for inst in ctx.all_instance_contexts:
-      ctx.all_instance_contexts[inst].rename()
-
-    for inst in ctx.all_instance_contexts:
-        ic = ctx.all_instance_contexts[inst]
-        ic.renameIds()
-        stmts = []
-        for u in ic.updates:
-            stmts += [u.elaborate()]
-        mdec = ModuleDec(ic.name, ic.module.io, stmts)
-        ctx.elaborated_instances[inst] = mdec
-    ctx.all_instance_contexts = {}
+    share_identical_instances(session)
+
+    for inst in session.all_instance_contexts:
+        ic = session.all_instance_contexts[inst]
+        if ic.definition != None:
+            continue
+        mdec = None
+        if graph != None:
+            mdec = graph.lookup(ic)
+        if mdec == None:
+            if ic.cached != None:
+                mdec = ModuleDec(ic.name, ic.cached.io, ic.cached.stmts)
+            else:
+                ic.renameIds()
+                stmts = []
+                for u in ic.updates:
+                    stmts += [u.elaborate()]
+                mdec = ModuleDec(ic.name, ic.module.io, stmts)
+                if session.module_cache != None:
+                    session.module_cache.store(ic, mdec)
+            if graph != None:
+                graph.store(ic, mdec)
+        session.elaborated_instances[inst] = mdec
+    session.all_instance_contexts = OrderedDict()
+    if session.module_cache != None:
+        session.module_cache.trim()
 
@@ -10,22 +10,78 @@ This module also includes utility functions for producing Python
 from pyrrhic import builder, pyrast
 from pyrrhic.builder import instrument
 from pyrrhic.builder.bdast import *
-import ast, inspect, copy
+import ast, bisect, inspect, copy, marshal, re, sys
 
-def compile_pyrrhic(path):
+# Bumped whenever the code generated for the same source changes, so that
+# `codecache.CodeCache` entries made by older instrumentation are not reused
+InstrumentationVersion = 2
+
+def compile_pyrrhic(path, cache=None):
     """
     Parses the Python source at `path`, gets the AST, transforms it,
     and returns the compiled AST.
+
+    If a `codecache.CodeCache` is given as `cache`, an instrumented code
+    object previously stored for the same source is returned instead, and
+    freshly compiled code is stored there.
     """
     f = open(path, "r")
     src = f.read()
     f.close()
-    past = ast.parse(src)
-    ModuleWalker().visit(past)
+    if cache != None:
+        code = cache.load(path, src)
+        if code != None:
+            return code
+    code = compile_pyrrhic_source(src, path)
+    if cache != None:
+        cache.store(path, src, code)
+    return code
+
+def compile_pyrrhic_source(src, path):
+    """
+    Instruments and compiles the PyRRHIC source text `src`, using `path` as
+    the file name recorded in the resulting code object.
+    """
+    past = ast.parse(src, path)
+    ModuleWalker(src).visit(past)
     past = ast.fix_missing_locations(past)
     code = compile(past, path, mode='exec')
     return code
 
+def _compile_marshaled(args):
+    """
+    Process pool worker for `compile_all`.  Code objects can't be pickled,
+    so the result travels back marshaled.
+    """
+    (path, cache_dir) = args
+    cache = None
+    if cache_dir != None:
+        from pyrrhic.builder.codecache import CodeCache
+        cache = CodeCache(cache_dir)
+    return marshal.dumps(compile_pyrrhic(path, cache))
+
+def compile_all(paths, jobs=1, cache=None):
+    """
+    Compiles every source in `paths` and returns the code objects in the
+    same order.  With `jobs` > 1 the sources are parsed and instrumented in
+    a pool of `jobs` worker processes.
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        return [compile_pyrrhic(p, cache) for p in paths]
+
+    import multiprocessing
+    cache_dir = None
+    if cache != None:
+        cache_dir = cache.path
+    pool = multiprocessing.Pool(min(jobs, len(paths)))
+    try:
+        results = pool.map(_compile_marshaled, [(p, cache_dir) for p in paths],
+                           chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+    return [marshal.loads(r) for r in results]
+
 def name_id(id, store=False):
     if not isinstance(id, str):
         return id
@@ -89,6 +145,75 @@ def compare_attributes(a1, a2):
     else:
         return a1 == a2
 
+def attr_path(node):
+    """
+    Returns the names along a nested `ast.Attribute`/`ast.Name` node as a
+    tuple, or `None` if `node` is anything else.  Unlike `compare_attributes`
+    this lets a node be matched against a precomputed tuple without building
+    an AST to compare it with:
+
+    >>> attr_path(id_attr(["a", "b", "c"]))
+      ('a', 'b', 'c')
+    """
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    names.append(node.id)
+    names.reverse()
+    return tuple(names)
+
+# Precomputed call targets of the instrumentation inserted by `ModuleWalker`
+MAKE_BUILDER_INSTANCE = ("builder", "instrument", "make_builder_instance")
+MAKE_BUILDER_DEC = ("builder", "instrument", "make_builder_dec")
+
+# Matches the source text of PyRRHIC constructs: a reference to `Module`,
+# `Wire`, `Reg` or `When`, or a ``//=`` wiring operator.
+PYRRHIC_PATTERN = re.compile(r"\b(?:Module|Wire|Reg|When)\b|//=")
+
+def find_hot_lines(src):
+    """
+    Returns the sorted list of (1-based) line numbers of `src` on which a
+    PyRRHIC construct may appear.  Statements not spanning any of these
+    lines can't be changed by `ModuleWalker` and are skipped by it.
+
+    Scanning the text is far cheaper than walking the AST, and a false
+    positive (say, ``Reg`` in a comment) only costs a visit.
+    """
+    line_starts = [0]
+    pos = src.find("\n")
+    while pos >= 0:
+        line_starts.append(pos + 1)
+        pos = src.find("\n", pos + 1)
+    lines = []
+    for m in PYRRHIC_PATTERN.finditer(src):
+        line = bisect.bisect_right(line_starts, m.start())
+        if len(lines) == 0 or lines[-1] != line:
+            lines.append(line)
+    return lines
+
+def last_line(nodes):
+    """
+    Returns the largest line number found in the given AST nodes and their
+    descendants.
+    """
+    line = 0
+    for n in nodes:
+        for sub in ast.walk(n):
+            line = max(line, getattr(sub, "lineno", 0))
+    return line
+
+def set_line(node, line):
+    """
+    Sets the line number of `node` and all its descendants to `line`.
+    """
+    for sub in ast.walk(node):
+        if "lineno" in sub._attributes:
+            sub.lineno = line
+            sub.col_offset = 0
+
 def get_keyword(call, keyword):
     """
     Returns the value of a keyword argument to an `ast.Call` node, or
@@ -166,7 +291,93 @@ class ModuleWalker(ast.NodeTransformer):
     3. Replaces any assignment of a Python identifier to `Wire()` or
         `Reg()` with an asignment to a `BuilderId`, and adds
         a new `BuilderDec` statement after it.
+
+    If the `source` text of the tree is given, it is first pre-scanned with
+    `find_hot_lines` and only statements spanning lines with PyRRHIC
+    constructs are visited; everything else is left untouched.  Pass
+    ``prune = False`` to visit every node regardless.
     """
+    def __init__(self, source = None, prune = True):
+        self.hot_lines = None
+        if prune and source != None:
+            self.hot_lines = find_hot_lines(source)
+        # Last line of the statement currently being visited
+        self.span_end = sys.maxint
+
+    def is_hot(self, first, last):
+        """
+        Returns `True` iff a PyRRHIC construct appears between lines `first`
+        and `last`, inclusive.
+        """
+        i = bisect.bisect_left(self.hot_lines, first)
+        return i < len(self.hot_lines) and self.hot_lines[i] <= last
+
+    def visit_stmts(self, stmts):
+        """
+        Visits a list of statements, skipping cold ones, and returns `True`
+        if any of them was replaced.
+
+        Python 2 ASTs carry no end line numbers, so each statement is taken
+        to extend up to the line before its successor, and the last one up
+        to the end of the enclosing statement.
+        """
+        changed = False
+        outer_end = self.span_end
+        for i in range(len(stmts)):
+            stmt = stmts[i]
+            if self.hot_lines != None:
+                if i + 1 < len(stmts):
+                    end = max(stmts[i + 1].lineno - 1, stmt.lineno)
+                else:
+                    end = outer_end
+                if not self.is_hot(stmt.lineno, end):
+                    continue
+                self.span_end = end
+            new_stmt = self.visit(stmt)
+            self.span_end = outer_end
+            if new_stmt is not stmt:
+                stmts[i] = new_stmt
+                changed = True
+        return changed
+
+    def generic_visit(self, node):
+        """
+        Like `ast.NodeTransformer.generic_visit`, but rewrites `node` in place,
+        only splicing lists whose contents actually changed.
+        """
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if len(value) > 0 and isinstance(value[0], ast.stmt):
+                    changed = self.visit_stmts(value)
+                else:
+                    changed = False
+                    for i in range(len(value)):
+                        item = value[i]
+                        if isinstance(item, ast.AST):
+                            new_item = self.visit(item)
+                            if new_item is not item:
+                                value[i] = new_item
+                                changed = True
+                if changed:
+                    # Visitors may delete a node (`None`) or expand it into
+                    # several (a list), as `visit_If` does.
+                    new_values = []
+                    for item in value:
+                        if item == None:
+                            continue
+                        elif isinstance(item, list):
+                            new_values.extend(item)
+                        else:
+                            new_values.append(item)
+                    value[:] = new_values
+            elif isinstance(value, ast.AST):
+                new_node = self.visit(value)
+                if new_node == None:
+                    delattr(node, field)
+                elif new_node is not value:
+                    setattr(node, field, new_node)
+        return node
 
     def check_for_module(self, node):
         """
@@ -176,7 +387,7 @@ class ModuleWalker(ast.NodeTransformer):
         """
         isModule = False
         for base in node.bases:
-            if base.id == "Module":
+            if isinstance(base, ast.Name) and base.id == "Module":
                 isModule = True
         return isModule
 
@@ -234,7 +445,9 @@ class ModuleWalker(ast.NodeTransformer):
           init = self.make_instrumented_init(module.name)
           module.body.append(init)
 
-        module.body.append(inst_call(instrument.module_end.__name__, name))
+        end = inst_call(instrument.module_end.__name__, name)
+        set_line(end, last_line(module.body))
+        module.body.append(end)
 
         return module
 
@@ -243,14 +456,28 @@ class ModuleWalker(ast.NodeTransformer):
         Adds instrumentation calls to the beginning and end of the body of
         a `Module` class' `__init__` method.
 
-        Specifically, `instrument.module_inst_begin("class_name")` and
-        `instrument.module_inst_end(self)` are inserted.
+        Specifically, `instrument.module_inst_begin("class_name", locals())`
+        and `instrument.module_inst_end(self)` are inserted.  At the top of
+        the method, ``locals()`` holds exactly the constructor's arguments.
+        If `module_inst_begin` finds the module's elaboration in the
+        session's `modcache.ModuleCache`, the rest of the body is skipped:
+
+        >>> if builder.instrument.module_inst_begin("M", locals()):
+        ...     builder.instrument.module_inst_end(self)
+        ...     return
         """
         beginFunc = instrument.module_inst_begin.__name__
         endFunc = instrument.module_inst_end.__name__
-        begin = inst_call(beginFunc, [ast.Str(class_name)])
+        params = ast.Call(func = name_id("locals"), args = [], keywords = [],
+                          starargs = None, kwargs = None)
+        begin = inst_call(beginFunc, [ast.Str(class_name), params]).value
+        cached = ast.If(test = begin,
+                        body = [inst_call(endFunc, [name_id("self")]),
+                                ast.Return(value = None)],
+                        orelse = [])
         end = inst_call(endFunc, [name_id("self")])
-        function_dec.body.insert(0, begin)
+        set_line(end, last_line(function_dec.body))
+        function_dec.body.insert(0, cached)
         function_dec.body.append(end)
         return function_dec
 
@@ -263,7 +490,13 @@ class ModuleWalker(ast.NodeTransformer):
         >>> builder.instrument.make_builder_instance(M(...), "M")
         """
         modClassInit = call.args[0] # Also `ast.Call` type
-        modClassName = ast.Str(s = modClassInit.func.id)
+        func = modClassInit.func
+        # `M(...)` or, for classes imported from another PyRRHIC module,
+        # `lib.M(...)`
+        if isinstance(func, ast.Attribute):
+            modClassName = ast.Str(s = func.attr)
+        else:
+            modClassName = ast.Str(s = func.id)
         args = [modClassInit, modClassName]
         icall = inst_call(instrument.make_builder_instance.__name__, args).value
         return icall
@@ -321,7 +554,7 @@ class ModuleWalker(ast.NodeTransformer):
 
         >>> builder.instrument.make_builder_dec(type, True, on_reset = ...)
         """
-        if compare_attributes(call.func, name_id("Reg")):
+        if isinstance(call.func, ast.Name) and call.func.id == "Reg":
             is_reg = name_id("True")
         else:
             is_reg = name_id("False")
@@ -354,6 +587,14 @@ class ModuleWalker(ast.NodeTransformer):
         else_call = inst_call(instrument.when_else.__name__, [])
         end = inst_call(instrument.when_end.__name__, [])
 
+        # `when_begin` gets the line of the `if`, so that source locations
+        # captured by the builder point at the `When()`.  Line numbers of
+        # Python 2 code objects may never decrease, so the other calls get
+        # the last line of the code preceding them.
+        set_line(begin, if_stmt.lineno)
+        set_line(else_call, last_line([if_stmt.test] + if_stmt.body))
+        set_line(end, last_line([if_stmt]))
+
         res = [begin] + if_stmt.body + [else_call] + if_stmt.orelse + [end]
         return res
 
@@ -365,11 +606,15 @@ class ModuleWalker(ast.NodeTransformer):
         ----------
         aug_assign (ast.AugAssign) A Python AST for ``//=``
         """
-        lhs = copy.deepcopy(aug_assign.target)
-        rhs = copy.deepcopy(aug_assign.value)
+        # The `AugAssign` node is discarded, so its operands can be reused
+        # as they are rather than copied.
+        lhs = aug_assign.target
+        rhs = aug_assign.value
         for term in [lhs, rhs]:
             term.ctx = ast.Load()
         res = make_call(builder.bdast.Connect.__name__, [lhs, rhs])
+        ast.copy_location(res, aug_assign)
+        ast.copy_location(res.value, aug_assign)
         return res
 
     def check_for_explicit_module_instance(self, assign):
@@ -377,11 +622,8 @@ class ModuleWalker(ast.NodeTransformer):
         Returns true iff `assign` is a wrapped instantiation of a module, of the
         form ``m = builder.instrument.make_builder_instance(M(...))``
         """
-        lval = assign.targets[0]    # Should be an `ast.Name`
-        fname = id_attr(["builder", "instrument", "make_builder_instance"])
         if isinstance(assign.value, ast.Call):
-            call = assign.value
-            if compare_attributes(call.func, fname):
+            if attr_path(assign.value.func) == MAKE_BUILDER_INSTANCE:
                 return True
         return False
 
@@ -400,8 +642,7 @@ class ModuleWalker(ast.NodeTransformer):
         >>> w = builder.instrument.make_builder_dec(type, ...)
         """
         if isinstance(assign.value, ast.Call):
-            fname = id_attr(["builder", "instrument", "make_builder_dec"])
-            if compare_attributes(assign.value.func, fname):
+            if attr_path(assign.value.func) == MAKE_BUILDER_DEC:
                 return True
         return False
 
@@ -419,7 +660,8 @@ class ModuleWalker(ast.NodeTransformer):
         statement.
         """
         if isinstance(if_stmt.test, ast.Call):
-          if if_stmt.test.func.id == 'When':
+          func = if_stmt.test.func
+          if isinstance(func, ast.Name) and func.id == 'When':
             return True
         return False
 
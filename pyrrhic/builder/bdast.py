@@ -7,8 +7,11 @@ package into `pyrast`.
 """
 from pyrrhic.pyrast import *
 from pyrrhic.builder import context
+from pyrrhic import trace
+from collections import OrderedDict
+import sys
 
-class BuilderType:
+class BuilderType(object):
     __is_reversed__ = False
 
 class Reverse(BuilderType):
@@ -20,13 +23,43 @@ class Reverse(BuilderType):
     def __as_lower_type__(self):
         raise AssertionError("Shouldn't be called")
 
+class BundleBuilder(type):
+    """
+    Metaclass of `BundleDec` types.  Records the source file defining each
+    bundle type so that elaborated modules can track what they depend on.
+    """
+    def __init__(self, name, bases, attrs):
+        super(BundleBuilder, self).__init__(name, bases, attrs)
+        self.__source_file__ = sys._getframe(1).f_code.co_filename
+
+    def class_fields(self):
+        """
+        Returns a dict of the fields declared in the bodies of this class and
+        its bases, by name.  Computed once per class.
+        """
+        if "__class_fields__" not in vars(self):
+            fields = {}
+            for c in reversed(self.__mro__):
+                for (name, value) in vars(c).items():
+                    if name[0] != "_" and hasattr(value, "__as_lower_type__"):
+                        fields[name] = value
+            self.__class_fields__ = fields
+        return self.__class_fields__
+
 class BundleDec(BuilderType):
+    __metaclass__ = BundleBuilder
+
     def __as_lower_type__(self):
-        fields = {}
-        for f in inspect.getmembers(self):
-            (name, type) = f
-            if name[0] == "_":
-                continue
+        # Fields set by `__init__` override those of the class
+        members = dict(self.__class__.class_fields())
+        for (name, value) in vars(self).items():
+            if name[0] != "_" and hasattr(value, "__as_lower_type__"):
+                members[name] = value
+        # In name order, which `Bundle.field` lays out from the most
+        # significant bits down
+        fields = OrderedDict()
+        for name in sorted(members):
+            type = members[name]
             orientation = Field.Default
             if isinstance(type, BuilderType) and type.__is_reversed__:
                 orientation = Field.Reverse
@@ -38,9 +71,13 @@ class BundleDec(BuilderType):
 
 class BuilderStmt(Stmt):
     isDec = False
+    __slots__ = ()
     def __init__(self):
-        print "ADDING "+str(self)
-        context.cur_context.updates += [self]
+        cur_context = context.current().cur_context
+        if trace.enabled and trace.on(trace.BUILDER, trace.DEBUG):
+            trace.emit(trace.BUILDER, trace.DEBUG, "update",
+                       stmt = repr(self), context = cur_context.name)
+        cur_context.updates += [self]
 
     # def traverse_exprs(self, func):
     #     """
@@ -57,29 +94,55 @@ class BuilderStmt(Stmt):
 
 
 class BuilderExpr(Expr):
-    pass
+    __slots__ = ()
 
 class BuilderId(BuilderExpr):
+    # `__final__` is the unique `Id` this id is replaced with when its
+    # context is elaborated; see `BuilderContext.make_builder_id`.
+    # `__type__` is the lowered type of the declaration, if known.
+    __slots__ = ("__n__", "__name__", "__final__", "__type__")
+    __typed__ = True
     def __init__(self, name):
         # Add this Id as a declaration to the current builder context
-        self.__n__ = context.cur_context.instanceCount
-        context.cur_context.instanceCount += 1
+        cur_context = context.current().cur_context
+        self.__n__ = cur_context.instanceCount
+        cur_context.instanceCount += 1
         self.__name__ = name
+        self.__final__ = name
+        self.__type__ = None
+    def __str__(self):
+        # Stable within a context, unlike `__repr__`, so that update logs
+        # can be compared before renaming.
+        return str(self.__name__)+"#"+str(self.__n__)
     def __repr__(self):
         return "{"+str(self.__name__)+" : "+(super(BuilderId, self).__repr__())+"}"
 
 
 class BuilderDec(BuilderStmt):
+    __slots__ = ("idt",)
+    __exprs__ = ("idt",)
     def __init__(self, idt):
         self.idt = idt
-        name = context.cur_context.name
-        print "ADDING CONTEXT UPDATE "+str(self)+" to "+name
-        context.cur_context.updates += [self]
+        cur_context = context.current().cur_context
+        if trace.enabled and trace.on(trace.BUILDER, trace.DEBUG):
+            trace.emit(trace.BUILDER, trace.DEBUG, "declaration",
+                       stmt = repr(self), context = cur_context.name)
+        cur_context.updates += [self]
+
+    def lowered_type(self):
+        """
+        Returns the lowered type of the declared wire or register, lowering
+        its builder type the first time only.
+        """
+        if self.__ltype__ == None:
+            self.__ltype__ = self.btype.__as_lower_type__()
+        return self.__ltype__
 
 
 
 class Wire(BuilderDec):
     isReg = False
+    __slots__ = ("btype", "__ltype__")
     def __init__(self, type, idt = None):
         """
         Represents a wire declaration.
@@ -91,6 +154,7 @@ class Wire(BuilderDec):
         btype -- A `BuilderType` argument
         """
         self.btype = type
+        self.__ltype__ = None
         self.idt = idt
         super(Wire, self).__init__(idt)
 
@@ -102,10 +166,14 @@ class Wire(BuilderDec):
         return self
 
     def elaborate(self):
-        return WireDec(self.idt, self.btype.__as_lower_type__())
+        res = WireDec(self.idt, self.lowered_type())
+        res.lineInfo = self.lineInfo
+        return res
 
 class Reg(BuilderDec):
     isReg = True
+    __slots__ = ("btype", "onReset", "__ltype__")
+    __exprs__ = ("idt", "onReset")
 
     def __init__(self, type, onReset = None, idt = None):
         """
@@ -119,6 +187,7 @@ class Reg(BuilderDec):
         """
         self.onReset = onReset
         self.btype = type
+        self.__ltype__ = None
         self.idt = idt
         super(Reg, self).__init__(idt)
 
@@ -132,11 +201,14 @@ class Reg(BuilderDec):
         return self
 
     def elaborate(self):
-        return RegDec(idt = self.idt, \
-                        type = self.btype.__as_lower_type__(), \
+        res = RegDec(idt = self.idt, \
+                        type = self.lowered_type(), \
                         onReset = self.onReset)
+        res.lineInfo = self.lineInfo
+        return res
 
 class BuilderTypeDec(BuilderStmt):
+    __slots__ = ("bundleDec",)
     def __init__(self, bundleDec):
         self.bundleDec = bundleDec
     def elaborate(self):
@@ -145,19 +217,127 @@ class BuilderTypeDec(BuilderStmt):
         pass
 
 class Connect(BuilderStmt):
+    __slots__ = ("lval", "rval")
+    __exprs__ = ("lval", "rval")
     def __init__(self, lval, rval):
         self.lval = lval
         self.rval = rval
+        if context.current().capture_locations:
+            self.lineInfo = LineInfo(2)
         BuilderStmt.__init__(self)
     def traverse_exprs(self, func):
         self.lval = self.lval.__traverse__(func)
         self.rval = self.rval.__traverse__(func)
         return self
     def elaborate(self):
-        return ConnectStmt(self.lval, self.rval)
+        res = ConnectStmt(self.lval, self.rval)
+        res.lineInfo = self.lineInfo
+        return res
     def __repr__(self):
         return str(self.lval) + " := " + str(self.rval)
 
+class BuilderForEach(BuilderStmt):
+    """
+    Connects every element of a vector from one template expression; made by
+    `Tabulate`, `MapElements` and `ConnectElements`.
+    """
+    __slots__ = ("lval", "count", "template")
+    __exprs__ = ("lval", "template")
+    def __init__(self, lval, count, template):
+        self.lval = lval
+        self.count = count
+        self.template = template
+        if context.current().capture_locations:
+            self.lineInfo = LineInfo(3)
+        BuilderStmt.__init__(self)
+    def traverse_exprs(self, func):
+        self.lval = self.lval.__traverse__(func)
+        self.template = self.template.__traverse__(func)
+        return self
+    def elaborate(self):
+        res = ForEachStmt(self.lval, self.count, self.template)
+        res.lineInfo = self.lineInfo
+        return res
+    def __repr__(self):
+        return "foreach i < " + str(self.count) + ": " + str(self.lval) + \
+            "[i] := " + str(self.template)
+
+class BuilderConnectEach(BuilderStmt):
+    """
+    Connects every element of a vector from a list of expressions; made by
+    `ConnectElements`.
+    """
+    __slots__ = ("lval", "rvals")
+    __exprs__ = ("lval", "rvals")
+    def __init__(self, lval, rvals):
+        self.lval = lval
+        self.rvals = rvals
+        if context.current().capture_locations:
+            self.lineInfo = LineInfo(3)
+        BuilderStmt.__init__(self)
+    def traverse_exprs(self, func):
+        self.lval = self.lval.__traverse__(func)
+        self.rvals = [e.__traverse__(func) for e in self.rvals]
+        return self
+    def elaborate(self):
+        # Instances share their class updates, so they mustn't share the list
+        res = ConnectEachStmt(self.lval, list(self.rvals))
+        res.lineInfo = self.lineInfo
+        return res
+    def __repr__(self):
+        return str(self.lval) + " := [" + \
+            ", ".join([str(e) for e in self.rvals]) + "]"
+
+def vec_count(vec, count = None):
+    """
+    Returns the number of elements of the vector expression `vec`: `count`
+    if given, and the length of its `Vec` type otherwise.  Raises
+    `TypeError` if that type isn't known.
+    """
+    if count != None:
+        return count
+    t = resolve_type(vec)
+    if not isinstance(t, Vec):
+        raise TypeError("%s is not a vector of known length" % vec)
+    return t.count
+
+def Tabulate(vec, func, count = None):
+    """
+    Connects each element ``vec[i]`` to ``func(i)``, with one statement for
+    the whole vector.  `func` is called once, on an `Index` standing for
+    every ``i``, and must only use it in expressions.
+
+    Parameters
+    ----------
+    vec (Expr): Vector wire or register to drive
+    func (function): Maps the index expression to an element's value
+    count (int): Number of elements, if the type of `vec` isn't known
+    """
+    BuilderForEach(vec, vec_count(vec, count), func(Index()))
+
+def MapElements(vec, func, src, count = None):
+    """
+    Connects each element ``vec[i]`` to ``func(src[i])``, with one statement
+    for the whole vector; see `Tabulate`.
+    """
+    BuilderForEach(vec, vec_count(vec, count), func(src[Index()]))
+
+def ConnectElements(vec, values, count = None):
+    """
+    Connects each element ``vec[i]`` to ``values[i]``, with one statement for
+    the whole vector.  `values` is either a vector expression or a list of
+    one expression per element.
+    """
+    n = vec_count(vec, count)
+    if isinstance(values, Expr):
+        BuilderForEach(vec, n, values[Index()])
+        return
+    values = list(values)
+    if len(values) != n:
+        raise ValueError("%d values for the %d elements of %s" % \
+                         (len(values), n, vec))
+    BuilderConnectEach(vec, values)
+
 class ModuleBuilder(type):
     """
     Metaclass to creating PyRRHIC `ModuleDec` instances from
@@ -168,13 +348,19 @@ class ModuleBuilder(type):
         Creates this module's `ModuleDec` based on the state of the current
         builder context.
         """
-        self.__context__ = context.cur_context
+        self.__context__ = context.current().cur_context
         self.__context__.className = name
-        print "Set context for "+str(self)+" to "+str(self.__context__.className)
+        # Frame executing the `class` statement
+        self.__source_file__ = sys._getframe(1).f_code.co_filename
+        if trace.enabled and trace.on(trace.CONTEXT, trace.INFO):
+            trace.emit(trace.CONTEXT, trace.INFO, "module_class",
+                       module = name, context = self.__context__.name)
 
 
 class Module(BuilderStmt):
     __metaclass__ = ModuleBuilder
+    # User-defined modules carry a `__dict__` for their own attributes
+    __slots__ = ()
 
     def elaborate(self):
         stmts = []
@@ -197,6 +383,8 @@ class Block(BuilderStmt):
     """
     Represents a list of sub-statements
     """
+    __slots__ = ("stmts",)
+    __bodies__ = ("stmts",)
     def __init__(self, stmts):
         self.stmts = stmts
 
@@ -222,6 +410,9 @@ class BuilderWhen(BuilderStmt):
     """
     Conditional assignment as represented in the context.
     """
+    __slots__ = ("cond", "if_body", "else_body")
+    __exprs__ = ("cond",)
+    __bodies__ = ("if_body", "else_body")
     def __init__(self, cond, if_body, else_body):
         """
         Parameters
@@ -237,7 +428,9 @@ class BuilderWhen(BuilderStmt):
     def elaborate(self):
         ib = self.if_body.elaborate()
         eb = self.else_body.elaborate()
-        return WhenStmt(self.cond, ib, eb)
+        res = WhenStmt(self.cond, ib, eb)
+        res.lineInfo = self.lineInfo
+        return res
 
     def traverse_exprs(self, func):
         self.cond = self.cond.__traverse__(func)
@@ -249,6 +442,7 @@ class BuilderInst(BuilderDec):
     """
     Module instance declaration statement.
     """
+    __slots__ = ("module",)
 
     def __init__(self, idt, module):
         self.idt = idt
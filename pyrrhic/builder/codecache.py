@@ -0,0 +1,122 @@
+"""
+Persistent On-Disk Cache of Instrumented Code Objects.
+
+Compiling a PyRRHIC source means parsing it, walking the AST with
+`astgen.ModuleWalker`, and compiling the result.  None of that depends on
+anything but the source text, the path it was read from and the versions of
+PyRRHIC and of its instrumentation, so the marshaled code object is stored
+on disk under a hash of those and reused on the next run.
+"""
+import hashlib, imp, marshal, os, tempfile
+
+# Name of the environment variable overriding the default cache directory.
+CacheDirEnv = "PYRRHIC_CACHE_DIR"
+
+def default_cache_dir():
+    """
+    Returns the directory used for cached code objects when none is given
+    explicitly: ``$PYRRHIC_CACHE_DIR`` if set, else ``~/.cache/pyrrhic``.
+    """
+    path = os.environ.get(CacheDirEnv)
+    if path:
+        return path
+    return os.path.join(os.path.expanduser("~"), ".cache", "pyrrhic")
+
+class CodeCache(object):
+    """
+    Maps (source path, source text, PyRRHIC version) to a marshaled,
+    already-instrumented code object stored in `path`.
+    """
+    suffix = ".pyrc"
+
+    def __init__(self, path = None, in_memory = False):
+        """
+        Parameters
+        ----------
+        path (str): Cache directory, created on first store.  Defaults to
+                    `default_cache_dir()`.
+        in_memory (bool): Also keep every code object loaded or stored in a
+                          dict, for long-running processes compiling the
+                          same sources over and over.
+        """
+        if path == None:
+            path = default_cache_dir()
+        self.path = path
+        self.memory = None
+        if in_memory:
+            self.memory = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, src):
+        """
+        Returns the hex digest under which the code compiled from `src`
+        (read from `path`) is stored.
+        """
+        from pyrrhic import __version__
+        from pyrrhic.builder.astgen import InstrumentationVersion
+        h = hashlib.sha1()
+        h.update(imp.get_magic())
+        h.update(__version__ + "\0" + str(InstrumentationVersion) + "\0")
+        h.update(os.path.abspath(path) + "\0")
+        h.update(src)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def load(self, path, src):
+        """
+        Returns the cached code object for `src`, or `None` if there is no
+        usable entry.
+        """
+        key = self.key(path, src)
+        if self.memory != None and key in self.memory:
+            self.hits += 1
+            return self.memory[key]
+        try:
+            f = open(self.entry_path(key), "rb")
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            try:
+                code = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                # Truncated or foreign entry; treat it as a miss and let the
+                # next `store` overwrite it.
+                self.misses += 1
+                return None
+        finally:
+            f.close()
+        self.hits += 1
+        if self.memory != None:
+            self.memory[key] = code
+        return code
+
+    def store(self, path, src, code):
+        """
+        Writes `code` to the cache.  The entry is written to a temporary file
+        and renamed into place so concurrent runs never see partial entries.
+        """
+        key = self.key(path, src)
+        if self.memory != None:
+            self.memory[key] = code
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        (fd, tmp) = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                marshal.dump(code, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.entry_path(key))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
@@ -1,75 +1,118 @@
-import inspect
+import inspect, hashlib, itertools, threading
+from collections import OrderedDict
 from pyrrhic.pyrast import Id
+from pyrrhic import trace
 
 BaseContextName = "__BASE_CONTEXT__"
 NewContextName = "__NEW_CONTEXT__"
 
 
+class SymbolTable(object):
+    """
+    Assigns unique names to the ids declared in a module context as they are
+    created.  The first id declared with a given name gets that name, later
+    ones get ``_t_<name>_<N>``, and unnamed temporaries get
+    ``_<context>_tmp_<N>``.
+    """
+    def __init__(self, name):
+        """
+        Parameters
+        ----------
+        name (str): Name of the context owning the table, used in the names
+                    of temporaries
+        """
+        self.name = name
+        # Names given out so far
+        self.taken = set()
+        # Next counter to try for each base name
+        self.counters = {}
+
+    def copy(self, name):
+        """
+        Returns a table with the names taken in this one, for the context
+        named `name`.
+        """
+        res = SymbolTable(name)
+        res.taken = set(self.taken)
+        res.counters = dict(self.counters)
+        return res
+
+    def fresh(self, name):
+        """
+        Returns a name not yet in this table for an id named `name`, or for
+        a temporary if `name` is `None`, and records it as taken.
+        """
+        if name == None:
+            base = "_" + self.name + "_tmp_"
+        elif name not in self.taken:
+            self.taken.add(name)
+            return name
+        else:
+            base = "_t_" + name + "_"
+        cnt = self.counters.get(base, 0)
+        while base + str(cnt) in self.taken:
+            cnt += 1
+        self.counters[base] = cnt + 1
+        res = base + str(cnt)
+        self.taken.add(res)
+        return res
+
 class BuilderContext(object):
     """
     Encapsulates all state pertaining an elaboration.
     """
-    def __init__(self, name = NewContextName):
+    def __init__(self, name = NewContextName, symbols = None):
+        """
+        Parameters
+        ----------
+        name (str): name of this context
+        symbols (SymbolTable): table naming the ids declared in this context,
+                               shared with the enclosing module's context for
+                               the bodies of `When()` blocks.  A new one is
+                               made by default.
+        """
         self.updates = []
         self.instanceCount = 0
         self.name = name
+        if symbols == None:
+            symbols = SymbolTable(name)
+        self.symbols = symbols
+        self.renamed = False
+
+    def own_updates(self):
+        """
+        Returns the updates logged to this context that it alone may modify.
+        """
+        return self.updates
 
     def renameIds(self):
         """
-        Replaces all `BuilderId` instances in this context with unique
-        PyRRHIC `Id`s.
+        Replaces all `BuilderId` instances in this context with the unique
+        PyRRHIC `Id`s they were given when created.  Only done once per
+        context.
         """
-        rmap = self.renameMap()
+        if self.renamed:
+            return
+        self.renamed = True
         from pyrrhic.builder import bdast
+        from pyrrhic.pyrast import rewrite_stmts
         def replace(expr):
             if isinstance(expr, bdast.BuilderId):
-                print "Renaming expression "+str(expr)
-                return rmap[expr]
+                return expr.__final__
             else:
                 return expr
-        for u in self.updates:
-            print "Renaming update "+str(u)
-            u.traverse_exprs(replace)
-
-    def renameMap(self):
-        """
-        Builds a renaming of all `BuilderId` instances in this context
-        to unique PyRRHIC `Id`s
-        """
-        names = self.collectIds()
-        renameMap = {}
-        for name in names:
-            # Give the first entry the "real" name and make temporary ids
-            # for all the other instances
-            idt = names[name][0]
-            renameMap[idt] = Id(name)
-            if len(names[name]) > 1:
-                cnt = 0
-                for idt in names[name][1:]:
-                    renameMap[idt] = Id("_t_"+name+"_"+str(cnt))
-                    cnt += 1
-        return renameMap
-
-    def collectIds(self):
-        """
-        Makes a dictionary containing every string ised in a `BuilderId` in
-        this context.  Each value contains all `BuilderId`s using that name.
-        """
-        names = {}
-        from pyrrhic.builder import bdast
-        for u in self.updates:
-            if isinstance(u, bdast.BuilderDec):
-                print "\tCollected "+str(u.idt)
-                if u.idt.__name__.__idt__ in names:
-                    names[u.idt.__name__.__idt__] += [u.idt]
-                else:
-                    names[u.idt.__name__.__idt__] = [u.idt]
-        return names
+        updates = self.own_updates()
+        if trace.enabled and trace.on(trace.RENAME, trace.DEBUG):
+            for u in updates:
+                trace.emit(trace.RENAME, trace.DEBUG, "rename_update",
+                           stmt = repr(u), context = self.name)
+        rewrite_stmts(updates, post = replace)
 
     def make_builder_id(self, name):
         """
         Returns a new `bdast.BuilderId` with name `name`, or creates
-        a new temporary name if `name` is `None`.
+        a new temporary name if `name` is `None`.  Its unique final name is
+        assigned right away from this context's `SymbolTable`.
 
         name (str): String name from which to create an identifier
         """
@@ -79,35 +122,205 @@ class BuilderContext(object):
             id = BuilderId(Id(name_str))
         else:
             id = BuilderId(Id(name))
+        id.__final__ = Id(self.symbols.fresh(name))
+        if trace.enabled and trace.on(trace.RENAME, trace.DEBUG):
+            trace.emit(trace.RENAME, trace.DEBUG, "rename_id",
+                       id = str(id), to = str(id.__final__),
+                       context = self.name)
         return id
 
-# Always contains the context in which to log the next update
-cur_context = BuilderContext(BaseContextName)
-context_stack = []
+class ElaborationSession(object):
+    """
+    Holds all builder state for the elaboration of one design.
+
+    Instrumented code and the builder always work on the current session of
+    the calling thread (see `current`), so independent designs can be
+    elaborated one after the other in a warm process, or concurrently on
+    different threads, each in a session of its own:
+
+        with ElaborationSession() as session:
+            exec code in env
+            builder.elaborate_all_instances()
+            mdecs = session.elaborated_instances.values()
+
+    Source locations are captured per session (`capture_locations`), but
+    hash-consing (`expr.enable_hash_consing`) and tracing (`trace.configure`)
+    are process-wide: sessions elaborated concurrently must agree on them.
+    """
+    def __init__(self):
+        # Always contains the context in which to log the next update
+        self.cur_context = BuilderContext(BaseContextName)
+        self.context_stack = []
+
+        # Tracks which `BuilderContext` corresponds to each module type based
+        # on the string of each type's name.
+        self.all_class_contexts = {}
+        self.all_class_contexts[BaseContextName] = BuilderContext(BaseContextName)
+
+        # Tracks which `BuilderInstanceContext` corresponds to each module
+        # instance based on each instance's reference (that is,
+        # ``all_instance_contexts[m]`` contains module `m`'s context.)  Kept
+        # in instantiation order so that instance names come out the same on
+        # every run.
+        self.all_instance_contexts = OrderedDict()
+
+        # When an instance is elaborated, it gets added to this dict and
+        # removed from `all_instance_contexts`.
+        self.elaborated_instances = OrderedDict()
+
+        # When an instance is elaborated, its desired name is added to this
+        # dictionary.  If a name is already present, the instance is renamed
+        # to have a name that ends with `_N` where `N` is the current number
+        # of modules with that name.
+        self.instance_names = {}
+
+        # Contains the nearest-enclosing conditional expression, with the
+        # `LineInfo` of the `When()` it came from (if source locations are
+        # captured)
+        self.cond_stack = []
+
+        # `modcache.ModuleCache` of elaborated modules, or `None` to always
+        # run module constructors
+        self.module_cache = None
+
+        # Whether builder statements record the `LineInfo` of the PyRRHIC
+        # source line they came from
+        self.capture_locations = False
+
+    def __enter__(self):
+        _local.stack.append(current())
+        _local.session = self
+        return self
+
+    def __exit__(self, *exc):
+        _local.session = _local.stack.pop()
+        return False
 
+class _SessionLocal(threading.local):
+    """
+    Per-thread current session, and the sessions it replaced.
+    """
+    def __init__(self):
+        self.session = None
+        self.stack = []
+
+_local = _SessionLocal()
+
+def current():
+    """
+    Returns the current `ElaborationSession` of the calling thread, starting
+    a new one the first time the thread asks for one.
+    """
+    session = _local.session
+    if session == None:
+        session = _local.session = ElaborationSession()
+    return session
+
+def structural_value(value):
+    """
+    Returns a hashable value equal for structurally equal module parameters,
+    or raises `TypeError` if `value` has no such representation (e.g. it is
+    an `Expr` or a module instance).
+    """
+    from pyrrhic.builder.bdast import BuilderType
+    from pyrrhic.pyrast import Type
+    if value == None or isinstance(value, (bool, int, long, float, str, unicode)):
+        return (type(value).__name__, value)
+    if isinstance(value, (tuple, list)):
+        return (type(value).__name__,
+                tuple([structural_value(v) for v in value]))
+    if isinstance(value, dict):
+        items = [(k, structural_value(value[k])) for k in sorted(value)]
+        return ("dict", tuple(items))
+    if isinstance(value, Type):
+        return ("type", str(value))
+    if isinstance(value, BuilderType):
+        return (type(value), structural_value(vars(value)))
+    raise TypeError("no structural value for " + type(value).__name__)
+
+def hash_expr(h, e):
+    """
+    Adds the structure of the expression `e` to the digest `h`.  Literals
+    are hashed with their widths and signedness, which their printed form
+    leaves out, and builder ids by their names within their context.
+    """
+    from pyrrhic.builder.bdast import BuilderId
+    from pyrrhic.pyrast import Expr
+    stack = [(False, e)]
+    while stack:
+        (text, e) = stack.pop()
+        if text:
+            h.update(e)
+        elif isinstance(e, BuilderId):
+            h.update(" " + str(e))
+        elif isinstance(e, Expr):
+            h.update(" " + type(e).__name__ + "(")
+            stack.append((True, ")"))
+            stack += [(False, getattr(e, f)) for f in reversed(e.__fields__)]
+        elif isinstance(e, (list, tuple)):
+            h.update(" [")
+            stack.append((True, "]"))
+            stack += [(False, v) for v in reversed(e)]
+        else:
+            h.update(" " + repr((type(e).__name__, e)))
+
+class UpdateLog(object):
+    """
+    Update log of a module instance, sharing the updates logged to its class
+    context (which all instances of the class have in common) instead of
+    copying them.
+
+    Iterates like a list of the class updates followed by the instance's own.
+    New updates are only ever appended to the instance's own, so the class
+    updates are never modified through the log.
+    """
+    __slots__ = ("base", "size", "local")
+
+    def __init__(self, base):
+        """
+        Parameters
+        ----------
+        base ([BuilderStmt]): Updates of the class context.  Only the ones
+                              logged so far are part of this log.
+        """
+        self.base = base
+        self.size = len(base)
+        # Updates logged to the instance itself
+        self.local = []
 
-# Tracks which `BuilderContext` corresponds to each module type based on the
-# string of each type's name.
-all_class_contexts = {}
-all_class_contexts[BaseContextName] = BuilderContext(BaseContextName)
+    def __len__(self):
+        return self.size + len(self.local)
 
+    def __iter__(self):
+        for u in itertools.islice(self.base, self.size):
+            yield u
+        for u in self.local:
+            yield u
 
-# Tracks which `BuilderInstanceContext` corresponds to each module instance
-# based on each instance's reference (that is, ``all_instance_contexts[m]``
-# contains module `m`'s context.)
-all_instance_contexts = {}
+    def __reversed__(self):
+        return reversed(list(self))
 
-# When an instance is elaborated, it gets added to this dict and removed
-# from `all_instance_contexts`.
-elaborated_instances = {}
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("update log index out of range")
+        if i < self.size:
+            return self.base[i]
+        return self.local[i - self.size]
 
-# When an instance is elaborated, its desired name is added to this dictionary.
-# If a name is already present, the instance is renamed to ahve a name that
-# ends with `_N` where `N` is the current number of modules with that name.
-instance_names = {}
+    def append(self, update):
+        self.local.append(update)
 
-# Contains the nearest-enclosing conditional expression
-cond_stack = []
+    def __iadd__(self, updates):
+        self.local.extend(updates)
+        return self
+
+    def owned(self):
+        """
+        Returns the updates private to this instance.
+        """
+        return self.local
 
 class BuilderInstanceContext(BuilderContext):
     """
@@ -128,14 +341,97 @@ class BuilderInstanceContext(BuilderContext):
         self.class_context = class_context
         self.instanceCount = class_context.instanceCount
         self.name = class_context.name + "_INSTANCE"
-        self.updates = [] + class_context.updates
+        self.updates = UpdateLog(class_context.updates)
+        self.symbols = class_context.symbols.copy(self.name)
+        self.renamed = False
+        # Source file instantiating this module, if it was wrapped in
+        # `Module()`
+        self.site = None
+        # Constructor arguments, by name, recorded by `module_inst_begin`
+        self.params = None
+        # Context of an identical instance whose definition this one shares
+        self.definition = None
+        # Key of this instance in the session's `modcache.ModuleCache`, if
+        # it can be cached, and the `ModuleDec` and dependencies found there
+        self.cache_key = None
+        self.cached = None
+        self.cached_files = None
+
+    def own_updates(self):
+        return self.updates.owned()
+
+    def renameIds(self):
+        """
+        Renames the ids of this instance's own updates.  Updates shared with
+        the class context are renamed (once) by the class context, since
+        their ids have the same names in every instance.
+        """
+        self.class_context.renameIds()
+        BuilderContext.renameIds(self)
+
+    def structural_key(self):
+        """
+        Returns a key equal for instances of the same class constructed with
+        structurally equal parameters, or `None` if the parameters can't be
+        compared.
+        """
+        if self.params == None:
+            return None
+        try:
+            return (self.className, structural_value(self.params))
+        except TypeError:
+            return None
+
+    def body_digest(self):
+        """
+        Returns a digest of this instance's update log, used to verify that
+        two instances with equal `structural_key`s really have the same body.
+        Contained instances are identified by their definitions' names, so
+        instances must be renamed (or shared) before their parents.
+        """
+        from pyrrhic.builder import bdast
+        h = hashlib.sha1()
+        stack = list(reversed(self.updates))
+        while stack:
+            u = stack.pop()
+            if isinstance(u, bdast.Block):
+                h.update("{")
+                stack.append("}")
+                stack += reversed(u.stmts)
+            elif isinstance(u, bdast.BuilderWhen):
+                h.update("when")
+                hash_expr(h, u.cond)
+                stack += [u.else_body, "else", u.if_body]
+            elif isinstance(u, bdast.BuilderInst):
+                h.update("inst " + str(u.idt) + " " + u.module.__context__.name)
+            elif isinstance(u, bdast.Wire) or isinstance(u, bdast.Reg):
+                h.update(type(u).__name__ + " " + str(u.idt) + " " + \
+                         repr(structural_value(u.btype)))
+                if isinstance(u, bdast.Reg) and u.onReset != None:
+                    hash_expr(h, u.onReset)
+            elif isinstance(u, str):
+                h.update(u)
+            elif isinstance(u, (bdast.Connect, bdast.BuilderForEach,
+                                bdast.BuilderConnectEach)):
+                h.update(type(u).__name__)
+                for f in u.__exprs__:
+                    hash_expr(h, getattr(u, f))
+                if isinstance(u, bdast.BuilderForEach):
+                    h.update(" " + str(u.count))
+            else:
+                h.update(type(u).__name__ + " " + repr(u))
+            h.update("\n")
+        return h.digest()
 
-    def rename(self):
+    def rename(self, session = None):
         """
         Sets the name of this instance context to one that does not yet
-        appear in the global `instance_names` dictionary.
+        appear in the `instance_names` dictionary of `session` (by default
+        the current one).
         """
-        print "Module = "+str(self.module)
+        if session == None:
+            session = current()
+        instance_names = session.instance_names
         desired_name = self.module.derived_name()
         if desired_name in instance_names:
             count = len(instance_names[desired_name])
@@ -144,4 +440,7 @@ class BuilderInstanceContext(BuilderContext):
         else:
             self.name = desired_name
             instance_names[desired_name] = [self]
+        if trace.enabled and trace.on(trace.RENAME, trace.INFO):
+            trace.emit(trace.RENAME, trace.INFO, "instance_name",
+                       desired = desired_name, name = self.name)
         return self.name
@@ -0,0 +1,179 @@
+"""
+Import Hook for PyRRHIC Sources.
+
+Installs a PEP 302 finder/loader on `sys.meta_path` so that PyRRHIC sources
+living under a set of root directories can be imported like ordinary Python
+modules.  Each source is instrumented with `astgen.compile_pyrrhic`, going
+through a `codecache.CodeCache` so that unchanged files skip parsing,
+transformation and compilation on warm runs.
+
+Import statements executed by PyRRHIC code go through `record_import`,
+which remembers which PyRRHIC modules each source file imported, so that
+`file_dependencies` can tell every file a design was built from.
+"""
+import __builtin__, imp, os, sys
+from pyrrhic.builder import astgen
+from pyrrhic.builder.codecache import CodeCache
+
+# Maps each source file to the files of the PyRRHIC modules its import
+# statements named.  Like `sys.modules`, this is shared by the whole process.
+imports = {}
+
+def imported_names(name, globals, fromlist, level):
+    """
+    Returns the full names of the modules an import statement of `name`
+    (with the arguments of ``__import__``) may have loaded: the module, its
+    parent packages and the submodules in `fromlist`, both absolute and
+    relative to the importing package.
+    """
+    bases = []
+    if level != 0 and globals:
+        package = globals.get("__package__")
+        if package == None:
+            package = globals.get("__name__", "")
+            if "__path__" not in globals:
+                package = package.rpartition(".")[0]
+        if level > 1:
+            package = ".".join(package.split(".")[:1 - level])
+        if package:
+            bases.append(package + "." + name if name else package)
+    if level <= 0:
+        bases.append(name)
+    res = []
+    for base in bases:
+        parts = base.split(".")
+        for i in range(1, len(parts) + 1):
+            res.append(".".join(parts[:i]))
+        for item in fromlist or ():
+            res.append(base + "." + item)
+    return res
+
+def record_import(name, globals = None, locals = None, fromlist = None,
+                  level = -1):
+    """
+    ``__import__`` of PyRRHIC code: imports `name` as usual, and records
+    in `imports` the PyRRHIC modules the statement named, whether they were
+    loaded now or earlier.
+    """
+    mod = __builtin__.__import__(name, globals, locals, fromlist, level)
+    importing = sys._getframe(1).f_code.co_filename
+    for n in imported_names(name, globals, fromlist, level):
+        m = sys.modules.get(n)
+        if m != None and isinstance(getattr(m, "__loader__", None),
+                                    PyrrhicImporter):
+            imports.setdefault(importing, set()).add(m.__file__)
+    return mod
+
+def builtins():
+    """
+    Returns the builtins to execute PyRRHIC code with, as the
+    ``__builtins__`` of its globals.
+    """
+    res = dict(vars(__builtin__))
+    res["__import__"] = record_import
+    return res
+
+def file_dependencies(paths):
+    """
+    Returns the set of `paths` and of the files of every PyRRHIC module
+    they import, directly or through other modules.
+    """
+    res = set()
+    stack = list(paths)
+    while stack:
+        p = stack.pop()
+        if p not in res:
+            res.add(p)
+            stack.extend(imports.get(p, ()))
+    return res
+
+class PyrrhicImporter(object):
+    """
+    Finds and loads PyRRHIC modules and packages found under `roots`.
+    """
+    def __init__(self, roots, cache = None):
+        """
+        Parameters
+        ----------
+        roots ([str]): Directories searched for top-level PyRRHIC modules
+        cache (CodeCache): Cache of instrumented code objects, or `None` to
+                           always recompile.
+        """
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.cache = cache
+        # Maps module names found by `find_module` to (path, is_package)
+        self.found = {}
+
+    def find_module(self, fullname, path = None):
+        # The compiler itself is never instrumented, even if one of the roots
+        # happens to be the directory containing it.
+        if fullname == "pyrrhic" or fullname.startswith("pyrrhic."):
+            return None
+        if path == None:
+            dirs = self.roots
+        else:
+            # Submodules are only ours if their parent package was loaded
+            # by this importer.
+            parent = sys.modules.get(fullname.rpartition(".")[0])
+            if getattr(parent, "__loader__", None) is not self:
+                return None
+            dirs = path
+        name = fullname.rpartition(".")[2]
+        for d in dirs:
+            pkg_init = os.path.join(d, name, "__init__.py")
+            if os.path.isfile(pkg_init):
+                self.found[fullname] = (pkg_init, True)
+                return self
+            src = os.path.join(d, name + ".py")
+            if os.path.isfile(src):
+                self.found[fullname] = (src, False)
+                return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        (path, is_package) = self.found.pop(fullname)
+        code = astgen.compile_pyrrhic(path, self.cache)
+
+        mod = imp.new_module(fullname)
+        mod.__file__ = path
+        mod.__loader__ = self
+        if is_package:
+            mod.__path__ = [os.path.dirname(path)]
+            mod.__package__ = fullname
+        else:
+            mod.__package__ = fullname.rpartition(".")[0]
+        # Instrumented code calls into `builder.instrument`
+        from pyrrhic import builder
+        mod.__dict__["builder"] = builder
+        mod.__dict__["__builtins__"] = builtins()
+
+        sys.modules[fullname] = mod
+        try:
+            exec code in mod.__dict__
+        except:
+            del sys.modules[fullname]
+            raise
+        return mod
+
+def install(roots, cache_dir = None, use_cache = True, cache = None):
+    """
+    Creates a `PyrrhicImporter` for `roots` and puts it at the front of
+    `sys.meta_path`.  Returns the importer so it can be passed to
+    `uninstall`.  An existing `CodeCache` may be given as `cache`.
+    """
+    if use_cache and cache == None:
+        cache = CodeCache(cache_dir)
+    elif not use_cache:
+        cache = None
+    importer = PyrrhicImporter(roots, cache)
+    sys.meta_path.insert(0, importer)
+    return importer
+
+def uninstall(importer):
+    """
+    Removes an importer previously returned by `install`.
+    """
+    if importer in sys.meta_path:
+        sys.meta_path.remove(importer)
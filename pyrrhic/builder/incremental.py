@@ -0,0 +1,222 @@
+"""
+Incremental Re-elaboration.
+
+Records, for every elaborated module instance, which source files, module
+classes and `BundleDec` types its `ModuleDec` was derived from (directly or
+through the instances it contains), including the files of every PyRRHIC
+module those files import (see `importer.file_dependencies`), and persists
+that graph together with the elaborated IR.  On the next run, instances
+whose transitive inputs are unchanged reuse the stored `ModuleDec` rather
+than being elaborated again.
+"""
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib, os, tempfile
+from pyrrhic.builder.bdast import *
+
+def bundle_classes(btype, classes):
+    """
+    Adds to the set `classes` every `BundleDec` type reachable from the
+    builder type `btype`, including the types of its (possibly reversed)
+    fields.
+    """
+    stack = [btype]
+    seen = set()
+    while stack:
+        t = stack.pop()
+        if id(t) in seen:
+            continue
+        seen.add(id(t))
+        if isinstance(t, Reverse):
+            stack.append(t.type)
+        elif isinstance(t, BundleDec):
+            cls = type(t)
+            if cls not in classes:
+                classes.add(cls)
+                for c in cls.__mro__:
+                    for v in vars(c).values():
+                        if isinstance(v, BuilderType):
+                            stack.append(v)
+            for v in vars(t).values():
+                if isinstance(v, BuilderType):
+                    stack.append(v)
+
+def collect_direct_deps(updates, classes, children):
+    """
+    Walks a list of builder updates (including the bodies of `BuilderWhen`
+    statements), adding the `BundleDec` types declared to `classes` and the
+    contexts of instantiated modules to `children`.
+    """
+    stack = list(reversed(updates))
+    while stack:
+        u = stack.pop()
+        if isinstance(u, BuilderInst):
+            children.append(u.module.__context__)
+        elif isinstance(u, Wire) or isinstance(u, Reg):
+            bundle_classes(u.btype, classes)
+        elif isinstance(u, BuilderWhen):
+            stack += reversed(u.else_body.stmts)
+            stack += reversed(u.if_body.stmts)
+        elif isinstance(u, Block):
+            stack += reversed(u.stmts)
+
+class DependencyGraph(object):
+    """
+    Persistent map from instance names to the inputs and elaborated IR of
+    the corresponding modules, stored with `pickle` at `path`.
+    """
+    format_version = 6
+
+    def __init__(self, path):
+        self.path = path
+        # Records from the previous run, keyed by instance name
+        self.previous = {}
+        # Records for this run, in elaboration order
+        self.modules = OrderedDict()
+        self.file_hashes = {}
+        self.fingerprints = {}
+        self.reused = 0
+        self.elaborated = 0
+        self.load()
+
+    def version_tag(self):
+        from pyrrhic import __version__
+        return (self.format_version, __version__)
+
+    def load(self):
+        """
+        Reads the records of the previous run.  A missing, unreadable or
+        outdated state file just means everything is elaborated again.
+        """
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                state = pickle.load(f)
+            except Exception:
+                return
+        finally:
+            f.close()
+        if state.get("version") == self.version_tag():
+            self.previous = state["modules"]
+
+    def save(self):
+        """
+        Writes this run's records to `path`, replacing the previous state.
+        """
+        state = {"version": self.version_tag(), "modules": self.modules}
+        d = os.path.dirname(os.path.abspath(self.path))
+        (fd, tmp) = tempfile.mkstemp(dir = d, suffix = ".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def file_hash(self, path):
+        """
+        Returns a digest of the contents of `path`, or `None` if it can't
+        be read.  Each file is hashed at most once per run.
+        """
+        if path not in self.file_hashes:
+            try:
+                f = open(path, "rb")
+                try:
+                    self.file_hashes[path] = hashlib.sha1(f.read()).hexdigest()
+                finally:
+                    f.close()
+            except IOError:
+                self.file_hashes[path] = None
+        return self.file_hashes[path]
+
+    def dependencies(self, ic):
+        """
+        Returns ``(files, classes, children)`` for the instance context `ic`:
+        the source files it was built from (those of its module and bundle
+        classes, of its instantiation site and of every module they import)
+        and the names of those classes, and the contexts of the instances it
+        contains.
+        """
+        from pyrrhic.builder.importer import file_dependencies
+        module_class = type(ic.module)
+        files = set([module_class.__source_file__])
+        if ic.site != None:
+            files.add(ic.site)
+        bundles = set()
+        children = []
+        collect_direct_deps(ic.updates, bundles, children)
+        if ic.cached_files != None:
+            # The constructor didn't run; see `modcache.ModuleCache`
+            files.update(ic.cached_files)
+        classes = set([module_class.__name__])
+        for b in bundles:
+            classes.add(b.__name__)
+            files.add(b.__source_file__)
+        return (file_dependencies(files), classes, children)
+
+    def fingerprint(self, ic):
+        """
+        Returns a digest of everything the `ModuleDec` of `ic` depends on:
+        its name, the files and classes it was built from, and the names and
+        fingerprints of the instances it contains.
+        """
+        key = id(ic)
+        if key in self.fingerprints:
+            return self.fingerprints[key][0]
+        (files, classes, children) = self.dependencies(ic)
+        h = hashlib.sha1()
+        h.update(repr(self.version_tag()))
+        h.update("\0" + ic.name)
+        for f in sorted(files):
+            h.update("\0" + f + "\0" + str(self.file_hash(f)))
+        for c in sorted(classes):
+            h.update("\0" + c)
+        for child in children:
+            h.update("\0" + child.name + "\0" + self.fingerprint(child))
+        fp = h.hexdigest()
+        self.fingerprints[key] = (fp, files, classes, children)
+        return fp
+
+    def lookup(self, ic):
+        """
+        Returns the stored `ModuleDec` for `ic` if its inputs haven't changed
+        since it was stored, and `None` otherwise.
+        """
+        fp = self.fingerprint(ic)
+        rec = self.previous.get(ic.name)
+        if rec == None or rec["fingerprint"] != fp:
+            return None
+        self.modules[ic.name] = rec
+        self.reused += 1
+        return rec["ir"]
+
+    def store(self, ic, mdec):
+        """
+        Records the freshly elaborated `mdec` for `ic`.
+        """
+        fp = self.fingerprint(ic)
+        (_, files, classes, children) = self.fingerprints[id(ic)]
+        self.modules[ic.name] = {
+            "fingerprint": fp,
+            "files": sorted(files),
+            "classes": sorted(classes),
+            "children": [c.name for c in children],
+            "ir": mdec }
+        self.elaborated += 1
+
+    def files(self):
+        """
+        Returns the set of source files any module of this run depends on.
+        """
+        res = set()
+        for rec in self.modules.values():
+            res.update(rec["files"])
+        return res
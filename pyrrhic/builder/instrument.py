@@ -5,9 +5,11 @@ Contains functions to be injected by the builder into Python ASTs prior to
 elaboration.  These update the current context with information about
 the names of modules, wires, etc.
 """
+from pyrrhic import trace
 from pyrrhic.pyrast.expr import Id
 from pyrrhic.builder import context as ctx
 from pyrrhic.builder.bdast import *
+import sys
 
 def module_begin(name):
     """
@@ -15,10 +17,11 @@ def module_begin(name):
     function registers its caller with the Builder system, and creates
     a new ctx.
     """
+    session = ctx.current()
     nc = ctx.BuilderContext(name)
-    ctx.context_stack.append(ctx.cur_context)
-    ctx.cur_context = nc
-    ctx.all_class_contexts[name] = nc
+    session.context_stack.append(session.cur_context)
+    session.cur_context = nc
+    session.all_class_contexts[name] = nc
 
 def module_end(name):
     """
@@ -26,20 +29,35 @@ def module_end(name):
     resets the current context back to the enclosing one and performs
     any other needed cleanup.
     """
-    ctx.cur_context = ctx.context_stack.pop()
+    session = ctx.current()
+    session.cur_context = session.context_stack.pop()
 
 
-def module_inst_begin(class_name):
+def module_inst_begin(class_name, params=None):
     """
     When called at the beginning of a `Module`'s' ``__init__()`` method,
     this creates a new context for that module and adds it to the instance 
     stack.
 
+    Returns `True` if the module's elaboration was found in the session's
+    `module_cache`, in which case the rest of ``__init__()`` is skipped.
+
     Parameters
     ----------
     class_name (str): The (string) name of the class of module being instantiated
-    """
-    class_context = ctx.all_class_contexts[class_name]
+    params (dict): The arguments passed to ``__init__()``, by name
+    """
+    session = ctx.current()
+    class_context = session.all_class_contexts.get(class_name)
+    if class_context == None and params != None and "self" in params:
+        # The class was defined in another session (e.g. by a module
+        # imported while elaborating an earlier design)
+        for c in type(params["self"]).__mro__:
+            if c.__name__ == class_name and "__context__" in vars(c):
+                class_context = c.__context__
+                break
+    if class_context == None:
+        raise KeyError("no builder context for module class " + class_name)
 
     # `instance_name` is set afterwards by other instrumentation code,
     # and `module` is set by `module_inst_end`
@@ -47,9 +65,25 @@ def module_inst_begin(class_name):
         instance_name = None,             \
         class_context = class_context,    \
         module        = None) 
-
-    ctx.context_stack.append(ctx.cur_context)
-    ctx.cur_context = context
+    if params != None:
+        context.params = dict(params)
+        context.params.pop("self", None)
+
+    session.context_stack.append(session.cur_context)
+    session.cur_context = context
+
+    cache = session.module_cache
+    if cache != None and context.params != None:
+        context.cache_key = cache.key(params["self"], context.params)
+        if context.cache_key != None:
+            found = cache.load(context.cache_key)
+            if found != None:
+                (context.cached, context.cached_files) = found
+                if trace.enabled and trace.on(trace.CONTEXT, trace.INFO):
+                    trace.emit(trace.CONTEXT, trace.INFO, "module_cache_hit",
+                               module = class_name, key = context.cache_key)
+                return True
+    return False
 
 def module_inst_end(module):
     """
@@ -60,10 +94,15 @@ def module_inst_end(module):
     ----------
     module (Module): The module whose ``__init__()`` method was just called.
     """
-    ctx.cur_context.module = module
-    module.__context__ = ctx.cur_context
-    ctx.all_instance_contexts[module] = ctx.cur_context
-    ctx.cur_context = ctx.context_stack.pop()
+    session = ctx.current()
+    session.cur_context.module = module
+    module.__context__ = session.cur_context
+    session.all_instance_contexts[module] = session.cur_context
+    if trace.enabled and trace.on(trace.CONTEXT, trace.INFO):
+        trace.emit(trace.CONTEXT, trace.INFO, "module_instance",
+                   module = session.cur_context.className,
+                   updates = len(session.cur_context.updates))
+    session.cur_context = session.context_stack.pop()
 
 def make_builder_instance(instance, class_name, inst_name=None):
     """
@@ -79,11 +118,13 @@ def make_builder_instance(instance, class_name, inst_name=None):
 
     class_name (str): The string name of the class instantiated
     """
+    session = ctx.current()
     if inst_name == None:
-        id = ctx.cur_context.make_builder_id(class_name)
+        id = session.cur_context.make_builder_id(class_name)
     else:
-        id = ctx.cur_context.make_builder_id(inst_name)
+        id = session.cur_context.make_builder_id(inst_name)
     binst = BuilderInst(id, instance)
+    instance.__context__.site = sys._getframe(1).f_code.co_filename
     return id
 
 def make_builder_dec(btype, is_reg, name=None, on_reset=None):
@@ -91,12 +132,18 @@ def make_builder_dec(btype, is_reg, name=None, on_reset=None):
     Returns a new `BuilderId` referring to `dec` and updates the current context
     to contain a new `Wire` or `Reg`.
     """
-    id = ctx.cur_context.make_builder_id(name)
+    session = ctx.current()
+    id = session.cur_context.make_builder_id(name)
 
     if is_reg:
-      Reg(btype, idt = id, onReset = on_reset)
+      dec = Reg(btype, idt = id, onReset = on_reset)
     else:
-      Wire(btype, idt = id)
+      dec = Wire(btype, idt = id)
+    if session.capture_locations:
+      dec.lineInfo = LineInfo(2)
+    # Lets `SubField`s and `SubItem`s of the id resolve their types
+    if not isinstance(btype, Reverse):
+      id.__type__ = dec.lowered_type()
 
     return id
 
@@ -106,26 +153,33 @@ def when_begin(cond_expr):
     order to associate it with all the statements contained in the if and 
     else clauses.
     """
-    ctx.cond_stack.append(cond_expr)
+    session = ctx.current()
+    loc = None
+    if session.capture_locations:
+      loc = LineInfo(2)
+    session.cond_stack.append((cond_expr, loc))
     # Need to make a new `BuilderContext` so that the updates performed within
     # this `When()` block are distinguished from those outside of it.
-    bc = ctx.BuilderContext("__TEMP_WHEN_CONTEXT__")
-    ctx.context_stack.append(ctx.cur_context)
-    ctx.cur_context = bc
+    bc = ctx.BuilderContext("__TEMP_WHEN_CONTEXT__", session.cur_context.symbols)
+    session.context_stack.append(session.cur_context)
+    session.cur_context = bc
 
 def when_else():
-    bc = ctx.BuilderContext("__TEMP_ELSE_CONTEXT__")
-    ctx.context_stack.append(ctx.cur_context)
-    ctx.cur_context = bc
+    session = ctx.current()
+    bc = ctx.BuilderContext("__TEMP_ELSE_CONTEXT__", session.cur_context.symbols)
+    session.context_stack.append(session.cur_context)
+    session.cur_context = bc
 
 def when_end():
     """
     Pops the current condition stack at the end of a when statment's body
     in order to generate the final update AST node.
     """
-    cond = ctx.cond_stack.pop()
-    else_body = ctx.cur_context
-    if_body = ctx.context_stack.pop()
-    ctx.cur_context = ctx.context_stack.pop()
+    session = ctx.current()
+    (cond, loc) = session.cond_stack.pop()
+    else_body = session.cur_context
+    if_body = session.context_stack.pop()
+    session.cur_context = session.context_stack.pop()
     upd = BuilderWhen(cond, Block(if_body.updates), Block(else_body.updates))
-    ctx.cur_context.updates.append(upd)
+    upd.lineInfo = loc
+    session.cur_context.updates.append(upd)
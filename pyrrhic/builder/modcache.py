@@ -0,0 +1,238 @@
+"""
+Content-Addressed Cache of Elaborated Modules.
+
+A module generator like ``Counter(max_val)`` elaborates to the same
+`ModuleDec` every time it is run on the same source with the same
+constructor arguments.  `ModuleCache` stores the statements of such
+modules on disk under a hash of
+
+    the PyRRHIC version, the module class' name, the contents of the file
+    defining it and of every PyRRHIC module that file imports (directly
+    or not, see `importer.file_dependencies`), and the constructor
+    arguments
+
+together with the hashes of every other file the elaboration depended on
+(base classes and `BundleDec` types defined elsewhere, and the modules
+their files import).  When an entry is found and those files are
+unchanged, the instrumented ``__init__`` returns right after
+`instrument.module_inst_begin`, without running its body.
+
+Only leaf modules are stored: instances whose update log (including the
+updates of their class body) declares no module instances, since the names
+of contained modules are only assigned once the whole design is known.
+Modules whose constructor arguments have no `context.structural_value`, or
+that override `Module.derived_name`, are never cached either.
+
+The cache directory is bounded in size: `trim` removes the least recently
+used entries (hits refresh an entry's modification time) until it fits.
+"""
+import cPickle as pickle
+import hashlib, os, tempfile
+from pyrrhic import trace
+from pyrrhic.builder import context as ctx
+
+# Default size bound of a cache directory
+DefaultMaxBytes = 256 << 20
+
+def default_cache_dir():
+    """
+    Returns the directory used for cached modules when none is given
+    explicitly: the ``modules`` subdirectory of the code cache's.
+    """
+    from pyrrhic.builder.codecache import default_cache_dir
+    return os.path.join(default_cache_dir(), "modules")
+
+class ModuleCache(object):
+    """
+    Maps (module class source, constructor arguments) to the elaborated
+    statements of the module, stored in `path`.
+    """
+    suffix = ".pyrm"
+    format_version = 5
+
+    def __init__(self, path = None, max_bytes = DefaultMaxBytes):
+        """
+        Parameters
+        ----------
+        path (str): Cache directory, created on first store.  Defaults to
+                    `default_cache_dir()`.
+        max_bytes (int): Size the directory is trimmed down to by `trim`
+        """
+        if path == None:
+            path = default_cache_dir()
+        self.path = path
+        self.max_bytes = max_bytes
+        # Digests of the files read during this run, by path
+        self.file_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def file_hash(self, path):
+        """
+        Returns a digest of the contents of `path`, or `None` if it can't
+        be read.  Each file is hashed at most once.
+        """
+        if path not in self.file_hashes:
+            try:
+                f = open(path, "rb")
+                try:
+                    self.file_hashes[path] = hashlib.sha1(f.read()).hexdigest()
+                finally:
+                    f.close()
+            except IOError:
+                self.file_hashes[path] = None
+        return self.file_hashes[path]
+
+    def key(self, module, params):
+        """
+        Returns the hex digest under which the elaboration of `module`, an
+        instance of a module class constructed with the arguments `params`
+        (by name), is stored, or `None` if it can't be cached.
+        """
+        from pyrrhic import __version__
+        from pyrrhic.builder.bdast import Module
+        from pyrrhic.builder.importer import file_dependencies
+        cls = type(module)
+        if cls.derived_name.im_func is not Module.derived_name.im_func:
+            return None
+        src_hashes = []
+        for f in sorted(file_dependencies([cls.__source_file__])):
+            digest = self.file_hash(f)
+            if digest == None:
+                return None
+            src_hashes.append(f + "\0" + digest)
+        try:
+            args = repr(ctx.structural_value(params))
+        except TypeError:
+            return None
+        h = hashlib.sha1()
+        h.update(repr((self.format_version, __version__)))
+        h.update("\0" + cls.__name__ + "\0" + "\0".join(src_hashes))
+        h.update("\0" + args)
+        h.update("\0" + str(ctx.current().capture_locations))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def load(self, key):
+        """
+        Returns ``(mdec, files)``, the `ModuleDec` stored under `key` and the
+        files it depended on, if all of those are unchanged, and `None`
+        otherwise.
+        """
+        path = self.entry_path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            try:
+                entry = pickle.load(f)
+            except Exception:
+                self.misses += 1
+                return None
+        finally:
+            f.close()
+        for (dep, digest) in entry["files"]:
+            if self.file_hash(dep) != digest:
+                self.misses += 1
+                return None
+        self.hits += 1
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return (entry["ir"], [dep for (dep, _) in entry["files"]])
+
+    def dependencies(self, ic):
+        """
+        Returns the sorted source files the elaboration of the instance
+        context `ic` depended on, with those of the modules they import, or
+        `None` if it contains module instances and can't be cached.
+        """
+        from pyrrhic.builder.bdast import Module
+        from pyrrhic.builder.importer import file_dependencies
+        from pyrrhic.builder.incremental import collect_direct_deps
+        bundles = set()
+        children = []
+        collect_direct_deps(ic.updates, bundles, children)
+        if children:
+            return None
+        files = set()
+        for c in type(ic.module).__mro__:
+            if issubclass(c, Module) and "__source_file__" in vars(c):
+                files.add(c.__source_file__)
+        for b in bundles:
+            files.add(b.__source_file__)
+        return sorted(file_dependencies(files))
+
+    def store(self, ic, mdec):
+        """
+        Stores `mdec`, elaborated from the instance context `ic`, under
+        ``ic.cache_key`` if it can be cached.  The entry is written to a
+        temporary file and renamed into place so concurrent runs never see
+        partial entries.
+        """
+        if ic.cache_key == None:
+            return
+        files = self.dependencies(ic)
+        if files == None:
+            return
+        entry = { "files": [(f, self.file_hash(f)) for f in files],
+                  "ir": mdec }
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        (fd, tmp) = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.entry_path(ic.cache_key))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.stored += 1
+
+    def trim(self):
+        """
+        Removes the least recently used entries until the cache directory
+        holds at most `max_bytes`.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        total = 0
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if trace.enabled and trace.on(trace.CONTEXT, trace.DEBUG):
+                trace.emit(trace.CONTEXT, trace.DEBUG, "module_cache_evict",
+                           entry = path, size = size)
@@ -0,0 +1,11 @@
+"""
+Passes over Elaborated PyRRHIC IR.
+
+Each pass works on the `ModuleDec`s produced by
+`builder.elaborate_all_instances`, in elaboration order, updating them in
+place.
+"""
+from widths import infer_widths
+from whens import expand_whens
+from dead import remove_dead_code
+from constfold import fold_constants
@@ -0,0 +1,375 @@
+"""
+Constant Folding and Propagation.
+
+Replaces the expressions of a module whose operands are all unsigned
+literals with the literal they evaluate to, following FIRRTL's width rules
+(see `widths.py`), so that ``Lit(3) + Lit(4)`` becomes ``7`` of width 3 and
+``~Lit(5, 4)`` becomes ``10``:
+
+    a + b           a + b, one bit wider than the widest operand
+    a - b           a - b, modulo 2 to the power of that width
+    a == b, ...     1 or 0
+    ~a              a with its bits inverted
+    a[msb:lsb]      bits msb down to lsb of a
+    Cat(a, b, ...)  a, b, ... side by side, a in the high bits
+    Mux(s, a, b)    a if s is not 0, b otherwise
+
+A `Mux` with a literal selector becomes the selected operand (which need
+not be a literal) if that is at least as wide as the other one, so that
+the width of the expression doesn't change; as the right-hand side of a
+connection whose target has a declared width, it always does.  (Targets
+whose width is still to be inferred take it from the whole `Mux`.)  A `when`
+with a literal condition is replaced by the statements of the selected
+branch.
+
+Constants are propagated through wires driven by a single unconditional
+connection of the whole wire: if its right-hand side folds to a literal
+that fits the wire, reads of the wire are replaced by that literal.  The
+wire itself is left alone for `dead.py` to remove.
+
+Each module is folded in one post-order pass over its expressions, with
+the results remembered per node: subtrees shared between expressions (by
+hash-consing, or through propagated wires) are only folded once, so the
+pass stays linear in the size of the expression DAG.
+"""
+from pyrrhic.pyrast import *
+from refs import declared_type
+from widths import lit_width, name_of
+
+def mask(width):
+    return (1 << width) - 1
+
+def const(e):
+    """
+    Returns the value of `e` if it is an unsigned integer literal, and
+    `None` otherwise.
+    """
+    if isinstance(e, Lit) and not e.signed and \
+       isinstance(e.value, (int, long)) and e.value >= 0:
+        return e.value
+    return None
+
+def fold_add(a, b, wa, wb):
+    w = max(wa, wb) + 1
+    return Lit(a + b, w)
+
+def fold_sub(a, b, wa, wb):
+    w = max(wa, wb) + 1
+    return Lit((a - b) & mask(w), w)
+
+# How operator nodes with literal operands fold: a function of the operand
+# values and widths returning the resulting literal
+Folders = {
+    Add: fold_add,
+    Sub: fold_sub,
+    Eq:  lambda a, b, wa, wb: Lit(int(a == b), 1),
+    Neq: lambda a, b, wa, wb: Lit(int(a != b), 1),
+    Lt:  lambda a, b, wa, wb: Lit(int(a < b), 1),
+    Gt:  lambda a, b, wa, wb: Lit(int(a > b), 1),
+}
+
+class ConstantFolder(object):
+    """
+    Folds the expressions of one module.
+    """
+    def __init__(self, mdec):
+        self.mdec = mdec
+        # Declared types by name
+        self.types = {}
+        # Right-hand side of each wire connected exactly once, as a whole,
+        # outside of any `when`
+        self.drivers = {}
+        # Folded value of each of those wires, as a literal or the wire's id
+        self.wire_values = {}
+        # Maps `id(node)` to (node, folded node, width)
+        self.memo = {}
+        # Expression nodes folded, and `WhenStmt`s whose condition folded to
+        # a literal
+        self.folded = 0
+        self.constant_whens = 0
+
+    def find_drivers(self):
+        """
+        Collects the declared types, and the wires constants may be
+        propagated through.
+        """
+        wires = set()
+        counts = {}
+        stack = [(s, True) for s in reversed(self.mdec.stmts)]
+        while stack:
+            (s, top) = stack.pop()
+            if isinstance(s, (WireDec, RegDec)):
+                name = name_of(s.idt)
+                self.types[name] = s.type
+                if top and isinstance(s, WireDec):
+                    wires.add(name)
+            elif isinstance(s, (ConnectStmt, VecStmt)):
+                e = s.lval
+                whole = isinstance(e, Id) and top and \
+                        isinstance(s, ConnectStmt)
+                while isinstance(e, (SubField, SubItem)):
+                    e = e.__base__
+                name = name_of(e)
+                if whole:
+                    counts[name] = counts.get(name, 0) + 1
+                    self.drivers[name] = s.rval
+                else:
+                    counts[name] = 2
+            elif isinstance(s, WhenStmt):
+                body = s.if_stmts + s.else_stmts
+                stack.extend((b, False) for b in reversed(body))
+        for (name, n) in counts.items():
+            if n != 1 or name not in wires:
+                self.drivers.pop(name, None)
+
+    def element_type(self, e):
+        """
+        Returns the declared type of the elements of the vector `e`, or
+        `None` if it isn't known.
+        """
+        t = declared_type(self.types, e)
+        return t.type if isinstance(t, Vec) else None
+
+    def node_width(self, node, widths):
+        """
+        Returns the width of the folded `node`, whose operands have the
+        widths `widths`, or `None` if it isn't known.
+        """
+        if isinstance(node, Lit):
+            return lit_width(node)
+        if isinstance(node, (Id, SubField, SubItem)):
+            t = declared_type(self.types, node)
+            return t.width if t != None else None
+        if isinstance(node, (Eq, Neq, Lt, Gt)):
+            return 1
+        if isinstance(node, Bits):
+            return node.msb - node.lsb + 1
+        if isinstance(node, (Invert, SReg)):
+            return widths[0] if widths else None
+        if None in widths or not widths:
+            return None
+        if isinstance(node, (Add, Sub)):
+            return max(widths) + 1
+        if isinstance(node, Cat):
+            return sum(widths)
+        if isinstance(node, Mux):
+            return max(widths[1:])
+        return None
+
+    def evaluate(self, node, kids, widths):
+        """
+        Returns what `node` folds to given its folded operands `kids` and
+        their widths, or `None` if it doesn't.
+        """
+        cls = type(node)
+        if cls in Folders:
+            a = const(kids[0])
+            b = const(kids[1])
+            if a != None and b != None:
+                return Folders[cls](a, b, widths[0], widths[1])
+        elif cls is Invert:
+            a = const(kids[0])
+            if a != None:
+                return Lit(~a & mask(widths[0]), widths[0])
+        elif cls is Bits:
+            a = const(kids[0])
+            if a != None:
+                w = node.msb - node.lsb + 1
+                return Lit((a >> node.lsb) & mask(w), w)
+        elif cls is Cat:
+            values = [const(k) for k in kids]
+            if None not in values and None not in widths:
+                v = 0
+                for (x, w) in zip(values, widths):
+                    v = (v << w) | x
+                return Lit(v, sum(widths))
+        elif cls is Mux:
+            (sel, a, b) = kids
+            if a is b:
+                return a
+            s = const(sel)
+            if s == None:
+                return None
+            (chosen, wc, wo) = (a, widths[1], widths[2]) if s != 0 else \
+                               (b, widths[2], widths[1])
+            if wc == None or wo == None:
+                return None
+            c = const(chosen)
+            if c != None:
+                return Lit(c, max(wc, wo))
+            if wc >= wo:
+                return chosen
+        return None
+
+    def result_width(self, node, res, widths):
+        """
+        Returns the width of `res`, which `node`, whose operands have the
+        widths `widths`, folded to.
+        """
+        if isinstance(res, Lit):
+            return lit_width(res)
+        # A `Mux` folded to one of its operands, at least as wide as the other
+        return max(widths[1:])
+
+    def fold(self, root):
+        """
+        Returns the folded form of the expression `root`, which is left
+        unchanged.
+        """
+        memo = self.memo
+        drivers = self.drivers
+        wire_values = self.wire_values
+        # Wires whose driver is being folded
+        pending = set()
+        # (node, its operands once they are being folded, or `None`)
+        stack = [(root, None)]
+        while stack:
+            (node, kids) = stack.pop()
+            if kids is None:
+                if id(node) in memo:
+                    continue
+                if isinstance(node, Id):
+                    name = name_of(node)
+                    if name in pending:
+                        # Combinational loop through the wire
+                        memo[id(node)] = (node, node, self.node_width(node, []))
+                        continue
+                    if name in drivers and name not in wire_values:
+                        pending.add(name)
+                        stack.append((node, ()))
+                        stack.append((drivers[name], None))
+                        continue
+                    value = wire_values.get(name, node)
+                    memo[id(node)] = (node, value, self.node_width(value, []))
+                    continue
+                kids = expr_children(node)
+                stack.append((node, kids))
+                stack.extend((k, None) for k in kids)
+                continue
+            if isinstance(node, Id):
+                name = name_of(node)
+                pending.discard(name)
+                value = self.wire_value(node, memo[id(drivers[name])][1])
+                wire_values[name] = value
+                memo[id(node)] = (node, value, self.node_width(value, []))
+                continue
+            entries = [memo[id(k)] for k in kids]
+            folded = [e[1] for e in entries]
+            widths = [e[2] for e in entries]
+            res = self.evaluate(node, folded, widths)
+            if res is None:
+                res = node
+                for (k, f) in zip(kids, folded):
+                    if k is not f:
+                        res = replace_expr_children(node, folded, True)
+                        break
+                width = self.node_width(res, widths)
+            else:
+                self.folded += 1
+                width = self.result_width(node, res, widths)
+            memo[id(node)] = (node, res, width)
+        return memo[id(root)][1]
+
+    def wire_value(self, idt, driver):
+        """
+        Returns what reads of the wire `idt` fold to, given its folded
+        `driver`: a literal of the wire's width, if `driver` is one that
+        fits it, and `idt` itself otherwise.
+        """
+        v = const(driver)
+        if v == None:
+            return idt
+        t = self.types.get(name_of(idt))
+        w = t.width if t != None else None
+        if w == None:
+            return driver
+        if v > mask(w):
+            return idt
+        return Lit(v, w)
+
+    def fold_rval(self, e, t):
+        """
+        Folds the right-hand side of a connection to a target of type `t`,
+        where, if `t` has a known width, a `Mux` with a literal selector
+        always becomes the selected operand.
+        """
+        e = self.fold(e)
+        if t is None or t.width is None:
+            return e
+        while isinstance(e, Mux) and const(e.__sel__) != None:
+            self.folded += 1
+            if const(e.__sel__) != 0:
+                e = e.__a__
+            else:
+                e = e.__b__
+        return e
+
+    def run(self):
+        """
+        Folds every expression of the module, then splices the `when`s with
+        literal conditions into their enclosing statement lists.
+        """
+        self.find_drivers()
+        stack = list(reversed(self.mdec.stmts))
+        while stack:
+            s = stack.pop()
+            if isinstance(s, ConnectStmt):
+                s.rval = self.fold_rval(s.rval,
+                                        declared_type(self.types, s.lval))
+            elif isinstance(s, ForEachStmt):
+                s.template = self.fold_rval(s.template,
+                                            self.element_type(s.lval))
+            elif isinstance(s, ConnectEachStmt):
+                t = self.element_type(s.lval)
+                s.rvals = [self.fold_rval(e, t) for e in s.rvals]
+            elif isinstance(s, RegDec) and s.onReset is not None:
+                s.onReset = self.fold_rval(s.onReset, s.type)
+            elif isinstance(s, WhenStmt):
+                s.cond = self.fold(s.cond)
+                stack.extend(reversed(s.else_stmts))
+                stack.extend(reversed(s.if_stmts))
+        self.mdec.stmts = self.splice(self.mdec.stmts)
+
+    def splice(self, stmts):
+        """
+        Returns `stmts` with every `WhenStmt` whose condition is a literal
+        replaced by the statements of the branch it selects, in nested
+        bodies too.  Each statement is moved once.
+        """
+        res = []
+        # (statements, list to append them to), one per body to rebuild
+        tasks = [(stmts, res)]
+        while tasks:
+            (src, dst) = tasks.pop()
+            iters = [iter(src)]
+            while iters:
+                for s in iters[-1]:
+                    if isinstance(s, WhenStmt):
+                        c = const(s.cond)
+                        if c != None:
+                            self.constant_whens += 1
+                            iters.append(iter(s.if_stmts if c != 0
+                                              else s.else_stmts))
+                            break
+                        (if_stmts, else_stmts) = (s.if_stmts, s.else_stmts)
+                        s.if_stmts = []
+                        s.else_stmts = []
+                        tasks.append((if_stmts, s.if_stmts))
+                        tasks.append((else_stmts, s.else_stmts))
+                    dst.append(s)
+                else:
+                    iters.pop()
+        return res
+
+def fold_constants(mdecs):
+    """
+    Folds the constant expressions of the `ModuleDec`s `mdecs`, which are
+    updated in place, and returns the number of expression nodes and
+    `when`s folded.
+    """
+    folded = 0
+    for mdec in mdecs:
+        folder = ConstantFolder(mdec)
+        folder.run()
+        folded += folder.folded + folder.constant_whens
+    return folded
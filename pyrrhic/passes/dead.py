@@ -0,0 +1,251 @@
+"""
+Dead Code Elimination.
+
+Removes the wires and registers of a module that can't affect anything
+observable from outside of it, along with the connections driving them.
+Observable are the module's ``io`` and the ports of the modules it
+instantiates; everything else is live only if some connection to a live
+declaration reads it, or if it is read by the condition of a `when`
+enclosing such a connection, or by the reset value of a live register.
+A connection of bundles with reversed fields also drives its right-hand
+side, so it is kept if either side is live; when the type of its target
+isn't known (as for instance ports), it is assumed to have such fields.
+
+Each module gets a reverse-dependency graph whose nodes are its declared
+names and its `WhenStmt`s: a name depends on every name read by the
+connections driving it (or by its reset value) and on the `when`s around
+them, and a `when` depends on the names in its condition and on the `when`
+around it.  Marking what the roots depend on and dropping the rest visits
+every statement and expression node once.  A `when` left without
+statements is dropped too, and one left with only an else branch is
+turned around.
+"""
+from pyrrhic.pyrast import *
+from refs import declared_type, is_passive, is_reference
+from widths import io_name, name_of
+
+class DeadCodeReport(object):
+    """
+    How much IR `remove_dead_code` removed.
+    """
+    def __init__(self):
+        self.wires = 0
+        self.regs = 0
+        self.connects = 0
+        self.whens = 0
+        # (module name, declaration name) of every removed declaration
+        self.removed = []
+
+    def __str__(self):
+        return "removed %d wires, %d registers, %d connections, %d whens" % \
+            (self.wires, self.regs, self.connects, self.whens)
+
+def root_name(e):
+    """
+    Returns the name of the declaration the target `e` is part of.
+    """
+    while isinstance(e, (SubField, SubItem)):
+        e = e.__base__
+    return name_of(e)
+
+def names_read(e, out):
+    """
+    Appends the names of the identifiers in the expression `e` to `out`.
+    """
+    if isinstance(e, Expr):
+        for node in walk_expr(e):
+            if isinstance(node, Id):
+                out.append(str(node.__idt__))
+
+def lval_reads(e, out):
+    """
+    Appends the names read by the target `e` (in vector indices) to `out`.
+    """
+    while isinstance(e, (SubField, SubItem)):
+        if isinstance(e, SubItem):
+            names_read(e.__item__, out)
+        e = e.__base__
+
+def connect_reads(s):
+    """
+    Returns the names read by the connection (or `VecStmt`) `s`.
+    """
+    reads = []
+    lval_reads(s.lval, reads)
+    if isinstance(s, ConnectStmt):
+        names_read(s.rval, reads)
+    elif isinstance(s, ForEachStmt):
+        names_read(s.template, reads)
+    else:
+        for e in s.rvals:
+            names_read(e, reads)
+    return reads
+
+class DeadCodeEliminator(object):
+    """
+    Reverse-dependency graph of one module.
+    """
+    def __init__(self, mdec):
+        self.mdec = mdec
+        # What each name, and each `when` (by id), depends on
+        self.deps = {}
+        # Declared types by name, and whether each one (by id) is passive
+        self.types = {}
+        self.passive = {}
+        # Names of the right-hand sides driven by each connection (by id)
+        # through reversed fields
+        self.driven = {}
+        self.roots = []
+        # `WhenStmt`s in pre-order
+        self.whens = []
+        self.live = set()
+
+    def build(self):
+        """
+        Adds the dependencies of every statement of the module.
+        """
+        deps = self.deps
+        io = io_name(self.mdec)
+        if io != None:
+            self.roots.append(io)
+        stack = [(s, None) for s in reversed(self.mdec.stmts)]
+        while stack:
+            (s, when) = stack.pop()
+            if isinstance(s, (ConnectStmt, VecStmt)):
+                reads = connect_reads(s)
+                if when != None:
+                    reads.append(when)
+                deps.setdefault(root_name(s.lval), []).extend(reads)
+                driven = self.reverse_targets(s)
+                if driven:
+                    # Whatever the right-hand sides are driven with
+                    self.driven[id(s)] = driven
+                    back = [root_name(s.lval)]
+                    lval_reads(s.lval, back)
+                    if when != None:
+                        back.append(when)
+                    for name in driven:
+                        deps.setdefault(name, []).extend(back)
+            elif isinstance(s, WhenStmt):
+                self.whens.append(s)
+                d = deps.setdefault(id(s), [])
+                names_read(s.cond, d)
+                if when != None:
+                    d.append(when)
+                body = s.if_stmts + s.else_stmts
+                stack.extend((b, id(s)) for b in reversed(body))
+            elif isinstance(s, (WireDec, RegDec)):
+                name = name_of(s.idt)
+                self.types[name] = s.type
+                if isinstance(s, RegDec) and s.onReset is not None:
+                    names_read(s.onReset, deps.setdefault(name, []))
+            elif isinstance(s, ModuleInst):
+                self.roots.append(name_of(s.inst_idt))
+
+    def reverse_targets(self, s):
+        """
+        Returns the names of the declarations on the right-hand side of the
+        connection (or `VecStmt`) `s` that it may drive through reversed
+        fields.
+        """
+        if isinstance(s, ConnectStmt):
+            rvals = [s.rval]
+        elif isinstance(s, ForEachStmt):
+            rvals = [s.template]
+        else:
+            rvals = s.rvals
+        rvals = [e for e in rvals if is_reference(e)]
+        if not rvals:
+            return []
+        t = declared_type(self.types, s.lval)
+        if t != None and isinstance(s, VecStmt):
+            t = t.type if isinstance(t, Vec) else None
+        if t != None:
+            if id(t) not in self.passive:
+                self.passive[id(t)] = (t, is_passive(t))
+            if self.passive[id(t)][1]:
+                return []
+        return [root_name(e) for e in rvals]
+
+    def mark(self):
+        """
+        Marks everything the roots depend on as live.
+        """
+        live = self.live
+        deps = self.deps
+        work = [r for r in self.roots if r not in live]
+        live.update(work)
+        while work:
+            for d in deps.get(work.pop(), ()):
+                if d not in live:
+                    live.add(d)
+                    work.append(d)
+
+    def is_live(self, s):
+        """
+        Returns true iff the statement `s` (whose nested bodies, if any, have
+        already been filtered) should be kept.
+        """
+        if isinstance(s, (ConnectStmt, VecStmt)):
+            name = root_name(s.lval)
+            if name in self.live or name not in self.types:
+                return True
+            for name in self.driven.get(id(s), ()):
+                if name in self.live or name not in self.types:
+                    return True
+            return False
+        if isinstance(s, (WireDec, RegDec)):
+            return name_of(s.idt) in self.live
+        if isinstance(s, WhenStmt):
+            return bool(s.if_stmts or s.else_stmts)
+        return True
+
+    def sweep(self, stmts, report):
+        """
+        Returns the statements of `stmts` to keep, counting the others in
+        `report`.
+        """
+        kept = []
+        for s in stmts:
+            if self.is_live(s):
+                kept.append(s)
+            elif isinstance(s, WireDec):
+                report.wires += 1
+                report.removed.append((str(self.mdec.idt), name_of(s.idt)))
+            elif isinstance(s, RegDec):
+                report.regs += 1
+                report.removed.append((str(self.mdec.idt), name_of(s.idt)))
+            elif isinstance(s, VecStmt):
+                report.connects += s.count
+            elif isinstance(s, WhenStmt):
+                report.whens += 1
+            else:
+                report.connects += 1
+        return kept
+
+    def remove(self, report):
+        """
+        Removes the dead statements of the module, innermost `when`s first.
+        """
+        for w in reversed(self.whens):
+            w.if_stmts = self.sweep(w.if_stmts, report)
+            w.else_stmts = self.sweep(w.else_stmts, report)
+            if not w.if_stmts and w.else_stmts:
+                w.cond = Invert(w.cond)
+                w.if_stmts = w.else_stmts
+                w.else_stmts = []
+        self.mdec.stmts = self.sweep(self.mdec.stmts, report)
+
+def remove_dead_code(mdecs):
+    """
+    Removes the unobservable declarations and connections of the
+    `ModuleDec`s `mdecs`, which are updated in place, and returns a
+    `DeadCodeReport` of what was removed.
+    """
+    report = DeadCodeReport()
+    for mdec in mdecs:
+        dce = DeadCodeEliminator(mdec)
+        dce.build()
+        dce.mark()
+        dce.remove(report)
+    return report
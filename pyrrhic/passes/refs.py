@@ -0,0 +1,63 @@
+"""
+References and Their Types.
+
+Helpers shared by the passes for targets and other references: a
+declaration's `Id`, possibly followed by `SubField`s and `SubItem`s
+selecting a part of it.
+"""
+from pyrrhic.pyrast import *
+from widths import name_of
+
+def is_reference(e):
+    """
+    Returns true iff `e` names a declaration or a part of one, and may thus
+    be driven through reversed fields.
+    """
+    while isinstance(e, (SubField, SubItem)):
+        e = e.__base__
+    return isinstance(e, Id)
+
+def is_passive(t):
+    """
+    Returns true iff the type `t` has no reversed fields.
+    """
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, Bundle):
+            for f in t.fields.values():
+                if f.orientation == Field.Reverse:
+                    return False
+                stack.append(f.type)
+        elif isinstance(t, Vec):
+            stack.append(t.type)
+    return True
+
+def part_type(t, path):
+    """
+    Returns the type of the part of a value of type `t` selected by `path`,
+    a list of `SubField`s and `SubItem`s (outermost first) whose own bases
+    are ignored, or `None` if there is no such part.
+    """
+    path = list(path)
+    while t != None and path:
+        e = path.pop()
+        if isinstance(e, SubField):
+            info = t.field(e.__attr__) if isinstance(t, Bundle) else None
+            t = info.type if info != None else None
+        else:
+            t = t.type if isinstance(t, Vec) else None
+    return t
+
+def declared_type(types, e):
+    """
+    Returns the type of the reference `e`, given the declared types of
+    `types` by name, or `None` if it isn't known.
+    """
+    path = []
+    while isinstance(e, (SubField, SubItem)):
+        path.append(e)
+        e = e.__base__
+    if not isinstance(e, Id):
+        return None
+    return part_type(types.get(name_of(e)), path)
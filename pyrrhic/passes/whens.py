@@ -0,0 +1,398 @@
+"""
+When Expansion.
+
+Replaces the `WhenStmt`s of a module with `Mux` networks, so that each
+connected target is driven by a single unconditional `ConnectStmt`
+following FIRRTL's last-connect semantics:
+
+    r := a                  r := Mux(c, Mux(d, b, a), a)
+    when c:                 (for a register r)
+      when d:
+        r := b
+
+Declarations and instances inside `when`s are moved to the top of the
+module, in the order they appear, followed by one connection per target in
+the order the targets are first connected.
+
+Each module is expanded in a single pass over its statements.  The driver
+of every target so far is kept in one map; connections inside a branch
+overwrite it and log the value they replaced, and at the end of the branch
+the log is unwound into a map of just the targets the branch connected.
+The two branch maps of a `when` are then merged into one `Mux` per target.
+Nothing is copied on entering a `when`, so each one costs time in
+proportion to the targets connected inside it: a long chain of nested
+``elif``s connecting the same few targets takes linear time.
+
+A target that a `when` connects in one branch only keeps its previous
+value in the other: the value connected to it (or to an enclosing field or
+vector) before, the register itself for parts of registers, and for a wire
+that was never connected, the value of the branch that does connect it.
+
+Targets are told apart by their strings, so two connections must only
+share a key if they drive the same thing.  Before they are expanded,
+connections to a vector element selected by an expression become a `when`
+per element, and connections of bundles with reversed fields, which no
+`Mux` can carry, become one connection per field, the reversed ones
+driving the right-hand side.  Modules where that needs a type that isn't
+known are left unexpanded.
+"""
+from pyrrhic.pyrast import *
+from refs import is_passive, is_reference, part_type
+from widths import io_name
+
+# Markers of the ends of the branches of a `WhenStmt` on the statement stack
+_ELSE, _END = range(2)
+
+class CantExpand(ValueError):
+    """
+    Raised for modules whose `when`s can't be expanded.
+    """
+    pass
+
+class WhenExpander(object):
+    """
+    Driver maps of one module being expanded.
+    """
+    def __init__(self, ports = None):
+        """
+        Parameters
+        ----------
+        ports (dict): Maps module names to the type of their ``io``, for the
+                      ports of the instances of the module (see
+                      `module_ports`)
+        """
+        self.ports = ports or {}
+        # Declared types by name, and the module instantiated by each
+        # instance name
+        self.types = {}
+        self.insts = {}
+        # Whether each type is passive, by `id`
+        self.passive = {}
+        # Driver of each target, keyed by its string
+        self.current = {}
+        # Target expressions in the order they were first connected, and the
+        # source locations of their first connections
+        self.order = []
+        self.targets = {}
+        self.infos = {}
+        # Targets that are fields or elements of each target, with the
+        # `SubField`s and `SubItem`s leading down to them
+        self.subtargets = {}
+        # Names of the registers declared so far, and the name of the
+        # declaration each target is part of
+        self.regs = set()
+        self.roots = {}
+        # (key, replaced driver) log of the branches being expanded, and the
+        # log length at the start of each of them
+        self.trail = []
+        self.marks = []
+
+    def target(self, lval, info):
+        """
+        Returns the key of the target `lval`, registering it (and it as a
+        sub-target of the targets enclosing it) the first time it is seen.
+        """
+        key = str(lval)
+        if key not in self.targets:
+            self.targets[key] = lval
+            self.infos[key] = info
+            self.order.append(key)
+            path = []
+            e = lval
+            while isinstance(e, (SubField, SubItem)):
+                path.append(e)
+                e = e.__base__
+                self.subtargets.setdefault(str(e), []).append(
+                    (key, list(reversed(path))))
+            self.roots[key] = str(e)
+        return key
+
+    def type_of(self, e):
+        """
+        Returns the type of the reference `e`, or `None` if it isn't known.
+        """
+        path = []
+        while isinstance(e, (SubField, SubItem)):
+            path.append(e)
+            e = e.__base__
+        if not isinstance(e, Id):
+            return None
+        t = self.types.get(str(e))
+        if t is None:
+            # Instance ports are reached through the instance's ``io``
+            if not path or not isinstance(path[-1], SubField) or \
+               path[-1].__attr__ != "io":
+                return None
+            t = self.ports.get(self.insts.get(str(e)))
+            path.pop()
+        return part_type(t, path)
+
+    def is_passive(self, t):
+        """
+        Returns true iff the type `t` has no reversed fields.
+        """
+        res = self.passive.get(id(t))
+        if res is None:
+            res = self.passive[id(t)] = is_passive(t)
+        return res
+
+    def split(self, s):
+        """
+        Returns the statements to expand in place of the `ConnectStmt` `s`
+        if its target can't be expanded as it is, and `None` otherwise (see
+        the module docstring).
+        """
+        chain = []
+        e = s.lval
+        while isinstance(e, (SubField, SubItem)):
+            chain.append(e)
+            e = e.__base__
+        chain.reverse()
+        for (i, p) in enumerate(chain):
+            if isinstance(p, SubItem) and \
+               not isinstance(p.__item__, (int, long, Lit)):
+                t = self.type_of(p.__base__)
+                if not isinstance(t, Vec):
+                    raise CantExpand("can't tell the length of " +
+                                     str(p.__base__))
+                res = []
+                for k in range(t.count):
+                    c = ConnectStmt(rebase(SubItem(p.__base__, Lit(k)),
+                                           chain[i + 1:]), s.rval)
+                    c.lineInfo = s.lineInfo
+                    res.append(WhenStmt(p.__item__ == Lit(k), [c], []))
+                return res
+        t = self.type_of(s.lval)
+        if t is None or self.is_passive(t):
+            return None
+        if isinstance(t, Vec):
+            res = [ConnectStmt(SubItem(s.lval, Lit(k)),
+                               SubItem(s.rval, Lit(k)))
+                   for k in range(t.count)]
+        else:
+            theirs = self.type_of(s.rval)
+            res = []
+            for k in t.fields:
+                if isinstance(theirs, Bundle) and theirs.field(k) is None:
+                    continue
+                if t.fields[k].orientation == Field.Default:
+                    res.append(ConnectStmt(SubField(s.lval, k),
+                                           SubField(s.rval, k)))
+                elif is_reference(s.rval):
+                    res.append(ConnectStmt(SubField(s.rval, k),
+                                           SubField(s.lval, k)))
+                else:
+                    raise CantExpand("%s can't drive the reversed field %s" \
+                                     % (s.rval, SubField(s.lval, k)))
+        for c in res:
+            c.lineInfo = s.lineInfo
+        return res
+
+    def lookup(self, drivers, key):
+        """
+        Returns the driver of `key` in the map `drivers`, taken from that of
+        the nearest enclosing target if `key` has none of its own, or `None`.
+        """
+        v = drivers.get(key)
+        if v is not None:
+            return v
+        e = self.targets[key]
+        path = []
+        while isinstance(e, (SubField, SubItem)):
+            path.append(e)
+            e = e.__base__
+            v = drivers.get(str(e))
+            if v is not None:
+                return rebase(v, reversed(path))
+        return None
+
+    def previous(self, key):
+        """
+        Returns the value `key` holds when a `when` doesn't connect it, or
+        `None` if it is an unconnected wire (see the module docstring).
+        """
+        v = self.lookup(self.current, key)
+        if v is None and self.roots[key] in self.regs:
+            return self.targets[key]
+        return v
+
+    def assign(self, key, value, propagate = True):
+        """
+        Makes `value` the driver of `key`, and, if `propagate` is true, the
+        corresponding part of it the driver of each connected sub-target of
+        `key`.
+        """
+        current = self.current
+        trail = self.trail
+        logged = bool(self.marks)
+        if logged:
+            trail.append((key, current.get(key)))
+        current[key] = value
+        if not propagate:
+            return
+        for (sub, path) in self.subtargets.get(key, ()):
+            if sub in current:
+                if logged:
+                    trail.append((sub, current[sub]))
+                current[sub] = rebase(value, path)
+
+    def unwind(self):
+        """
+        Ends the innermost branch: restores the drivers it replaced, and
+        returns a map of the targets it connected to their final drivers.
+        """
+        mark = self.marks.pop()
+        trail = self.trail
+        current = self.current
+        final = {}
+        while len(trail) > mark:
+            (k, old) = trail.pop()
+            if k not in final:
+                final[k] = current[k]
+            if old is None:
+                del current[k]
+            else:
+                current[k] = old
+        return final
+
+    def merge(self, cond, if_vals, else_vals):
+        """
+        Drives each target connected by either branch of a `when` on `cond`
+        with the `Mux` of its drivers in both.  The branch maps already
+        hold the parts of the targets whose enclosing targets were connected,
+        so nothing is propagated to sub-targets here.
+        """
+        keys = list(if_vals)
+        keys.extend(k for k in else_vals if k not in if_vals)
+        merged = []
+        for k in keys:
+            prior = self.previous(k)
+            a = self.lookup(if_vals, k)
+            if a is None:
+                a = prior
+            b = self.lookup(else_vals, k)
+            if b is None:
+                b = prior
+            if a is None or a is b:
+                merged.append((k, b))
+            elif b is None:
+                merged.append((k, a))
+            else:
+                merged.append((k, Mux(cond, a, b)))
+        for (k, v) in merged:
+            self.assign(k, v, False)
+
+    def expand(self, stmts):
+        """
+        Returns the expanded form of the statements `stmts`.
+        """
+        decls = []
+        branches = []
+        stack = list(reversed(stmts))
+        while stack:
+            s = stack.pop()
+            if isinstance(s, tuple):
+                (marker, when) = s
+                if marker == _ELSE:
+                    branches.append(self.unwind())
+                    self.marks.append(len(self.trail))
+                else:
+                    else_vals = self.unwind()
+                    self.merge(when.cond, branches.pop(), else_vals)
+            elif isinstance(s, ConnectStmt):
+                parts = self.split(s)
+                if parts is None:
+                    self.assign(self.target(s.lval, s.lineInfo), s.rval)
+                else:
+                    stack.extend(reversed(parts))
+            elif isinstance(s, WhenStmt):
+                self.marks.append(len(self.trail))
+                stack.append((_END, s))
+                stack.extend(reversed(s.else_stmts))
+                stack.append((_ELSE, s))
+                stack.extend(reversed(s.if_stmts))
+            elif isinstance(s, VecStmt):
+                stack.extend(reversed(s.expand()))
+            elif s is not None:
+                if isinstance(s, RegDec):
+                    self.regs.add(str(s.idt))
+                if isinstance(s, (WireDec, RegDec)):
+                    self.types[str(s.idt)] = s.type
+                elif isinstance(s, ModuleInst):
+                    self.insts[str(s.inst_idt)] = str(s.mod_idt)
+                decls.append(s)
+        # A connection to a whole target overrides those to its parts, so
+        # targets go before the targets inside them
+        emitted = set()
+        for key in self.order:
+            chain = []
+            e = self.targets[key]
+            while True:
+                k = str(e)
+                if k in emitted:
+                    break
+                if k in self.current:
+                    chain.append(k)
+                emitted.add(k)
+                if not isinstance(e, (SubField, SubItem)):
+                    break
+                e = e.__base__
+            for k in reversed(chain):
+                c = ConnectStmt(self.targets[k], self.current[k])
+                if self.infos[k] != None:
+                    c.lineInfo = self.infos[k]
+                decls.append(c)
+        return decls
+
+def rebase(base, path):
+    """
+    Returns the part of `base` selected by `path`, a list of `SubField`s and
+    `SubItem`s (outermost first) whose own bases are ignored.
+    """
+    for e in path:
+        if isinstance(e, SubField):
+            base = SubField(base, e.__attr__)
+        else:
+            base = SubItem(base, e.__item__)
+    return base
+
+def module_ports(mdecs):
+    """
+    Returns a map of the names of the `ModuleDec`s `mdecs` to the types of
+    their ``io`` declarations.
+    """
+    ports = {}
+    for mdec in mdecs:
+        io = io_name(mdec)
+        for s in walk_stmts(mdec.stmts):
+            if isinstance(s, (WireDec, RegDec)) and str(s.idt) == io:
+                ports[str(mdec.idt)] = s.type
+                break
+    return ports
+
+def has_whens(stmts):
+    """
+    Returns true iff `stmts` (not counting nested bodies) contains a
+    `WhenStmt`.
+    """
+    for s in stmts:
+        if isinstance(s, WhenStmt):
+            return True
+    return False
+
+def expand_whens(mdecs):
+    """
+    Expands the `WhenStmt`s of the `ModuleDec`s `mdecs`, which are updated in
+    place, and returns how many modules were expanded.  Modules raising
+    `CantExpand` keep their `when`s.
+    """
+    ports = module_ports(mdecs)
+    expanded = 0
+    for mdec in mdecs:
+        if has_whens(mdec.stmts):
+            try:
+                mdec.stmts = WhenExpander(ports).expand(mdec.stmts)
+            except CantExpand:
+                continue
+            expanded += 1
+    return expanded
@@ -0,0 +1,502 @@
+"""
+Width Inference.
+
+Fills in the widths of the `UInt`s and `SInt`s declared without one, as in
+``Reg(UInt())``, from the way the declared wires and registers are driven.
+As in FIRRTL, a declaration is as wide as the widest expression connected
+to it, and expression widths follow from their operands':
+
+    Lit             the given width, or as many bits as the value needs
+    a + b, a - b    max(width(a), width(b)) + 1
+    a == b, ...     1
+    ~a, Reg(a)      width(a)
+    a[msb:lsb]      msb - lsb + 1
+    Cat(a, b, ...)  width(a) + width(b) + ...
+    Mux(s, a, b)    max(width(a), width(b))
+
+Every unknown width of a module, and every expression whose width depends
+on one, becomes a variable of a `WidthGraph`, constrained only by the
+variables it is computed from.  The graph's strongly connected components
+are solved in dependency order: a variable outside of any cycle is
+evaluated exactly once, and the variables of a cycle (a register fed back
+through a `Mux`, say) are iterated with a worklist until they settle, which
+takes near-linear time overall.  A cycle that never settles, such as an
+uninferred counter incremented with ``+``, is an error.
+
+Modules are inferred one at a time, in elaboration order, so the ports of
+an instance are known by the time the module containing it is inferred;
+they are not widened by the way that module drives them.
+"""
+from pyrrhic.pyrast import *
+
+# Kinds of width variables: a fixed width, the width of a declaration (the
+# widest of the expressions driving it), the widest of the widths of some
+# operands plus a constant, and the sum of those widths plus a constant.
+# Operands whose width isn't known (yet) don't contribute.
+K_CONST, K_DECL, K_MAX, K_SUM = range(4)
+
+def combine(kind, extra, widths):
+    """
+    Returns the width of a variable of kind `kind` (other than `K_CONST`)
+    whose operands have the widths `widths`, or `None` if none is known.
+    """
+    widths = [w for w in widths if w != None]
+    if not widths:
+        return None
+    if kind == K_SUM:
+        return sum(widths) + extra
+    return max(widths) + extra
+
+# How the widths of operator nodes follow from their operands':
+# (variable kind, extra width, fields holding the operands), with the
+# operands of `Cat` in its `exprs`, and a kind of `None` for nodes as wide
+# as their single operand
+Operators = {
+    Add:    (K_MAX, 1, ("__a__", "__b__")),
+    Sub:    (K_MAX, 1, ("__a__", "__b__")),
+    Mux:    (K_MAX, 0, ("__a__", "__b__")),
+    Cat:    (K_SUM, 0, None),
+    Invert: (None, 0, ("e",)),
+    SReg:   (None, 0, ("value",)),
+}
+
+def name_of(e):
+    """
+    Returns the name declared or referred to by the identifier `e`.
+    """
+    if isinstance(e, Id):
+        return str(e.__idt__)
+    return str(e)
+
+class BundleShape(object):
+    """
+    Width variables of the fields of a bundle, mapping each field name to a
+    ``(flipped, shape)`` pair.
+    """
+    __slots__ = ("fields",)
+    def __init__(self, fields):
+        self.fields = fields
+
+class VecShape(object):
+    """
+    Width variables of the elements of a vector, which all share one shape.
+    """
+    __slots__ = ("elem",)
+    def __init__(self, elem):
+        self.elem = elem
+
+def lit_width(lit):
+    """
+    Returns the width of the literal `lit`: its own if it has one, or the
+    number of bits needed to represent its value.
+    """
+    if lit.width != None:
+        return lit.width
+    v = lit.value
+    if lit.signed:
+        if v < 0:
+            v = ~v
+        return v.bit_length() + 1
+    return max(v.bit_length(), 1)
+
+class WidthGraph(object):
+    """
+    Width variables and constraints of one module.
+
+    The shape of a ground-typed declaration or expression is the index of
+    its width variable; bundles and vectors have a `BundleShape` or
+    `VecShape` holding those of their fields, and expressions whose type
+    can't be resolved have the shape `None`.
+    """
+    def __init__(self, name, ports = None):
+        """
+        Parameters
+        ----------
+        name (str): Name of the module, for error messages
+        ports (dict): Maps the names of modules already inferred to the
+                      types of their ``io`` declarations
+        """
+        self.name = name
+        self.ports = ports if ports != None else {}
+        # Variables, as parallel lists indexed by variable
+        self.kind = []
+        self.extra = []
+        self.args = []
+        self.users = []
+        self.value = []
+        # Names of declared widths, `None` for expressions
+        self.origin = []
+        # Maps widths to the `K_CONST` variables holding them
+        self.consts = {}
+        # Maps declared names to their shapes
+        self.decls = {}
+        # Types of the declarations, by name, and the declaration statements
+        # whose types have unknown widths
+        self.types = {}
+        self.declared = []
+        # Maps `id(expr)` to (expr, shape), so that every node is only
+        # visited once however many statements share it
+        self.memo = {}
+
+    def var(self, kind, extra = 0, args = (), origin = None):
+        """
+        Returns a new variable computed from the variables `args`.
+        """
+        if kind != K_DECL and args:
+            for a in args:
+                if self.kind[a] != K_CONST:
+                    break
+            else:
+                return self.const(combine(kind, extra,
+                                          [self.extra[a] for a in args]))
+        v = len(self.kind)
+        self.kind.append(kind)
+        self.extra.append(extra)
+        self.args.append(list(args))
+        self.users.append([])
+        self.value.append(None)
+        self.origin.append(origin)
+        for a in args:
+            self.users[a].append(v)
+        return v
+
+    def const(self, width):
+        v = self.consts.get(width)
+        if v == None:
+            v = len(self.kind)
+            self.kind.append(K_CONST)
+            self.extra.append(width)
+            self.args.append([])
+            self.users.append([])
+            self.value.append(width)
+            self.origin.append(None)
+            self.consts[width] = v
+        return v
+
+    def type_shape(self, t, origin):
+        """
+        Returns the shape of a declaration of type `t`, with a new variable
+        for each unknown width.
+        """
+        if isinstance(t, (UInt, SInt)):
+            if t.width != None:
+                return self.const(t.width)
+            return self.var(K_DECL, origin = origin)
+        if isinstance(t, Bundle):
+            fields = {}
+            for k in t.fields:
+                f = t.fields[k]
+                fields[k] = (f.orientation == Field.Reverse,
+                             self.type_shape(f.type, origin + "." + k))
+            return BundleShape(fields)
+        if isinstance(t, Vec):
+            return VecShape(self.type_shape(t.type, origin + "[]"))
+        return None
+
+    def shape(self, root):
+        """
+        Returns the shape of the expression `root`, computing those of its
+        subexpressions on the way.
+        """
+        if not isinstance(root, Expr):
+            return None
+        memo = self.memo
+        stack = [(root, False)]
+        while stack:
+            (e, ready) = stack.pop()
+            if ready:
+                memo[id(e)] = (e, self.node_shape(e))
+                continue
+            if id(e) in memo:
+                continue
+            kids = expr_children(e)
+            if kids:
+                stack.append((e, True))
+                stack.extend((k, False) for k in kids)
+            else:
+                memo[id(e)] = (e, self.node_shape(e))
+        return memo[id(root)][1]
+
+    def node_shape(self, e):
+        """
+        Returns the shape of `e`, whose children already have theirs.
+        """
+        memo = self.memo
+        op = Operators.get(type(e))
+        if op != None:
+            (kind, extra, fields) = op
+            if fields == None:
+                operands = e.exprs
+            else:
+                operands = [getattr(e, f) for f in fields]
+            shapes = []
+            for a in operands:
+                s = memo[id(a)][1] if isinstance(a, Expr) else None
+                if not isinstance(s, int):
+                    return None
+                shapes.append(s)
+            if kind == None:
+                return shapes[0]
+            return self.var(kind, extra, shapes)
+        if isinstance(e, Id):
+            return self.decls.get(name_of(e))
+        if isinstance(e, Lit):
+            return self.const(lit_width(e))
+        if isinstance(e, SubField):
+            base = memo[id(e.__base__)][1]
+            if isinstance(base, BundleShape) and e.__attr__ in base.fields:
+                return base.fields[e.__attr__][1]
+            return None
+        if isinstance(e, SubItem):
+            base = memo[id(e.__base__)][1]
+            if isinstance(base, VecShape):
+                return base.elem
+            return None
+        if isinstance(e, (Eq, Neq, Lt, Gt)):
+            return self.const(1)
+        if isinstance(e, Bits):
+            if isinstance(e.msb, (int, long)) and isinstance(e.lsb, (int, long)):
+                return self.const(e.msb - e.lsb + 1)
+        return None
+
+    def bound(self, dst, src):
+        """
+        Constrains the width variable `dst` to be at least `src`.  Only
+        unknown declared widths are constrained.
+        """
+        if self.kind[dst] == K_DECL and src not in self.args[dst]:
+            self.args[dst].append(src)
+            self.users[src].append(dst)
+
+    def connect(self, lval, rval):
+        """
+        Adds the constraints of connecting `rval` to `lval`, field by field
+        for bundles and vectors; reversed fields are driven the other way.
+        """
+        stack = [(self.shape(lval), self.shape(rval), False)]
+        while stack:
+            (l, r, flipped) = stack.pop()
+            if isinstance(l, int) and isinstance(r, int):
+                if flipped:
+                    self.bound(r, l)
+                else:
+                    self.bound(l, r)
+            elif isinstance(l, BundleShape) and isinstance(r, BundleShape):
+                for k in l.fields:
+                    if k in r.fields:
+                        (f, ls) = l.fields[k]
+                        stack.append((ls, r.fields[k][1], flipped != f))
+            elif isinstance(l, VecShape) and isinstance(r, VecShape):
+                stack.append((l.elem, r.elem, flipped))
+
+    def declare(self, name, t, stmt = None):
+        shape = self.type_shape(t, name)
+        self.decls[name] = shape
+        self.types[name] = t
+        if stmt != None and t.width == None:
+            self.declared.append((stmt, shape))
+
+    def build(self, stmts):
+        """
+        Adds the declarations and constraints of the statements `stmts`.
+        """
+        # Declarations first, so that every `Id` can be resolved
+        for s in walk_stmts(stmts):
+            if isinstance(s, (WireDec, RegDec)):
+                self.declare(name_of(s.idt), s.type, s)
+            elif isinstance(s, ModuleInst):
+                io = self.ports.get(str(s.mod_idt))
+                if io != None:
+                    name = name_of(s.inst_idt)
+                    self.decls[name] = BundleShape(
+                        {"io": (False, self.type_shape(io, name + ".io"))})
+        for s in walk_stmts(stmts):
+            if isinstance(s, ConnectStmt):
+                self.connect(s.lval, s.rval)
+            elif isinstance(s, RegDec) and s.onReset is not None:
+                self.connect(s.idt, s.onReset)
+
+    def evaluate(self, v):
+        """
+        Returns the width of variable `v` computed from the current widths
+        of its arguments, or `None` if it can't be known yet.
+        """
+        kind = self.kind[v]
+        if kind == K_CONST:
+            return self.extra[v]
+        value = self.value
+        return combine(kind, self.extra[v], [value[a] for a in self.args[v]])
+
+    def components(self):
+        """
+        Returns the strongly connected components of the graph of variables
+        and their arguments, each one after those of its arguments (Tarjan's
+        algorithm, with an explicit stack).
+        """
+        args = self.args
+        index = [None] * len(args)
+        low = [0] * len(args)
+        on_stack = [False] * len(args)
+        stack = []
+        res = []
+        counter = 0
+        for root in xrange(len(args)):
+            if index[root] != None:
+                continue
+            # (variable, position of the next argument to visit)
+            work = [(root, 0)]
+            while work:
+                (v, i) = work.pop()
+                if i == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    on_stack[v] = True
+                recurse = False
+                vargs = args[v]
+                while i < len(vargs):
+                    a = vargs[i]
+                    i += 1
+                    if index[a] == None:
+                        work.append((v, i))
+                        work.append((a, 0))
+                        recurse = True
+                        break
+                    elif on_stack[a]:
+                        low[v] = min(low[v], index[a])
+                if recurse:
+                    continue
+                if low[v] == index[v]:
+                    comp = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        comp.append(w)
+                        if w == v:
+                            break
+                    res.append(comp)
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+        return res
+
+    def solve(self):
+        """
+        Computes the width of every variable.  Raises `ValueError` if the
+        widths of a cycle grow without bound.
+        """
+        value = self.value
+        for comp in self.components():
+            if len(comp) == 1 and comp[0] not in self.args[comp[0]]:
+                v = comp[0]
+                value[v] = self.evaluate(v)
+                continue
+            members = set(comp)
+            queued = set(comp)
+            updates = dict.fromkeys(comp, 0)
+            worklist = list(comp)
+            head = 0
+            while head < len(worklist):
+                v = worklist[head]
+                head += 1
+                queued.discard(v)
+                w = self.evaluate(v)
+                if w == None or w == value[v]:
+                    continue
+                value[v] = w
+                updates[v] += 1
+                if updates[v] > len(comp):
+                    raise ValueError("width of %s in module %s grows without "
+                                     "bound" % (self.describe(comp),
+                                                self.name))
+                for u in self.users[v]:
+                    if u in members and u not in queued:
+                        queued.add(u)
+                        worklist.append(u)
+
+    def describe(self, comp):
+        names = sorted(self.origin[v] for v in comp if self.origin[v] != None)
+        if names:
+            return ", ".join(names)
+        return "an expression"
+
+    def width(self, e):
+        """
+        Returns the inferred width of the ground-typed expression `e` of
+        this module (after `solve`), or `None` if it isn't known.
+        """
+        s = self.shape(e)
+        if isinstance(s, int):
+            return self.value[s]
+        return None
+
+    def inferred_type(self, t, shape):
+        """
+        Returns `t` with the widths inferred for `shape` filled in.  Types
+        are shared between declarations, so changed ones are copied.
+        """
+        if isinstance(t, (UInt, SInt)):
+            if t.width == None and self.value[shape] != None:
+                return type(t)(self.value[shape])
+            return t
+        if isinstance(t, Bundle):
+            fields = type(t.fields)()
+            changed = False
+            for k in t.fields:
+                f = t.fields[k]
+                ft = self.inferred_type(f.type, shape.fields[k][1])
+                if ft is not f.type:
+                    changed = True
+                    f = Field(f.orientation, f.name, ft)
+                fields[k] = f
+            if changed:
+                return Bundle(fields)
+            return t
+        if isinstance(t, Vec):
+            et = self.inferred_type(t.type, shape.elem)
+            if et is not t.type:
+                return Vec(et, t.count)
+        return t
+
+    def apply(self):
+        """
+        Fills the inferred widths into the declarations, returning how many
+        of them were given complete types.
+        """
+        inferred = 0
+        for (s, shape) in self.declared:
+            s.type = self.inferred_type(s.type, shape)
+            self.types[name_of(s.idt)] = s.type
+            if s.type.width != None:
+                inferred += 1
+        return inferred
+
+def io_name(mdec):
+    """
+    Returns the name of the ``io`` declaration of `mdec`, or `None`.
+    """
+    io = mdec.io
+    # Modules fresh from the builder still refer to the builder's id
+    io = getattr(io, "__final__", io)
+    if io is None:
+        return None
+    return str(io)
+
+def infer_widths(mdecs):
+    """
+    Infers the unknown widths of the declarations of the `ModuleDec`s
+    `mdecs`, which are updated in place, and returns how many declarations
+    got complete types.  Raises `ValueError` if some widths grow without
+    bound.
+    """
+    ports = {}
+    inferred = 0
+    for mdec in mdecs:
+        graph = WidthGraph(str(mdec.idt), ports)
+        graph.build(mdec.stmts)
+        graph.solve()
+        inferred += graph.apply()
+        io = io_name(mdec)
+        if io in graph.types:
+            ports[str(mdec.idt)] = graph.types[io]
+    return inferred
@@ -5,15 +5,18 @@ The PyRRHIC Abstract Syntax Tree representation
 from expr import *
 from stmt import *
 from pyrtype import *
-import inspect
+import inspect, linecache, sys
 
-class LineInfo:
+class LineInfo(object):
     """
     Contains Python source file and line number information to associate
     with a PyRRHIC AST node.
 
-    Extracted using Python's `inspect.currentframe` routine
+    Only the code object and line number of the calling frame are kept when
+    the `LineInfo` is created; the file name, function name and source text
+    are looked up when first asked for.
     """
+    __slots__ = ("__code__", "line")
 
     def __init__(self, frames = 2):
         """
@@ -29,13 +32,37 @@ class LineInfo:
         """
         # The actual line of interest should correspond to the third
         # innermost stack frome.
-        frameInfo = None
-        #print inspect.getouterframes(inspect.currentframe())
-        frameInfo = inspect.getouterframes(inspect.currentframe())[frames]
-        self.source = frameInfo[1]
-        self.line   = frameInfo[2]
-        self.module = frameInfo[3]
-        self.string = frameInfo[4]
+        frame = sys._getframe(frames)
+        self.__code__ = frame.f_code
+        self.line = frame.f_lineno
+
+    # Code objects can't be pickled, so a pickled `LineInfo` carries the
+    # resolved file and function names instead.
+    def __getstate__(self):
+        return (self.source, self.module, self.line)
+
+    def __setstate__(self, state):
+        (source, module, self.line) = state
+        self.__code__ = (source, module)
+
+    @property
+    def source(self):
+        if isinstance(self.__code__, tuple):
+            return self.__code__[0]
+        return self.__code__.co_filename
+
+    @property
+    def module(self):
+        if isinstance(self.__code__, tuple):
+            return self.__code__[1]
+        return self.__code__.co_name
+
+    @property
+    def string(self):
+        return [linecache.getline(self.source, self.line)]
+
+    def __str__(self):
+        return str(self.source) + " " + str(self.line)
 
     def assignedVar(self):
         """
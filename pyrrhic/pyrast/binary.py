@@ -0,0 +1,585 @@
+"""
+Compact Binary Serialization of Elaborated IR.
+
+Stores lists of `ModuleDec`s in a versioned binary format that loads much
+faster than the text form can be parsed:
+
+    magic "PYRRHICB", format version
+    string table: count, then (length, UTF-8 bytes) per string
+    type table: count, then one record per distinct type, children first
+    module count, then the modules
+
+All integers are LEB128 varints (zigzag-encoded where they may be
+negative).  Statements and expressions are written in prefix order as an
+opcode followed by their operands; identifiers, field names and file
+names are indices into the string table, and declared types are indices
+into the type table.  Both writer and reader use explicit stacks, so
+neither the nesting of `when`s nor the depth of expressions is limited.
+
+A `ModuleDec`'s `io` is stored as the `Id` it was finally named, which
+loaded modules refer to instead of the builder's declaration.  Bulk
+`VecStmt`s are stored as the per-element connections they expand to.
+"""
+from collections import OrderedDict
+from expr import *
+from stmt import *
+from pyrtype import *
+
+Magic = "PYRRHICB"
+FormatVersion = 2
+
+# Type records
+T_UINT, T_SINT, T_VEC, T_BUNDLE = range(4)
+
+# Statement opcodes
+S_WIRE, S_REG, S_CONNECT, S_WHEN, S_INST = range(5)
+
+# Expression opcodes.  `E_NONE`, `E_INT` and `E_STR` stand for field values
+# that aren't expressions (an absent `SReg` enable, `Bits` indices, ...).
+(E_NONE, E_INT, E_STR, E_LIT, E_ID, E_SUBFIELD, E_SUBITEM, E_ADD, E_SUB,
+ E_EQ, E_NEQ, E_LT, E_GT, E_INVERT, E_SREG, E_BITS, E_CAT, E_MUX) = range(18)
+
+BinaryOps = { Add: E_ADD, Sub: E_SUB, Eq: E_EQ, Neq: E_NEQ, Lt: E_LT, Gt: E_GT }
+BinaryClasses = dict((op, cls) for (cls, op) in BinaryOps.items())
+
+# Number of operands of the expression opcodes read through a frame
+Arity = [0] * (E_MUX + 1)
+for op in BinaryClasses:
+    Arity[op] = 2
+Arity[E_SUBITEM] = Arity[E_SREG] = 2
+Arity[E_INVERT] = 1
+Arity[E_BITS] = Arity[E_MUX] = 3
+
+def _constructors():
+    """
+    Returns a table mapping expression opcodes to node constructors.
+
+    Going through `ExprBuilder` costs more than decoding a node does, so
+    unless hash-consing is on, nodes are made by filling in their slots
+    directly.
+    """
+    from expr import _intern_table
+    if _intern_table != None:
+        make = dict(BinaryClasses)
+        make.update({ E_LIT: Lit, E_ID: Id, E_SUBFIELD: SubField,
+                      E_SUBITEM: SubItem, E_INVERT: Invert, E_SREG: SReg,
+                      E_BITS: Bits, E_CAT: lambda *args: Cat(*args),
+                      E_MUX: Mux })
+        return make
+    new = object.__new__
+    def nodes(cls):
+        fields = cls.__fields__
+        typed = cls.__typed__
+        def make(*values):
+            node = new(cls)
+            if typed:
+                node.__type__ = None
+            for (f, v) in zip(fields, values):
+                setattr(node, f, v)
+            return node
+        return make
+    def make_id(idt):
+        node = new(Id)
+        node.__idt__ = idt
+        return node
+    def make_cat(*args):
+        node = new(Cat)
+        node.exprs = args
+        return node
+    make = dict((op, nodes(cls)) for (op, cls) in BinaryClasses.items())
+    make.update({ E_LIT: nodes(Lit), E_ID: make_id,
+                  E_SUBFIELD: nodes(SubField), E_SUBITEM: nodes(SubItem),
+                  E_INVERT: nodes(Invert), E_SREG: nodes(SReg),
+                  E_BITS: nodes(Bits), E_CAT: make_cat, E_MUX: nodes(Mux) })
+    return make
+
+def _uvarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _svarint(out, n):
+    if n >= 0:
+        _uvarint(out, n << 1)
+    else:
+        _uvarint(out, ((-n) << 1) - 1)
+
+def _flat_len(stmts):
+    """
+    Returns the number of statements `stmts` is written as, with each
+    `VecStmt` counting for one connection per element.
+    """
+    n = 0
+    for s in stmts:
+        if isinstance(s, VecStmt):
+            n += s.count
+        else:
+            n += 1
+    return n
+
+def _read_uvarint(buf, pos):
+    """
+    Decodes the varint at `buf[pos]`, returning its value and the position
+    following it.
+    """
+    b = buf[pos]
+    pos += 1
+    n = b & 0x7f
+    shift = 7
+    while b & 0x80:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+    return (n, pos)
+
+class Writer(object):
+    """
+    Encodes `ModuleDec`s, collecting the strings and types they use.
+    """
+    def __init__(self):
+        self.body = bytearray()
+        self.strings = []
+        self.string_index = {}
+        self.types = bytearray()
+        self.n_types = 0
+        # Maps `id(type)` to (type, index) and structural keys to indices
+        self.type_ids = {}
+        self.type_index = {}
+        self.n_modules = 0
+
+    def string(self, s):
+        """
+        Returns the string table index of `s`, adding it if needed.
+        """
+        i = self.string_index.get(s)
+        if i == None:
+            i = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def type(self, t):
+        """
+        Returns the type table index of `t`, adding it (and the types it is
+        built from) if no structurally equal type is in the table yet.
+        """
+        hit = self.type_ids.get(id(t))
+        if hit != None:
+            return hit[1]
+        if isinstance(t, UInt) or isinstance(t, SInt):
+            rec = (T_UINT if isinstance(t, UInt) else T_SINT, t.width)
+        elif isinstance(t, Vec):
+            rec = (T_VEC, t.count, self.type(t.type))
+        elif isinstance(t, Bundle):
+            fields = []
+            for k in t.fields:
+                f = t.fields[k]
+                fields.append((f.orientation, self.string(f.name),
+                               self.type(f.type)))
+            rec = (T_BUNDLE, tuple(fields))
+        else:
+            raise TypeError("can't serialize type " + type(t).__name__)
+        i = self.type_index.get(rec)
+        if i == None:
+            i = self.type_index[rec] = self.n_types
+            self.n_types += 1
+            out = self.types
+            out.append(rec[0])
+            if rec[0] == T_VEC:
+                _uvarint(out, rec[1])
+                _uvarint(out, rec[2])
+            elif rec[0] == T_BUNDLE:
+                _uvarint(out, len(rec[1]))
+                for (orientation, name, ft) in rec[1]:
+                    _uvarint(out, orientation)
+                    _uvarint(out, name)
+                    _uvarint(out, ft)
+            else:
+                self.optional(out, rec[1])
+        self.type_ids[id(t)] = (t, i)
+        return i
+
+    def optional(self, out, n):
+        """
+        Writes the non-negative integer or `None` `n`.
+        """
+        if n == None:
+            out.append(0)
+        else:
+            _uvarint(out, n + 1)
+
+    def info(self, stmt):
+        out = self.body
+        info = stmt.lineInfo
+        if info == None:
+            out.append(0)
+        else:
+            out.append(1)
+            _uvarint(out, self.string(str(info.source)))
+            _uvarint(out, self.string(str(info.module)))
+            _uvarint(out, info.line)
+
+    def expr(self, root):
+        """
+        Writes the expression (or plain field value) `root`.
+        """
+        out = self.body
+        stack = [root]
+        while stack:
+            e = stack.pop()
+            # `==` builds an `Eq` node for expressions
+            if e is None:
+                out.append(E_NONE)
+            elif isinstance(e, (int, long)):
+                out.append(E_INT)
+                _svarint(out, int(e))
+            elif isinstance(e, basestring):
+                out.append(E_STR)
+                _uvarint(out, self.string(e))
+            elif isinstance(e, Lit):
+                out.append(E_LIT)
+                _svarint(out, e.value)
+                self.optional(out, e.width)
+                out.append(1 if e.signed else 0)
+            elif isinstance(e, Id):
+                out.append(E_ID)
+                _uvarint(out, self.string(str(e.__idt__)))
+            elif isinstance(e, SubField):
+                out.append(E_SUBFIELD)
+                _uvarint(out, self.string(str(e.__attr__)))
+                stack.append(e.__base__)
+            elif isinstance(e, SubItem):
+                out.append(E_SUBITEM)
+                stack.append(e.__item__)
+                stack.append(e.__base__)
+            elif isinstance(e, BinExpr) and type(e) in BinaryOps:
+                out.append(BinaryOps[type(e)])
+                stack.append(e.__b__)
+                stack.append(e.__a__)
+            elif isinstance(e, Invert):
+                out.append(E_INVERT)
+                stack.append(e.e)
+            elif isinstance(e, SReg):
+                out.append(E_SREG)
+                stack.append(e.enable)
+                stack.append(e.value)
+            elif isinstance(e, Bits):
+                out.append(E_BITS)
+                stack.append(e.lsb)
+                stack.append(e.msb)
+                stack.append(e.e)
+            elif isinstance(e, Cat):
+                out.append(E_CAT)
+                _uvarint(out, len(e.exprs))
+                stack.extend(reversed(e.exprs))
+            elif isinstance(e, Mux):
+                out.append(E_MUX)
+                stack.append(e.__b__)
+                stack.append(e.__a__)
+                stack.append(e.__sel__)
+            else:
+                raise TypeError("can't serialize expression " +
+                                type(e).__name__)
+
+    def module(self, mdec):
+        """
+        Writes the `ModuleDec` `mdec`.
+        """
+        out = self.body
+        self.n_modules += 1
+        self.expr(mdec.idt)
+        # Modules fresh from the builder still refer to the builder's id
+        self.expr(getattr(mdec.io, "__final__", mdec.io))
+        _uvarint(out, _flat_len(mdec.stmts))
+        stack = list(reversed(mdec.stmts))
+        while stack:
+            s = stack.pop()
+            if isinstance(s, WireDec):
+                out.append(S_WIRE)
+                self.expr(s.idt)
+                _uvarint(out, self.type(s.type))
+            elif isinstance(s, RegDec):
+                out.append(S_REG)
+                self.expr(s.idt)
+                _uvarint(out, self.type(s.type))
+                self.expr(s.onReset)
+            elif isinstance(s, ConnectStmt):
+                out.append(S_CONNECT)
+                self.expr(s.lval)
+                self.expr(s.rval)
+            elif isinstance(s, WhenStmt):
+                out.append(S_WHEN)
+                self.expr(s.cond)
+                _uvarint(out, _flat_len(s.if_stmts))
+                _uvarint(out, _flat_len(s.else_stmts))
+                stack.extend(reversed(s.else_stmts))
+                stack.extend(reversed(s.if_stmts))
+            elif isinstance(s, VecStmt):
+                stack.extend(reversed(s.expand()))
+                continue
+            elif isinstance(s, ModuleInst):
+                out.append(S_INST)
+                self.expr(s.inst_idt)
+                self.expr(s.mod_idt)
+            else:
+                raise TypeError("can't serialize statement " +
+                                type(s).__name__)
+            self.info(s)
+
+    def write(self, stream):
+        """
+        Writes the complete file to `stream`.
+        """
+        head = bytearray(Magic)
+        _uvarint(head, FormatVersion)
+        _uvarint(head, len(self.strings))
+        for s in self.strings:
+            if isinstance(s, unicode):
+                s = s.encode("utf-8")
+            _uvarint(head, len(s))
+            head.extend(s)
+        _uvarint(head, self.n_types)
+        stream.write(head)
+        stream.write(self.types)
+        tail = bytearray()
+        _uvarint(tail, self.n_modules)
+        stream.write(tail)
+        stream.write(self.body)
+
+def dump(mdecs, stream):
+    """
+    Writes the `ModuleDec`s `mdecs` to the binary stream `stream`.
+    """
+    w = Writer()
+    for m in mdecs:
+        w.module(m)
+    w.write(stream)
+
+def dumps(mdecs):
+    """
+    Returns the `ModuleDec`s `mdecs` encoded as a string.
+    """
+    from cStringIO import StringIO
+    buf = StringIO()
+    dump(mdecs, buf)
+    return buf.getvalue()
+
+class Reader(object):
+    """
+    Decodes a file produced by `Writer`.
+    """
+    def __init__(self, data):
+        if data[:len(Magic)] != Magic:
+            raise ValueError("not a PyRRHIC binary IR file")
+        self.buf = bytearray(data)
+        self.make = _constructors()
+        self.pos = len(Magic)
+        version = self.uvarint()
+        if version != FormatVersion:
+            raise ValueError("unsupported PyRRHIC binary IR version %d "
+                             "(expected %d)" % (version, FormatVersion))
+        self.strings = []
+        for i in xrange(self.uvarint()):
+            n = self.uvarint()
+            s = str(self.buf[self.pos:self.pos + n])
+            self.pos += n
+            self.strings.append(s)
+        self.types = []
+        for i in xrange(self.uvarint()):
+            self.types.append(self.read_type())
+
+    def uvarint(self):
+        (n, self.pos) = _read_uvarint(self.buf, self.pos)
+        return n
+
+    def svarint(self):
+        n = self.uvarint()
+        if n & 1:
+            return -((n + 1) >> 1)
+        return n >> 1
+
+    def optional(self):
+        n = self.uvarint()
+        if n == 0:
+            return None
+        return n - 1
+
+    def read_type(self):
+        tag = self.buf[self.pos]
+        self.pos += 1
+        if tag == T_UINT:
+            return UInt(self.optional())
+        elif tag == T_SINT:
+            return SInt(self.optional())
+        elif tag == T_VEC:
+            count = self.uvarint()
+            return Vec(self.types[self.uvarint()], count)
+        elif tag == T_BUNDLE:
+            fields = OrderedDict()
+            for i in xrange(self.uvarint()):
+                orientation = self.uvarint()
+                name = self.strings[self.uvarint()]
+                fields[name] = Field(orientation, name,
+                                     self.types[self.uvarint()])
+            return Bundle(fields)
+        raise ValueError("bad type record %d" % tag)
+
+    def info(self):
+        if self.buf[self.pos] == 0:
+            self.pos += 1
+            return None
+        self.pos += 1
+        from pyrrhic.pyrast import LineInfo
+        info = LineInfo.__new__(LineInfo)
+        source = self.strings[self.uvarint()]
+        module = self.strings[self.uvarint()]
+        info.__setstate__((source, module, self.uvarint()))
+        return info
+
+    def expr(self):
+        """
+        Reads one expression (or plain field value).
+        """
+        # Varints are decoded inline, with `_read_uvarint` only called for
+        # the rare values that take more than one byte.
+        buf = self.buf
+        strings = self.strings
+        make = self.make
+        pos = self.pos
+        op = buf[pos]
+        pos += 1
+        # Identifiers are by far the most common expressions
+        if op == E_ID:
+            n = buf[pos]
+            if n < 0x80:
+                pos += 1
+            else:
+                (n, pos) = _read_uvarint(buf, pos)
+            self.pos = pos
+            return make[E_ID](strings[n])
+        # Partially read nodes: [opcode, operands still needed, operands]
+        frames = []
+        while True:
+            if op == E_ID or op == E_STR or op == E_SUBFIELD or op == E_CAT:
+                n = buf[pos]
+                if n < 0x80:
+                    pos += 1
+                else:
+                    (n, pos) = _read_uvarint(buf, pos)
+                if op == E_ID:
+                    value = make[E_ID](strings[n])
+                elif op == E_STR:
+                    value = strings[n]
+                elif op == E_SUBFIELD:
+                    frames.append([op, 1, [strings[n]]])
+                    value = frames
+                elif n == 0:
+                    value = make[E_CAT]()
+                else:
+                    frames.append([op, n, []])
+                    value = frames
+            elif op == E_LIT or op == E_INT:
+                (n, pos) = _read_uvarint(buf, pos)
+                v = -((n + 1) >> 1) if n & 1 else n >> 1
+                if op == E_INT:
+                    value = v
+                else:
+                    (width, pos) = _read_uvarint(buf, pos)
+                    width = None if width == 0 else width - 1
+                    value = make[E_LIT](v, width, buf[pos] == 1)
+                    pos += 1
+            elif op == E_NONE:
+                value = None
+            elif op < len(Arity) and Arity[op] > 0:
+                frames.append([op, Arity[op], []])
+                value = frames
+            else:
+                raise ValueError("bad expression opcode %d" % op)
+
+            if value is not frames:
+                # `value` is complete; hand it to the enclosing nodes,
+                # building each one whose operands are all there.
+                while frames:
+                    f = frames[-1]
+                    f[2].append(value)
+                    f[1] -= 1
+                    if f[1] > 0:
+                        break
+                    frames.pop()
+                    if f[0] == E_SUBFIELD:
+                        value = make[E_SUBFIELD](f[2][1], f[2][0])
+                    else:
+                        value = make[f[0]](*f[2])
+                else:
+                    self.pos = pos
+                    return value
+            op = buf[pos]
+            pos += 1
+
+    def module(self):
+        """
+        Reads one `ModuleDec`.
+        """
+        buf = self.buf
+        types = self.types
+        idt = self.expr()
+        mdec = ModuleDec(idt, self.expr(), [])
+        # Statement lists being filled, with the number of statements each
+        # still expects; a `when` contributes its else list, then its if
+        # list on top.
+        lists = [[mdec.stmts, self.uvarint()]]
+        while lists:
+            top = lists[-1]
+            if top[1] == 0:
+                lists.pop()
+                continue
+            top[1] -= 1
+            op = buf[self.pos]
+            self.pos += 1
+            if op == S_WIRE:
+                idt = self.expr()
+                s = WireDec(idt, types[self.uvarint()])
+            elif op == S_REG:
+                idt = self.expr()
+                t = types[self.uvarint()]
+                s = RegDec(idt, t, self.expr())
+            elif op == S_CONNECT:
+                lval = self.expr()
+                s = ConnectStmt(lval, self.expr())
+            elif op == S_WHEN:
+                cond = self.expr()
+                n_if = self.uvarint()
+                n_else = self.uvarint()
+                s = WhenStmt(cond, [], [])
+            elif op == S_INST:
+                inst = self.expr()
+                s = ModuleInst(inst, self.expr())
+            else:
+                raise ValueError("bad statement opcode %d" % op)
+            info = self.info()
+            if info != None:
+                s.lineInfo = info
+            top[0].append(s)
+            if op == S_WHEN:
+                lists.append([s.else_stmts, n_else])
+                lists.append([s.if_stmts, n_if])
+        return mdec
+
+    def modules(self):
+        """
+        Reads all the modules of the file.
+        """
+        return [self.module() for i in xrange(self.uvarint())]
+
+def loads(data):
+    """
+    Returns the list of `ModuleDec`s encoded in the string `data`.
+    """
+    return Reader(data).modules()
+
+def load(stream):
+    """
+    Returns the list of `ModuleDec`s read from the binary stream `stream`.
+    """
+    return loads(stream.read())
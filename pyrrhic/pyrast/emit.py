@@ -0,0 +1,120 @@
+"""
+Streaming FIRRTL Emitter.
+
+Writes the FIRRTL text of `ModuleDec` trees directly to a file object, one
+line at a time, instead of building the whole text in memory first.  Nested
+`WhenStmt`s are walked with an explicit stack, so neither the depth of the
+tree nor the size of the output is limited by anything but the stream.
+Bulk `VecStmt`s are expanded into their per-element connections as they
+are written.
+"""
+import gzip, io
+from stmt import *
+
+# Size of the write buffer of streams opened by `open_output`
+BufferSize = 1 << 16
+
+class Emitter(object):
+    """
+    Writes FIRRTL statements to `stream`, which only needs a `write` method.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.write = stream.write
+
+    def emit_stmts(self, stmts, indent = 0):
+        """
+        Writes each statement of `stmts` (and everything nested in it) at the
+        level of indentation specified by `indent`.
+        """
+        write = self.write
+        # Holds (indent, stmt) pairs still to be written, or (indent, str)
+        # pairs for lines with no statement of their own, last one first.
+        stack = [(indent, s) for s in reversed(stmts)]
+        while stack:
+            (ind, s) = stack.pop()
+            if isinstance(s, str):
+                write(TAB*ind + s + "\n")
+            elif isinstance(s, WhenStmt):
+                write(TAB*ind + s.header() + s.info() + "\n")
+                if len(s.else_stmts) > 0:
+                    stack.extend((ind + 1, e) for e in reversed(s.else_stmts))
+                    stack.append((ind, "else:"))
+                stack.extend((ind + 1, e) for e in reversed(s.if_stmts))
+            elif isinstance(s, VecStmt):
+                stack.extend((ind, e) for e in reversed(s.expand()))
+            elif isinstance(s, ModuleDec):
+                write(TAB*ind + s.header() + "\n")
+                stack.extend((ind + 1, e) for e in reversed(s.stmts))
+            else:
+                out = [TAB*ind]
+                s.__emit__(out)
+                out.append(s.info())
+                out.append("\n")
+                write("".join(out))
+
+    def emit_module(self, mdec):
+        """
+        Writes the `ModuleDec` `mdec`.
+        """
+        self.emit_stmts([mdec])
+
+def modules_under(mdecs, top):
+    """
+    Returns, in their original order, the `ModuleDec`s of `mdecs` making up
+    the design rooted at the module named `top`: that module and every
+    module it instantiates, directly or not.  Raises `KeyError` if there is
+    no module named `top`.
+    """
+    by_name = {}
+    for m in mdecs:
+        by_name[str(m.idt)] = m
+    if top not in by_name:
+        raise KeyError("no module named " + top)
+    keep = set([top])
+    work = [by_name[top]]
+    while work:
+        stack = list(work.pop().stmts)
+        while stack:
+            s = stack.pop()
+            if isinstance(s, ModuleInst):
+                name = str(s.mod_idt)
+                if name not in keep and name in by_name:
+                    keep.add(name)
+                    work.append(by_name[name])
+            elif isinstance(s, WhenStmt):
+                stack.extend(s.if_stmts)
+                stack.extend(s.else_stmts)
+    return [m for m in mdecs if str(m.idt) in keep]
+
+def write_output(path, mdecs):
+    """
+    Writes the `ModuleDec`s `mdecs` to the file `path`: in the binary format
+    of `binary.py` if it ends in ``.pyrb``, and as text otherwise (see
+    `open_output`).
+    """
+    if path.endswith(".pyrb"):
+        import binary
+        out = open(path, "wb", BufferSize)
+        try:
+            binary.dump(mdecs, out)
+        finally:
+            out.close()
+        return
+    out = open_output(path)
+    try:
+        emitter = Emitter(out)
+        for mdec in mdecs:
+            emitter.emit_module(mdec)
+            out.write("\n")
+    finally:
+        out.close()
+
+def open_output(path):
+    """
+    Opens `path` for writing emitted FIRRTL through a write buffer.  Paths
+    ending in ``.gz`` are compressed with gzip.
+    """
+    if path.endswith(".gz"):
+        return io.BufferedWriter(gzip.open(path, "wb"), BufferSize)
+    return open(path, "wb", BufferSize)
@@ -1,12 +1,120 @@
 
 
+import weakref
+from pyrtype import Bundle, Vec
+
+# Maps structural keys to live, hash-consed expression nodes while
+# hash-consing is enabled, and is `None` otherwise.
+_intern_table = None
+
+def enable_hash_consing():
+    """
+    Makes structurally equal expressions constructed from now on share a
+    single node.  Interned nodes are held weakly, so the table never keeps
+    an expression alive by itself.  This holds for every thread, and so for
+    every `ElaborationSession` of the process.
+    """
+    global _intern_table
+    if _intern_table == None:
+        _intern_table = weakref.WeakValueDictionary()
+
+def disable_hash_consing():
+    """
+    Stops interning newly constructed expressions.  Nodes interned so far
+    stay shared.
+    """
+    global _intern_table
+    _intern_table = None
+
+def _ref(value):
+    """
+    Returns the part of an intern key standing for field value `value`.
+    Children are themselves interned, so they are identified by `id()`; an
+    interned node keeps its children alive, so their ids can't be reused
+    while its key is in the table.
+    """
+    if isinstance(value, Expr):
+        return id(value)
+    if isinstance(value, (list, tuple)):
+        return tuple([_ref(v) for v in value])
+    return (type(value), value)
+
+class ExprBuilder(type):
+    """
+    Metaclass of `Expr` types, returning the existing node for structurally
+    equal expressions of hash-consed types while hash-consing is enabled.
+    """
+    def __call__(cls, *args, **kwargs):
+        node = type.__call__(cls, *args, **kwargs)
+        table = _intern_table
+        if table == None or not cls.__hash_consed__:
+            return node
+        try:
+            key = node.__intern_key__()
+            existing = table.get(key)
+        except TypeError:
+            # Some field isn't hashable; leave this node alone
+            return node
+        if existing != None:
+            return existing
+        node.__interned__ = True
+        table[key] = node
+        return node
+
+def same_expr(a, b):
+    """
+    Returns `True` iff `a` and `b` are structurally equal expressions (or
+    equal non-expression field values).  Two distinct hash-consed nodes are
+    never equal, so comparing those takes constant time.
+    """
+    stack = [(a, b)]
+    while stack:
+        (a, b) = stack.pop()
+        if a is b:
+            continue
+        if not isinstance(a, Expr) or not isinstance(b, Expr):
+            if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+                if len(a) != len(b):
+                    return False
+                stack.extend(zip(a, b))
+                continue
+            if isinstance(a, Expr) or isinstance(b, Expr):
+                return False
+            if type(a) != type(b) or not a == b:
+                return False
+            continue
+        if type(a) != type(b) or (getattr(a, "__interned__", False) and
+                                  getattr(b, "__interned__", False)):
+            return False
+        for f in a.__fields__:
+            stack.append((getattr(a, f), getattr(b, f)))
+    return True
+
 class Expr(object):
     """PyRRHIC Expression AST"""
+    __metaclass__ = ExprBuilder
     __line_info__ = None
 
     # Set to true if no parentheses are needed around this expression
     __is_single_term__ = False
 
+    # Names of the attributes holding this node's contents, in order.
+    # Nodes are numerous, so every subclass declares its fields as
+    # `__slots__` rather than carrying a `__dict__`.
+    __fields__ = ()
+    __slots__ = ("__weakref__", "__interned__")
+
+    # Set to true for node types shared between equal expressions while
+    # hash-consing is enabled.  `__interned__` is only set (by `ExprBuilder`,
+    # to true) on the nodes that actually are shared, and is unset on others.
+    __hash_consed__ = False
+
+    # Set to true for node types with a `__type__` slot, holding their
+    # (lowered) type once known; see `resolve_type`.  Other nodes' types are
+    # never known.
+    __typed__ = False
+    __type__ = None
+
     def __add__(self, other):
         return Add(self, other)
 
@@ -29,198 +137,493 @@ class Expr(object):
         return Lt(self, other)
 
     def __getattr__(self, attr):
-        if len(attr) > 2 and attr[0:1] == "__":
-            return super(self, object).__getattr__(attr)
-        else:
-            return SubField(self, attr)
+        # Special names (`__getstate__`, `__deepcopy__`, ...) looked up by
+        # `pickle`, `copy` and friends must not turn into fields.
+        if len(attr) > 2 and attr[0:2] == "__":
+            raise AttributeError(attr)
+        t = resolve_type(self)
+        if t != None and (not isinstance(t, Bundle) or t.field(attr) == None):
+            raise AttributeError("%s of type %s has no field %s" % \
+                                 (self, t, attr))
+        return SubField(self, attr)
   
     def __getitem__(self, item):
+        t = resolve_type(self)
+        if t != None and not isinstance(t, Vec):
+            raise TypeError("%s of type %s is not a vector" % (self, t))
         return SubItem(self, item)
 
+    def __str__(self):
+        out = []
+        self.__emit__(out)
+        return "".join(out)
+
+    def __tokens__(self):
+        """
+        Returns the pieces making up the string representation of this
+        expression: strings, or sub-expressions to be emitted in their
+        place.  Subclasses override either this or `__str__`.
+        """
+        return [str(self)]
+
+    def __emit__(self, out):
+        """
+        Appends the string tokens making up the representation of this
+        expression to the list `out`.  Sub-expressions are expanded with an
+        explicit stack, so the string is joined only once and the depth of
+        the expression doesn't matter.
+        """
+        stack = [self]
+        while stack:
+            t = stack.pop()
+            if isinstance(t, str):
+                out.append(t)
+            elif isinstance(t, Expr):
+                stack.extend(reversed(t.__tokens__()))
+            else:
+                out.append(str(t))
+
+    def __emit_parens__(self, out):
+        """
+        Like `__emit__`, but adds parentheses around the expression if it is
+        not a single term.
+        """
+        if self.__is_single_term__:
+            self.__emit__(out)
+        else:
+            out.append("(")
+            self.__emit__(out)
+            out.append(")")
+
     def __parens__(self):
         """
         Adds parentheses around the string representation of this expression
         if it is not a literal.  Used in larger composite expressions' string
         representations.
         """
-        if self.__is_single_term__:
-            return str(self)
-        else:
-            return "("+str(self)+")"
+        out = []
+        self.__emit_parens__(out)
+        return "".join(out)
+
+    def __intern_key__(self):
+        """
+        Returns a hashable key equal for structurally equal nodes.
+        """
+        return (type(self),) + tuple([_ref(getattr(self, f)) for f in self.__fields__])
+
+    def __rebuild__(self, values):
+        """
+        Returns a new node of this type holding the field values `values`,
+        given in the order of `__fields__`.
+        """
+        return type(self)(*values)
 
     def __traverse__(self, func):
         """
-        Performs a pre-order traversal of this `Expr` AST and applies `func`
+        Performs a post-order traversal of this `Expr` AST and applies `func`
         to each node encountered along the way, replacing it with the
-        result returned by `func`.
+        result returned by `func`.  See `Rewriter`.
 
-        Note that this function modifies the AST on which it operates.
+        Note that this function modifies the AST on which it operates,
+        except for hash-consed nodes, which may be shared and are rebuilt
+        instead when their children change.
+        """
+        return Rewriter(post = func).rewrite(self)
+
+def _parens(e):
+    """
+    Returns the tokens for `e` surrounded by parentheses if it is not a
+    single term, for use in `__tokens__`.
+    """
+    if isinstance(e, Expr) and not e.__is_single_term__:
+        return ["(", e, ")"]
+    return [e]
+
+def emit_expr(value, out):
+    """
+    Appends the string representation of `value` to the token list `out`,
+    going through `Expr.__emit__` for expressions.
+    """
+    if isinstance(value, Expr):
+        value.__emit__(out)
+    else:
+        out.append(str(value))
+
+def expr_children(node):
+    """
+    Returns the sub-expressions of `node`, in the order of its `__fields__`.
+    Fields holding lists or tuples (like `Cat.exprs`) contribute each of
+    their expression elements.
+    """
+    res = []
+    for f in node.__fields__:
+        v = getattr(node, f)
+        if isinstance(v, Expr):
+            res.append(v)
+        elif isinstance(v, (list, tuple)):
+            for x in v:
+                if isinstance(x, Expr):
+                    res.append(x)
+    return res
+
+def replace_expr_children(node, new, rebuild = False):
+    """
+    Returns `node` with its sub-expressions (as listed by `expr_children`)
+    replaced by the ones in `new`.  Nodes are updated in place, except for
+    hash-consed ones, and for every node if `rebuild` is true, which are
+    rebuilt with `__rebuild__`.
+    """
+    it = iter(new)
+    values = []
+    for f in node.__fields__:
+        v = getattr(node, f)
+        if isinstance(v, Expr):
+            v = next(it)
+        elif isinstance(v, (list, tuple)):
+            v = type(v)([next(it) if isinstance(x, Expr) else x for x in v])
+        values.append(v)
+    if rebuild or getattr(node, "__interned__", False):
+        return node.__rebuild__(values)
+    for (f, v) in zip(node.__fields__, values):
+        setattr(node, f, v)
+    return node
+
+def resolve_type(e):
+    """
+    Returns the (lowered) type of the expression `e`, or `None` if it isn't
+    known.  Types are known for typed nodes given one when they were made
+    (like the ids of declarations), and for `SubField` and `SubItem` paths
+    into those.  The type of each node along a path is cached on it, so
+    resolving ``io.input.data`` only looks up ``data`` in the field index
+    of the type of ``io.input``, once.
+    """
+    path = []
+    t = e.__type__
+    while t == None:
+        if not isinstance(e, (SubField, SubItem)):
+            return None
+        path.append(e)
+        e = e.__base__
+        t = e.__type__
+    while path:
+        e = path.pop()
+        if isinstance(e, SubField):
+            if not isinstance(t, Bundle):
+                return None
+            info = t.field(e.__attr__)
+            if info == None:
+                return None
+            t = info.type
+        else:
+            if not isinstance(t, Vec):
+                return None
+            t = t.type
+        e.__type__ = t
+    return t
+
+def walk_expr(root):
+    """
+    Yields every node of the expression `root` in pre-order, without
+    recursion.  Nodes shared between several parents are yielded once per
+    parent.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(expr_children(node)))
+
+class Rewriter(object):
+    """
+    Rewrites expression trees of any depth using an explicit stack.
+
+    `pre(node)`, if given, is applied to each node before its children are
+    visited, and the children of the node it returns are visited instead.
+    `post(node)`, if given, is applied once the node's children have been
+    rewritten.  Either function returns the node to use in place of its
+    argument (possibly the argument itself).
+
+    Results are remembered per node for the lifetime of the `Rewriter`, so a
+    single one can be used to rewrite every expression of a module in one
+    batch, with subexpressions shared between statements (as with
+    hash-consing) only rewritten once.
+    """
+    def __init__(self, post = None, pre = None):
+        self.post = post
+        self.pre = pre
+        # Maps `id(node)` to (node, result); the node is kept so that its id
+        # can't be reused while the entry exists.
+        self.memo = {}
+
+    def rewrite(self, root):
+        """
+        Returns the rewritten form of the expression `root`.  Values other
+        than expressions are returned unchanged.
         """
-        return func(self)
+        if not isinstance(root, Expr):
+            return root
+        pre = self.pre
+        post = self.post
+        memo = self.memo
+        # Rewritten nodes, waiting to be collected by their parents
+        done = []
+        # (node, original, children) entries; `children` is `None` until the
+        # node's children have been pushed.
+        stack = [(root, root, None)]
+        while stack:
+            (node, orig, kids) = stack.pop()
+            if kids == None:
+                m = memo.get(id(orig))
+                if m != None:
+                    done.append(m[1])
+                    continue
+                if pre != None:
+                    node = pre(node)
+                kids = expr_children(node) if isinstance(node, Expr) else []
+                stack.append((node, orig, kids))
+                for k in reversed(kids):
+                    stack.append((k, k, None))
+                continue
+            if kids:
+                new = done[len(done) - len(kids):]
+                del done[len(done) - len(kids):]
+                for (k, n) in zip(kids, new):
+                    if k is not n:
+                        node = replace_expr_children(node, new)
+                        break
+            if post != None:
+                node = post(node)
+            memo[id(orig)] = (orig, node)
+            done.append(node)
+        return done[0]
 
 class Lit(Expr):
     """PyRRHIC Literal Expression"""
     __is_single_term__ = True
+    __fields__ = __slots__ = ("value", "width", "signed")
+    __hash_consed__ = True
 
     def __init__(self, value, width = None, signed = False):
         self.value = value
         self.width = width
         self.signed = signed
 
-    def __str__(self):
-        return str(self.value)
+    def __tokens__(self):
+        return [str(self.value)]
 
 
 class Id(Expr):
     __is_single_term__ = True
+    __fields__ = __slots__ = ("__idt__",)
+    __hash_consed__ = True
 
     def __init__(self, idt):
         self.__idt__ = idt
 
-    def __str__(self):
-        return str(self.__idt__)
+    def __tokens__(self):
+        return [str(self.__idt__)]
     def __repr__(self):
         return str(self.__idt__)
 
+class Index(Expr):
+    """
+    Stands for the element index in the template expression of a
+    `stmt.ForEachStmt`; see `IndexTemplate`.
+    """
+    __is_single_term__ = True
+    __slots__ = ()
+
+    def __tokens__(self):
+        return ["i"]
+
+class IndexTemplate(object):
+    """
+    An expression containing `Index` nodes, prepared to be bound to many
+    indices: the nodes with an `Index` below them are found once, and `bind`
+    only rebuilds those.  The expression itself is never modified, and its
+    subtrees without an `Index` are shared by every bound copy.
+    """
+    __slots__ = ("root", "path")
+
+    def __init__(self, root):
+        self.root = root
+        # Nodes containing an `Index` (or being one), children first
+        self.path = []
+        contains = {}
+        stack = [(root, False)]
+        while stack:
+            (node, visited) = stack.pop()
+            if not visited:
+                if id(node) in contains:
+                    continue
+                contains[id(node)] = False
+                stack.append((node, True))
+                stack.extend((k, False) for k in expr_children(node))
+                continue
+            if isinstance(node, Index) or \
+               any(contains[id(k)] for k in expr_children(node)):
+                contains[id(node)] = True
+                self.path.append(node)
+
+    def bind(self, i):
+        """
+        Returns a copy of the expression with every `Index` replaced by the
+        literal `i`.
+        """
+        if not self.path:
+            return self.root
+        lit = Lit(i)
+        new = {}
+        for node in self.path:
+            if isinstance(node, Index):
+                new[id(node)] = lit
+            else:
+                kids = [new.get(id(k), k) for k in expr_children(node)]
+                new[id(node)] = replace_expr_children(node, kids, True)
+        return new[id(self.root)]
+
 class SubField(Expr):
     __is_single_term__ = True
+    __fields__ = ("__base__", "__attr__")
+    __slots__ = __fields__ + ("__type__",)
+    __hash_consed__ = True
+    __typed__ = True
 
     def __init__(self, base, attr):
         self.__base__ = base
         self.__attr__ = attr
+        self.__type__ = None
 
-    def __traverse__(self, func):
-        self.__base__ = self.__base__.__traverse__(func)
-        return func(self)
-
-    def __str__(self):
-        return str(self.__base__) + "." + str(self.__attr__)
+    def __tokens__(self):
+        return [self.__base__, ".", str(self.__attr__)]
 
     def __repr__(self):
         return self.__str__()
 
 class SubItem(Expr):
+    __fields__ = ("__base__", "__item__")
+    __slots__ = __fields__ + ("__type__",)
+    __hash_consed__ = True
+    __typed__ = True
+
     def __init__(self, base, item):
         self.__base__ = base
         self.__item__ = item
+        self.__type__ = None
 
-    def __traverse__(self, func):
-        self.__base__ = self.__base__.__traverse__(func)
-        self.__item__ = self.__item__.__traverse__(func)
-        return func(self)
+    def __tokens__(self):
+        return [self.__base__, "[", self.__item__, "]"]
 
     def __repr__(self):
-        return str(self.__base__) + "[" + str(self.__item__) + "]"
+        return self.__str__()
 
 class BinExpr(Expr):
+    __fields__ = __slots__ = ("__a__", "__b__")
+    __hash_consed__ = True
+
     def __init__(self, a, b):
         self.__a__ = a
         self.__b__ = b
 
-    def __str__(self):
-        return self.__a__.__parens__() + " " + self.__symbol__ + " " + self.__b__.__parens__()
-
-    def __traverse__(self, func):
-        self.__a__ = self.__a__.__traverse__(func)
-        self.__b__ = self.__b__.__traverse__(func)
-        return func(self)
+    def __tokens__(self):
+        return _parens(self.__a__) + [" " + self.__symbol__ + " "] + _parens(self.__b__)
 
 class Add(BinExpr):
+    __slots__ = ()
     __symbol__ = "+"
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class Sub(BinExpr):
+    __slots__ = ()
     __symbol__ = "-"
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class UnExpr(Expr):
     __is_single_term__ = True
+    __fields__ = __slots__ = ("e",)
+    __hash_consed__ = True
     def __init__(self, e):
         self.e = e
-    def __str__(self):
-        return self.__symbol__ + self.e.__parens__()
-    def __traverse__(self, func):
-        self.e = self.e.__traverse__(func)
-        return func(self)
+    def __tokens__(self):
+        return [self.__symbol__] + _parens(self.e)
 
 class Invert(UnExpr):
+    __slots__ = ()
     __symbol__ = "~"
     def __init__(self, e):
         UnExpr.__init__(self, e)
 
 class SReg(Expr):
+    __fields__ = __slots__ = ("value", "enable")
     def __init__(self, value, enable = None):
         self.value = value
         self.enable = enable
-    def __str__(self):
+    def __tokens__(self):
         if self.enable != None:
-            return "Reg("+str(self.value)+", "+str(self.enable)+")"
+            return ["Reg(", self.value, ", ", self.enable, ")"]
         else:
-            return "Reg("+str(self.value)+")"
-    def __traverse__(self, func):
-        self.value = self.value.__traverse__(func)
-        return func(self)
+            return ["Reg(", self.value, ")"]
 
 class Bits(Expr):
+    __fields__ = __slots__ = ("e", "msb", "lsb")
+    __hash_consed__ = True
     def __init__(self, e, msb, lsb):
         self.e = e
         self.msb = msb
         self.lsb = lsb
 
-    def __str__(self):
-        return self.e.__parens__() + "[" + str(self.msb) + ":" + str(self.lsb) + "]"
-    def __traverse__(self, func):
-        self.e = self.e.__traverse__(func)
-        return func(self)
+    def __tokens__(self):
+        return _parens(self.e) + ["[" + str(self.msb) + ":" + str(self.lsb) + "]"]
 
 class Cat(Expr):
+    __fields__ = __slots__ = ("exprs",)
+    __hash_consed__ = True
     def __init__(self, *args):
         self.exprs = args
-    def __str__(self):
-        res = self.exprs[0]
-        for s in self.exprs[1:]:
-            res += ", " + str(s)
-        return "Cat("+res+")"
-    def __traverse__(self, func):
-        newExprs = []
-        for e in self.exprs:
-            newExprs += [e.__traverse__(func)]
-        self.exprs = newExprs
-        return func(self)
+    def __tokens__(self):
+        res = ["Cat("]
+        for (i, e) in enumerate(self.exprs):
+            if i > 0:
+                res.append(", ")
+            res.append(e)
+        res.append(")")
+        return res
+    def __rebuild__(self, values):
+        return Cat(*values[0])
 
 class Eq(BinExpr):
+    __slots__ = ()
     __symbol__ = "=="
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class Neq(BinExpr):
+    __slots__ = ()
     __symbol__ = "!="
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class Lt(BinExpr):
+    __slots__ = ()
     __symbol__ = "<"
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class Gt(BinExpr):
+    __slots__ = ()
     __symbol__ = ">"
     def __init__(self, a, b):
         BinExpr.__init__(self, a, b)
 
 class Mux(Expr):
+    __fields__ = __slots__ = ("__sel__", "__a__", "__b__")
+    __hash_consed__ = True
     def __init__(self, sel, a, b):
         self.__a__ = a
         self.__b__ = b
         self.__sel__ = sel
 
-    def __str__(self):
-        return "Mux(" + str(self.__sel__) + ", " + str(self.__a__) + ", " + str(self.__b__) + ")"
-
-    def __traverse__(self, func):
-        self.__sel__ = self.__sel__.__traverse__(func)
-        self.__a__ = self.__a__.__traverse__(func)
-        self.__b__ = self.__b__.__traverse__(func)
-        return func(self)
+    def __tokens__(self):
+        return ["Mux(", self.__sel__, ", ", self.__a__, ", ", self.__b__, ")"]
@@ -2,11 +2,16 @@
 PyRRHIC Type System AST
 """
 
-class Type:
+class Type(object):
+    # Type nodes declare their fields as `__slots__` to avoid carrying a
+    # per-instance `__dict__`
+    __slots__ = ()
+
     def __as_lower_type__(self):
         return self
         
 class UInt(Type):
+    __slots__ = ("width",)
     def __init__(self, width = None):
         self.width = width
 
@@ -14,6 +19,7 @@ class UInt(Type):
         return "UInt<"+str(self.width)+">"
 
 class SInt(Type):
+    __slots__ = ("width",)
     def __init__(self, width = None):
         self.width = width
 
@@ -21,19 +27,81 @@ class SInt(Type):
         return "SInt<"+str(self.width)+">"
 
         
+class FieldInfo(object):
+    """
+    Entry of the field index of a `Bundle`: the type and orientation of a
+    field, and its position among the `Field`s of the bundle, which
+    `offset` is computed from.  Fields are laid out in order, the first one
+    in the most significant bits.
+    """
+    __slots__ = ("type", "orientation", "fields", "position", "__offset__")
+
+    def __init__(self, type, orientation, fields, position):
+        self.type = type
+        self.orientation = orientation
+        self.fields = fields
+        self.position = position
+        self.__offset__ = None
+
+    @property
+    def offset(self):
+        """
+        The offset of the field's least significant bit within the bundle,
+        or `None` while the widths of the fields after it are unknown.
+        """
+        if self.__offset__ == None:
+            offset = 0
+            for f in self.fields[self.position + 1:]:
+                w = f.type.width
+                if w == None:
+                    return None
+                offset += w
+            self.__offset__ = offset
+        return self.__offset__
+
 class Bundle(Type):
+    __slots__ = ("fields", "__width__", "__by_name__")
     def __init__(self, fields):
         self.fields = fields
-        self.width = 0
-        for k in self.fields:
-            field = self.fields[k]
-            self.width += field.type.width
-    
+        # Computed when first asked for, since field widths may not have
+        # been inferred yet
+        self.__width__ = None
+        # Maps field names to `FieldInfo`s; built by `field`
+        self.__by_name__ = None
+
+    @property
+    def width(self):
+        """
+        The total width of the fields, or `None` while any of them is
+        unknown.
+        """
+        if self.__width__ == None:
+            width = 0
+            for k in self.fields:
+                w = self.fields[k].type.width
+                if w == None:
+                    return None
+                width += w
+            self.__width__ = width
+        return self.__width__
+
+    def field(self, name):
+        """
+        Returns the `FieldInfo` of the field named `name`, or `None` if there
+        is no such field.
+        """
+        index = self.__by_name__
+        if index == None:
+            index = {}
+            fields = self.fields.values()
+            for (i, f) in enumerate(fields):
+                index[f.name] = FieldInfo(f.type, f.orientation, fields, i)
+            self.__by_name__ = index
+        return index.get(name)
+
     def __as_lower_type__(self):
-        fields = {}
-        for k in self.fields:
-            fields[k] = self.fields[k].__as_lower_type__()
-        return Bundle(fields)
+        # Fields are lowered when they are made
+        return self
  
     def __str__(self):
         res = "{ "
@@ -44,7 +112,8 @@ class Bundle(Type):
         res += " }"
         return res
 
-class Field:
+class Field(object):
+    __slots__ = ("orientation", "name", "type")
     Default, Reverse = range(2)
     orientations = { Default: "default", Reverse: "reverse" }
 
@@ -54,23 +123,42 @@ class Field:
         self.type = type.__as_lower_type__()
         
     def __as_lower_type__(self):
-        return Field(orientation = self.orientation, name = self.name, type = self.type.__as_lower_type__())
+        return self
 
     def __str__(self):
         orient = self.orientations[self.orientation]
         return orient + " " + str(self.name) + " : "+ str(self.type)
     
 class Vec(Type):
+    __slots__ = ("type", "count")
     def __init__(self, type, count):
         self.type = type.__as_lower_type__()
         self.count = count
-        self.width = self.type.width * count
+
+    @property
+    def width(self):
+        """
+        The total width of the elements, or `None` while theirs is unknown.
+        """
+        w = self.type.width
+        if w == None:
+            return None
+        return w * self.count
+
+    def offset(self, i):
+        """
+        Returns the offset of the least significant bit of element `i`, or
+        `None` while the element width is unknown.  Element 0 is the least
+        significant.
+        """
+        w = self.type.width
+        if w == None:
+            return None
+        return i * w
     
     def __as_lower_type__(self):
-        return Vec(type = self.type.__as_lower_type__(), count = self.count)
+        # The element type is lowered when the vector is made
+        return self
 
     def __str__(self):
         return "Vec<"+str(self.count)+">("+str(self.type)+")"
-    
-    
-    
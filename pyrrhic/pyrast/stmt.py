@@ -1,89 +1,277 @@
+from cStringIO import StringIO
+from expr import Expr, Rewriter, emit_expr, Lit, SubItem, IndexTemplate
 TAB = "  "
 
 class Stmt(object):
     """
     PyRRHIC Statement AST Nodes
     """
-    lineInfo = None
     __isBuilderStmt__ = False
+    # Statement nodes declare their fields as `__slots__` to avoid carrying
+    # a per-instance `__dict__`
+    __slots__ = ("__line_info__",)
+
+    # Names of the attributes holding expressions, and of those holding
+    # nested statements (or lists of them), as used by `rewrite_stmts`
+    __exprs__ = ()
+    __bodies__ = ()
+
+    @property
+    def lineInfo(self):
+        """
+        The `LineInfo` of the PyRRHIC source this statement came from, or
+        `None` if source locations weren't captured.
+        """
+        try:
+            return self.__line_info__
+        except AttributeError:
+            return None
+
+    @lineInfo.setter
+    def lineInfo(self, info):
+        self.__line_info__ = info
+
+    def info(self):
+        """
+        Returns this statement's source location as a FIRRTL-style
+        ``@[file line]`` annotation (with a leading space), or an empty
+        string if there is none.
+        """
+        info = self.lineInfo
+        if info == None:
+            return ""
+        return " @[" + str(info) + "]"
+
+    def __emit__(self, out):
+        """
+        Appends the tokens making up this statement's line of FIRRTL code
+        (without indentation or source location) to the list `out`.
+        """
+        out.append(str(self))
+
+    def __joined__(self):
+        out = []
+        self.__emit__(out)
+        return "".join(out)
 
     def firrtl_lines(self, indent=0):
         """
         Returns a list of strings containing the FIRRTL code for this statement
-        at the level of indentation specified by `indent`.
+        at the level of indentation specified by `indent`.  Use
+        `emit.Emitter` to write large trees to a stream instead.
         """
-        return [TAB*indent + str(self)]
+        from emit import Emitter
+        buf = StringIO()
+        Emitter(buf).emit_stmts([self], indent)
+        return buf.getvalue().splitlines()
+
+def walk_stmts(stmts):
+    """
+    Yields every statement of `stmts` and of the bodies nested in them, in
+    pre-order, without recursion.  Each `VecStmt` is followed by the
+    per-element statements it expands to.
+    """
+    stack = list(reversed(stmts))
+    while stack:
+        s = stack.pop()
+        if s == None:
+            continue
+        yield s
+        if isinstance(s, VecStmt):
+            stack.extend(reversed(s.expand()))
+        for f in reversed(s.__bodies__):
+            b = getattr(s, f)
+            if isinstance(b, list):
+                stack.extend(reversed(b))
+            else:
+                stack.append(b)
+
+def rewrite_stmts(stmts, post = None, pre = None):
+    """
+    Rewrites every expression of the statements `stmts`, including those of
+    nested statements, in one batch with a single `Rewriter` (see there for
+    the meaning of `post` and `pre`).  Statements are updated in place.
+    `VecStmt`s are rewritten in their bulk form, so a template is rewritten
+    once for all of its elements.
+    """
+    rw = Rewriter(post, pre)
+    stack = list(reversed(stmts))
+    while stack:
+        s = stack.pop()
+        if s == None:
+            continue
+        for f in s.__exprs__:
+            e = getattr(s, f)
+            if isinstance(e, Expr):
+                setattr(s, f, rw.rewrite(e))
+            elif isinstance(e, list):
+                setattr(s, f, [rw.rewrite(x) for x in e])
+        for f in reversed(s.__bodies__):
+            b = getattr(s, f)
+            if isinstance(b, list):
+                stack.extend(reversed(b))
+            else:
+                stack.append(b)
+    return rw
 
 class WireDec(Stmt):
+    __slots__ = ("idt", "type")
+    __exprs__ = ("idt",)
     def __init__(self, idt, type):
         self.idt = idt
         self.type = type
 
+    def __emit__(self, out):
+        out.append("wire ")
+        emit_expr(self.idt, out)
+        out.append(" : " + str(self.type))
+
     def __str__(self):
-        return "wire " + str(self.idt) + " : " + str(self.type)
+        return self.__joined__()
   
 class RegDec(Stmt):
+    __slots__ = ("idt", "type", "onReset")
+    __exprs__ = ("idt", "onReset")
     def __init__(self, idt, type, onReset = None):
         self.idt = idt
         self.type = type
         self.onReset = onReset
-    def __str__(self):
-        res = "reg " + str(self.idt) + " : " + str(self.type)
+    def __emit__(self, out):
+        out.append("reg ")
+        emit_expr(self.idt, out)
+        out.append(" : " + str(self.type))
         if self.onReset != None:
-            res += " [" + str(self.onReset)+ "]"
-        return res
+            out.append(" [")
+            emit_expr(self.onReset, out)
+            out.append("]")
+
+    def __str__(self):
+        return self.__joined__()
         
 class ConnectStmt(Stmt):
+    __slots__ = ("lval", "rval")
+    __exprs__ = ("lval", "rval")
     def __init__(self, lval, rval):
         self.lval = lval
         self.rval = rval
         
+    def __emit__(self, out):
+        emit_expr(self.lval, out)
+        out.append(" := ")
+        emit_expr(self.rval, out)
+
+    def __str__(self):
+        return self.__joined__()
+
+class VecStmt(Stmt):
+    """
+    Connects each of the `count` elements of the vector `lval` in one
+    statement.  The per-element `ConnectStmt`s are only made by `expand`,
+    when an emitter or pass needs them.
+    """
+    __slots__ = ("lval", "count")
+
+    def values(self):
+        """
+        Returns a list of the expressions connected to each element.
+        """
+        raise AssertionError("Not implemented...")
+
+    def expand(self):
+        """
+        Returns a new list of the per-element `ConnectStmt`s of this
+        statement, each carrying its source location.
+        """
+        res = []
+        info = self.lineInfo
+        for (i, v) in enumerate(self.values()):
+            c = ConnectStmt(SubItem(self.lval, Lit(i)), v)
+            if info != None:
+                c.lineInfo = info
+            res.append(c)
+        return res
+
     def __str__(self):
-        return str(self.lval) + " := " + str(self.rval)
+        return self.__joined__()
+
+class ForEachStmt(VecStmt):
+    """
+    ``lval[i] := template`` for every element `i`, where each `expr.Index`
+    in `template` stands for `i`.
+    """
+    __slots__ = ("template",)
+    __exprs__ = ("lval", "template")
+    def __init__(self, lval, count, template):
+        self.lval = lval
+        self.count = count
+        self.template = template
+
+    def values(self):
+        template = IndexTemplate(self.template)
+        return [template.bind(i) for i in xrange(self.count)]
+
+    def __emit__(self, out):
+        out.append("foreach i < " + str(self.count) + ": ")
+        emit_expr(self.lval, out)
+        out.append("[i] := ")
+        emit_expr(self.template, out)
+
+class ConnectEachStmt(VecStmt):
+    """
+    ``lval[i] := rvals[i]`` for every element `i`.
+    """
+    __slots__ = ("rvals",)
+    __exprs__ = ("lval", "rvals")
+    def __init__(self, lval, rvals):
+        self.lval = lval
+        self.count = len(rvals)
+        self.rvals = rvals
+
+    def values(self):
+        return self.rvals
+
+    def __emit__(self, out):
+        emit_expr(self.lval, out)
+        out.append(" := [")
+        for (i, e) in enumerate(self.rvals):
+            if i > 0:
+                out.append(", ")
+            emit_expr(e, out)
+        out.append("]")
 
 class WhenStmt(Stmt):
+  __slots__ = ("cond", "if_stmts", "else_stmts")
+  __exprs__ = ("cond",)
+  __bodies__ = ("if_stmts", "else_stmts")
   def __init__(self, cond, if_stmts, else_stmts):
       self.cond = cond
       self.if_stmts = if_stmts
       self.else_stmts = else_stmts
 
-  def firrtl_lines(self, indent=0):
-      lines = []
-      
-      lines.append(TAB*indent + "when " + str(self.cond) + ":")
-      for s in self.if_stmts:
-          lines += s.firrtl_lines(indent + 1)
-      if len(self.else_stmts) > 0:
-          lines.append(TAB*indent + "else:")
-          for s in self.else_stmts:
-              lines += s.firrtl_lines(indent + 1)
+  def header(self):
+      return "when " + str(self.cond) + ":"
 
-      return lines
-            
 
 class ModuleDec(Stmt):
+    __slots__ = ("idt", "io", "stmts")
+    __bodies__ = ("stmts",)
     def __init__(self, idt, io, stmts):
         self.idt = idt
         self.io = io
         self.stmts = stmts
 
     def __str__(self):
-      lines = self.firrtl_lines()
-      res = ""
-      for l in lines:
-        res += l + "\n"
-      return res
-
-    def firrtl_lines(self, indent=0):
-        lines = []
-
-        lines.append(TAB*indent + "module " + str(self.idt) + ":")
-        for s in self.stmts:
-          lines += s.firrtl_lines(indent + 1)
+      from emit import Emitter
+      buf = StringIO()
+      Emitter(buf).emit_module(self)
+      return buf.getvalue()
 
-        return lines
+    def header(self):
+      return "module " + str(self.idt) + ":"
 
 class ModuleInst(Stmt):
+    __slots__ = ("inst_idt", "mod_idt")
+    __exprs__ = ("inst_idt",)
     def __init__(self, inst_idt, mod_idt):
       """
       Parameters
@@ -94,5 +282,11 @@ class ModuleInst(Stmt):
       self.inst_idt = inst_idt
       self.mod_idt = mod_idt
      
+    def __emit__(self, out):
+      out.append("inst ")
+      emit_expr(self.inst_idt, out)
+      out.append(" : ")
+      emit_expr(self.mod_idt, out)
+
     def __str__(self):
-      return "inst " + str(self.inst_idt) + " : " + str(self.mod_idt)
+      return self.__joined__()
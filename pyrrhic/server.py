@@ -0,0 +1,255 @@
+"""
+Long-Running Compile Server.
+
+Keeps PyRRHIC imported and instrumented code cached in memory, and serves
+elaboration requests over a Unix domain socket so that each compile only
+pays for executing and elaborating the design.
+
+The protocol is one JSON object per line.  A client connects, sends a
+request and reads a single response before the server closes the
+connection.  Requests look like
+
+    {"sources": ["/abs/path/top.py"], "top": "Top", "output": null,
+     "locations": false, "hash_cons": false}
+
+and get back either ``{"ok": true, "ir": "...", "log": "..."}`` (or
+``"output": path`` instead of ``"ir"`` when an output file was asked for)
+or ``{"ok": false, "error": "...", "log": "..."}``, where ``log`` is what
+the design printed while it ran.  ``{"command": "shutdown"}`` stops the
+server.
+
+Sources are compiled in the server process, so their code objects stay
+cached there; each request is then executed and elaborated in a forked
+child, which starts from the server's clean builder state and exits
+afterwards.
+"""
+import errno, json, os, socket, sys, time, traceback
+from cStringIO import StringIO
+
+def default_socket_path():
+    """
+    Returns the socket path used when none is given: one per user, in the
+    temporary directory.
+    """
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), "pyrrhic-%d.sock" % os.getuid())
+
+def read_line(conn):
+    """
+    Reads bytes from the socket `conn` up to a newline or the end of the
+    stream, and returns them without the newline.
+    """
+    chunks = []
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        i = data.find("\n")
+        if i >= 0:
+            chunks.append(data[:i])
+            break
+        chunks.append(data)
+    return "".join(chunks)
+
+def send_json(conn, obj):
+    conn.sendall(json.dumps(obj) + "\n")
+
+class CompileServer(object):
+    """
+    Serves elaboration requests on the Unix domain socket at `path`.
+    """
+    def __init__(self, path, cache_dir = None, use_cache = True):
+        """
+        Parameters
+        ----------
+        path (str): Path of the socket to listen on
+        cache_dir (str): Directory of the on-disk code cache, by default
+                         `codecache.default_cache_dir()`
+        use_cache (bool): Set to false to never reuse instrumented code
+        """
+        from pyrrhic.builder.codecache import CodeCache
+        self.path = path
+        self.cache = None
+        if use_cache:
+            self.cache = CodeCache(cache_dir, in_memory = True)
+        self.sock = None
+        self.served = 0
+
+    def listen(self):
+        """
+        Binds the socket, replacing a stale one left by a server that is
+        no longer running.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(self.path)
+                except socket.error:
+                    os.remove(self.path)
+                else:
+                    raise RuntimeError("a server is already listening on " +
+                                       self.path)
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def serve_forever(self):
+        """
+        Accepts and handles requests until a shutdown request arrives.
+        """
+        if self.sock == None:
+            self.listen()
+        try:
+            while True:
+                try:
+                    (conn, _) = self.sock.accept()
+                except socket.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    if not self.handle(conn):
+                        break
+                finally:
+                    conn.close()
+                self.reap()
+        finally:
+            self.close()
+
+    def reap(self):
+        """
+        Collects the exit status of finished request children.
+        """
+        while True:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+
+    def handle(self, conn):
+        """
+        Reads one request from `conn` and answers it.  Returns `False` if
+        the server should stop.
+        """
+        try:
+            request = json.loads(read_line(conn))
+        except ValueError, e:
+            send_json(conn, {"ok": False, "error": "bad request: " + str(e)})
+            return True
+        if request.get("command", "compile") == "shutdown":
+            send_json(conn, {"ok": True})
+            return False
+
+        # Compile here so that code objects stay cached in this process
+        try:
+            codes = self.compile(request)
+        except Exception:
+            send_json(conn, {"ok": False, "error": traceback.format_exc()})
+            return True
+
+        self.served += 1
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self.sock.close()
+                send_json(conn, self.elaborate(request, codes))
+            except:
+                # Anything `elaborate` doesn't catch, like a design calling
+                # `sys.exit()`, still gets an answer
+                status = 1
+                try:
+                    send_json(conn, {"ok": False,
+                                     "error": traceback.format_exc()})
+                except:
+                    pass
+            os._exit(status)
+        return True
+
+    def compile(self, request):
+        """
+        Returns the instrumented code objects for the request's sources.
+        """
+        from pyrrhic.builder import astgen
+        return [astgen.compile_pyrrhic(p, self.cache)
+                for p in request["sources"]]
+
+    def elaborate(self, request, codes):
+        """
+        Executes and elaborates a design in the (forked) current process and
+        returns the response to send.
+        """
+        from pyrrhic import builder
+        from pyrrhic.builder import importer
+        from pyrrhic.builder import ElaborationSession, elaborate_all_instances
+        from pyrrhic.pyrast import emit, expr
+
+        start = time.time()
+        log = StringIO()
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            try:
+                roots = []
+                for p in request["sources"]:
+                    root = os.path.dirname(p)
+                    if root not in roots:
+                        roots.append(root)
+                importer.install(roots, use_cache = self.cache != None,
+                                 cache = self.cache)
+                if request.get("hash_cons"):
+                    expr.enable_hash_consing()
+
+                env = {"__name__": "__main__", "builder": builder,
+                       "__builtins__": importer.builtins()}
+                with ElaborationSession() as session:
+                    session.capture_locations = bool(request.get("locations"))
+                    for code in codes:
+                        exec code in env
+                    elaborate_all_instances()
+                mdecs = session.elaborated_instances.values()
+                if request.get("top"):
+                    mdecs = emit.modules_under(mdecs, request["top"])
+
+                response = {"ok": True}
+                if request.get("output"):
+                    emit.write_output(request["output"], mdecs)
+                    response["output"] = request["output"]
+                else:
+                    out = StringIO()
+                    emitter = emit.Emitter(out)
+                    for mdec in mdecs:
+                        emitter.emit_module(mdec)
+                        out.write("\n")
+                    response["ir"] = out.getvalue()
+            except Exception:
+                response = {"ok": False, "error": traceback.format_exc()}
+        finally:
+            sys.stdout = stdout
+        response["log"] = log.getvalue()
+        response["time"] = time.time() - start
+        return response
+
+def serve(path = None, cache_dir = None, use_cache = True):
+    """
+    Runs a `CompileServer` on `path` (by default `default_socket_path()`)
+    until it is shut down.
+    """
+    if path == None:
+        path = default_socket_path()
+    server = CompileServer(path, cache_dir, use_cache)
+    server.listen()
+    sys.stderr.write("pyrrhic: serving on %s\n" % path)
+    server.serve_forever()
@@ -0,0 +1,11 @@
+"""
+Simulation of Elaborated PyRRHIC IR.
+
+`netlist.Netlist` flattens a design made of the `ModuleDec`s produced by
+`builder.elaborate_all_instances` into ground-typed signals and their
+drivers.  `compiled.Simulator` runs it cycle by cycle, and
+`batch.BatchSimulator` runs many copies of it at once over NumPy arrays.
+"""
+from netlist import Netlist
+from compiled import Simulator
+from batch import BatchSimulator
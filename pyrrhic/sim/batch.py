@@ -0,0 +1,150 @@
+"""
+Batch Simulation with NumPy.
+
+Simulates many independent copies of a design at once, one per *lane*, as
+for running one design against thousands of stimulus streams.  Each signal
+holds a NumPy ``uint64`` array with an element per lane, and the functions
+`compiled.CodeGenerator` writes are turned into array code, where every
+operator and register update is a single vectorized operation over all
+lanes:
+
+    n7 = where(v4, U(0), where(v6 == U(16), U(1), v7))
+
+Values are masked to the widths of their signals as in `compiled.py`, so a
+lane holds signals of up to 64 bits.  Intermediate results wider than that
+are computed modulo 2**64, which only their low bits survive; comparing
+them, or selecting bits above the 64th, is an error.
+
+NumPy is only imported when a `BatchSimulator` is made.
+"""
+from pyrrhic.pyrast import SInt
+from compiled import CodeGenerator, Simulator
+from netlist import mask
+
+# Widest signal a lane holds
+LaneWidth = 64
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("BatchSimulator needs NumPy; install it with "
+                          "`pip install numpy`, or use sim.Simulator")
+    return numpy
+
+class NumpyCodeGenerator(CodeGenerator):
+    """
+    Writes the functions simulating a `Netlist` over arrays of lanes, with
+    ``U``, ``I`` and ``where`` standing for NumPy's ``uint64``, ``int64``
+    and ``where``.  Every constant is a ``uint64``, since mixing those with
+    Python integers yields floats.
+    """
+    def source(self):
+        n = self.netlist
+        for (name, t) in zip(n.names, n.types):
+            if t.width > LaneWidth:
+                raise ValueError("%s is %d bits wide; a lane holds at most %d" \
+                                 % (name, t.width, LaneWidth))
+        return CodeGenerator.source(self)
+
+    def const(self, value):
+        return "U(%d)" % value
+
+    def compare(self, op, a, b):
+        if a[1] > LaneWidth or b[1] > LaneWidth:
+            raise ValueError("can't compare values wider than %d bits in "
+                             "lanes" % LaneWidth)
+        if a[2] and b[2]:
+            cond = "(%s.view(I) %s %s.view(I))" % (self.signed(a), op,
+                                                  self.signed(b))
+        else:
+            cond = "(%s %s %s)" % (a[0], op, b[0])
+        code = "%s.astype(U)" % cond
+        self.conditions[code] = cond
+        return code
+
+    def bits(self, a, msb, lsb):
+        if msb >= LaneWidth:
+            raise ValueError("can't select bit %d in lanes of %d bits" % \
+                             (msb, LaneWidth))
+        return CodeGenerator.bits(self, a, msb, lsb)
+
+    def cat(self, args):
+        # Operands shifted out of the lane entirely don't contribute
+        shift = sum(a[1] for a in args)
+        kept = []
+        for a in args:
+            shift -= a[1]
+            if shift < LaneWidth:
+                kept.append(a)
+        return CodeGenerator.cat(self, kept)
+
+    def mux(self, sel, a, b, width, signed):
+        cond = self.conditions.get(sel[0], sel[0])
+        return "where(%s, %s, %s)" % (cond, self.fit(a, width, signed),
+                                      self.fit(b, width, signed))
+
+    def load(self, variables):
+        # Rows of a copy, so that storing a row can't change a variable
+        # still holding another's old value
+        return "%s[%s] = s.copy()" % (self.indent, ", ".join(variables))
+
+    def store(self, variables):
+        return ["%ss[%d] = %s" % (self.indent, i, v)
+                for (i, v) in enumerate(variables)]
+
+class BatchSimulator(Simulator):
+    """
+    Simulator of `lanes` independent copies of the design made of the
+    elaborated `ModuleDec`s `mdecs`, rooted at the module named `top`.
+    Values are poked and peeked as arrays with an element per lane.
+    """
+    generator = NumpyCodeGenerator
+
+    def __init__(self, mdecs, lanes, top = None):
+        self.numpy = import_numpy()
+        self.lanes = lanes
+        Simulator.__init__(self, mdecs, top)
+
+    def environment(self):
+        np = self.numpy
+        return {"U": np.uint64, "I": np.int64, "where": np.where}
+
+    def initial_values(self):
+        np = self.numpy
+        return np.zeros((len(self.netlist.names), self.lanes), np.uint64)
+
+    def poke(self, name, values):
+        """
+        Sets the input or register `name` to `values`: a value for every
+        lane, or an array of one per lane.
+        """
+        np = self.numpy
+        slot = self.input_slot(name)
+        v = np.asarray(values)
+        if v.dtype.kind == "i":
+            # Negative values in two's complement
+            v = v.astype(np.int64).view(np.uint64)
+        else:
+            v = v.astype(np.uint64)
+        width = self.netlist.types[slot].width
+        self.values[slot] = v & np.uint64(mask(width))
+        self.dirty = True
+
+    def peek(self, name):
+        """
+        Returns an array of the values of the signal `name` in every lane,
+        of ``int64``s for an ``SInt``.
+        """
+        np = self.numpy
+        slot = self.netlist.slot(name)
+        if self.dirty:
+            self.settle()
+        v = self.values[slot].copy()
+        t = self.netlist.types[slot]
+        if isinstance(t, SInt):
+            if t.width == 0:
+                return v.view(np.int64)
+            h = np.uint64(1 << (t.width - 1))
+            return ((v ^ h) - h).view(np.int64)
+        return v
@@ -0,0 +1,424 @@
+"""
+Compiled Simulation.
+
+Simulates a design cycle by cycle by running Python code generated from
+its `netlist.Netlist`.  Every signal gets a local variable holding its
+value, as an unsigned integer of the signal's width (``SInt``s in two's
+complement), and every driver becomes one assignment, so a clock cycle is
+a straight line of integer operations:
+
+    def cycle(s, n):
+        [v0, v1, v2, v3] = s
+        for _ in xrange(n):
+            n1 = (v1 + 1) & 31          # next values of the registers
+            ...
+            v1 = n1                     # the clock edge
+            v3 = (1 if v1 == 17 else 0) # combinational signals, levelized
+        s[:] = [v0, v1, v2, v3]
+
+The source is compiled once, when the `Simulator` is made.  Expressions
+are rendered once per module and instantiated per instance, with
+subexpressions shared within a driver computed once into a temporary.
+`CodeGenerator` turns each operator into source through a method of its
+own, so other engines can generate other code from the same netlist.
+"""
+from pyrrhic.pyrast import *
+from pyrrhic.passes.widths import lit_width, name_of
+from netlist import Netlist, mask
+
+# Python operators of the comparison nodes
+Comparisons = {Eq: "==", Neq: "!=", Lt: "<", Gt: ">"}
+
+class Signals(object):
+    """
+    Maps the names read by the expressions of one instance to the variables
+    holding their values, for substitution into a rendered template.
+    """
+    __slots__ = ("prefix", "slots", "var")
+
+    def __init__(self, prefix, slots, var):
+        self.prefix = prefix
+        self.slots = slots
+        self.var = var
+
+    def __getitem__(self, name):
+        return self.var(self.slots[self.prefix + name])
+
+class CodeGenerator(object):
+    """
+    Writes the source of the functions simulating a `Netlist`.
+
+    Operator methods take the source of their operands as (code, width,
+    signed) triples, the width and signedness of their result, and return
+    the source computing it as an unsigned integer of that width.
+    """
+    indent = "    "
+
+    def __init__(self, netlist):
+        self.netlist = netlist
+        # Rendered (lines, code) of each driver, by (kind, id(module
+        # netlist), index)
+        self.templates = {}
+        self.temps = 0
+        # Maps the code of each comparison rendered to the condition tested
+        self.conditions = {}
+        # Variable read in place of each combinational signal that is a
+        # copy of another signal, by slot
+        self.aliases = {}
+
+    def var(self, slot):
+        """
+        Returns the variable holding the value of the signal at `slot`.
+        """
+        return "v%d" % slot
+
+    def value(self, slot):
+        """
+        Returns the variable to read the value of the signal at `slot` from.
+        """
+        return self.aliases.get(slot) or self.var(slot)
+
+    def const(self, value):
+        """
+        Returns the source of the integer constant `value`.
+        """
+        return "%d" % value
+
+    def signed(self, a):
+        """
+        Returns the source of the value of the signed operand `a`.
+        """
+        (code, width, _) = a
+        if width == 0:
+            return self.const(0)
+        h = self.const(1 << (width - 1))
+        return "((%s ^ %s) - %s)" % (code, h, h)
+
+    def fit(self, a, width, signed):
+        """
+        Returns the source of the operand `a` converted to `width` bits,
+        truncated or, if `signed`, sign-extended.
+        """
+        (code, w, _) = a
+        if w > width or (signed and w < width):
+            if signed and w < width:
+                code = self.signed(a)
+            return "(%s & %s)" % (code, self.const(mask(width)))
+        return code
+
+    def add(self, a, b, width, signed):
+        if signed:
+            return "((%s + %s) & %s)" % (self.signed(a), self.signed(b),
+                                         self.const(mask(width)))
+        return "(%s + %s)" % (a[0], b[0])
+
+    def sub(self, a, b, width, signed):
+        if signed:
+            (x, y) = (self.signed(a), self.signed(b))
+        else:
+            (x, y) = (a[0], b[0])
+        return "((%s - %s) & %s)" % (x, y, self.const(mask(width)))
+
+    def compare(self, op, a, b):
+        """
+        Returns the source of 1 if ``a op b`` holds and 0 otherwise, for the
+        Python comparison operator `op`.
+        """
+        if a[2] and b[2]:
+            (x, y) = (self.signed(a), self.signed(b))
+        else:
+            (x, y) = (a[0], b[0])
+        cond = "%s %s %s" % (x, op, y)
+        code = "(1 if %s else 0)" % cond
+        self.conditions[code] = cond
+        return code
+
+    def invert(self, a, width):
+        return "(%s ^ %s)" % (a[0], self.const(mask(width)))
+
+    def bits(self, a, msb, lsb):
+        m = self.const(mask(msb - lsb + 1))
+        if lsb == 0:
+            return "(%s & %s)" % (a[0], m)
+        return "((%s >> %s) & %s)" % (a[0], self.const(lsb), m)
+
+    def cat(self, args):
+        shift = 0
+        parts = []
+        for (code, width, _) in reversed(args):
+            if shift:
+                code = "(%s << %s)" % (code, self.const(shift))
+            parts.append(code)
+            shift += width
+        return "(%s)" % " | ".join(reversed(parts))
+
+    def mux(self, sel, a, b, width, signed):
+        cond = self.conditions.get(sel[0], sel[0])
+        return "(%s if %s else %s)" % (self.fit(a, width, signed), cond,
+                                       self.fit(b, width, signed))
+
+    def render(self, mnet, e, target):
+        """
+        Returns (lines, code) computing the expression `e` of the module
+        netlist `mnet` and converting it to the ground type `target`:
+        assignments of shared subexpressions to temporaries, and the code
+        of the value.  Signals are read through ``%(name)s`` placeholders.
+        """
+        # Parents of each node within `e`
+        parents = {}
+        stack = [e]
+        while stack:
+            node = stack.pop()
+            n = parents.get(id(node), 0)
+            parents[id(node)] = n + 1
+            if n == 0:
+                stack.extend(expr_children(node))
+        lines = []
+        # Maps `id(node)` to (node, (code, width, signed))
+        done = {}
+        stack = [(e, None)]
+        while stack:
+            (node, kids) = stack.pop()
+            if kids is None:
+                if id(node) in done:
+                    continue
+                if isinstance(node, Id):
+                    t = mnet.signals[name_of(node)]
+                    done[id(node)] = (node, ("%%(%s)s" % name_of(node),
+                                             t.width, isinstance(t, SInt)))
+                    continue
+                if isinstance(node, Lit):
+                    w = lit_width(node)
+                    v = int(node.value) & mask(w)
+                    done[id(node)] = (node, (self.const(v), w,
+                                             bool(node.signed)))
+                    continue
+                kids = expr_children(node)
+                stack.append((node, kids))
+                stack.extend((k, None) for k in kids)
+                continue
+            res = self.operator(node, [done[id(k)][1] for k in kids])
+            if parents[id(node)] > 1:
+                temp = "t%d" % self.temps
+                self.temps += 1
+                lines.append("%s = %s" % (temp, res[0]))
+                res = (temp,) + res[1:]
+            done[id(node)] = (node, res)
+        res = done[id(e)][1]
+        return (lines, self.fit(res, target.width, res[2]))
+
+    def operator(self, node, args):
+        """
+        Returns the (code, width, signed) of the operator node `node` whose
+        operands are `args`.
+        """
+        cls = type(node)
+        if cls in (Add, Sub):
+            (a, b) = args
+            width = max(a[1], b[1]) + 1
+            signed = a[2] and b[2]
+            if cls is Add:
+                return (self.add(a, b, width, signed), width, signed)
+            return (self.sub(a, b, width, signed), width, signed)
+        if cls in Comparisons:
+            return (self.compare(Comparisons[cls], args[0], args[1]), 1, False)
+        if cls is Invert:
+            return (self.invert(args[0], args[0][1]), args[0][1], False)
+        if cls is Bits:
+            if node.msb < node.lsb:
+                raise ValueError("bad bit range in " + str(node))
+            return (self.bits(args[0], node.msb, node.lsb),
+                    node.msb - node.lsb + 1, False)
+        if cls is Cat:
+            return (self.cat(args), sum(a[1] for a in args), False)
+        if cls is Mux:
+            (sel, a, b) = args
+            width = max(a[1], b[1])
+            signed = a[2] and b[2]
+            return (self.mux(sel, a, b, width, signed), width, signed)
+        raise TypeError("can't simulate " + str(node))
+
+    def template(self, kind, driver):
+        """
+        Returns the rendered (lines, code) of the driver `driver` from the
+        `kind` (``"drivers"`` or ``"resets"``) of its module netlist.
+        """
+        (slot, (prefix, mnet), k) = driver
+        key = (kind, id(mnet), k)
+        if key not in self.templates:
+            (target, e) = getattr(mnet, kind)[k]
+            self.templates[key] = self.render(mnet, e, mnet.signals[target])
+        return self.templates[key]
+
+    def assignments(self, kind, drivers, level, prefix = "v"):
+        """
+        Returns the lines assigning the values of the drivers `drivers`,
+        each to the variable named `prefix` and its slot, indented `level`
+        times.
+        """
+        out = []
+        indent = self.indent * level
+        slots = self.netlist.slots
+        for d in drivers:
+            if d[0] in self.aliases:
+                continue
+            (lines, code) = self.template(kind, d)
+            names = Signals(d[1][0], slots, self.value)
+            for line in lines:
+                out.append(indent + line % names)
+            out.append("%s%s%d = %s" % (indent, prefix, d[0], code % names))
+        return out
+
+    def find_aliases(self):
+        """
+        Finds the combinational signals driven by a plain read of another
+        signal.  Those are only assigned before the values are stored, and
+        read from the other signal's variable everywhere else.
+        """
+        slots = self.netlist.slots
+        for d in self.netlist.comb:
+            (lines, code) = self.template("drivers", d)
+            if not lines and code.startswith("%(") and code.endswith(")s") \
+               and code.count("%") == 1:
+                self.aliases[d[0]] = self.value(slots[d[1][0] + code[2:-2]])
+
+    def copies(self, level):
+        """
+        Returns the lines assigning the copied signals, indented `level`
+        times.
+        """
+        return ["%s%s = %s" % (self.indent * level, self.var(slot), v)
+                for (slot, v) in sorted(self.aliases.items())]
+
+    def load(self, variables):
+        """
+        Returns the line loading the values in ``s`` into `variables`.
+        """
+        return "%s[%s] = s" % (self.indent, ", ".join(variables))
+
+    def store(self, variables):
+        """
+        Returns the lines storing the values of `variables` back into ``s``.
+        """
+        return ["%ss[:] = [%s]" % (self.indent, ", ".join(variables))]
+
+    def source(self):
+        """
+        Returns the source of the functions ``settle(s)``, evaluating the
+        combinational signals, ``cycle(s, n)``, running `n` clock cycles,
+        and ``reset(s)``, loading the registers with their reset values,
+        where `s` is the list of the values of the signals.
+        """
+        n = self.netlist
+        variables = [self.var(i) for i in range(len(n.names))]
+        load = self.load(variables)
+        store = self.store(variables) + [""]
+        self.find_aliases()
+        comb = self.assignments("drivers", n.comb, 1) + self.copies(1)
+        out = ["def settle(s):", load] + comb + store
+        loop = self.assignments("drivers", n.next, 2, "n")
+        for d in n.next:
+            loop.append("%s%s = n%d" % (self.indent * 2, self.var(d[0]), d[0]))
+        loop += self.assignments("drivers", n.comb, 2)
+        out += ["def cycle(s, n):", load,
+                "%sfor _ in xrange(n):" % self.indent]
+        out += loop or ["%spass" % (self.indent * 2)]
+        out += self.copies(1) + store
+        out += ["def reset(s):", load]
+        out += self.assignments("resets", n.resets, 1, "n")
+        for d in n.resets:
+            out.append("%s%s = n%d" % (self.indent, self.var(d[0]), d[0]))
+        out += comb + store
+        return "\n".join(out)
+
+class Simulator(object):
+    """
+    Cycle-accurate simulator of the design made of the elaborated
+    `ModuleDec`s `mdecs`, rooted at the module named `top` (by default the
+    only one no other module instantiates).  Signals are named as in
+    `netlist.py`; the combinational ones are settled whenever they are
+    peeked after a change.
+    """
+    generator = CodeGenerator
+
+    def __init__(self, mdecs, top = None):
+        self.netlist = Netlist(mdecs, top)
+        self.source = self.generator(self.netlist).source()
+        env = self.environment()
+        code = compile(self.source, "<simulation of %s>" % self.netlist.top,
+                       "exec")
+        exec code in env
+        self._settle = env["settle"]
+        self._cycle = env["cycle"]
+        self._reset = env["reset"]
+        # Value of each signal, by slot
+        self.values = self.initial_values()
+        self.cycles = 0
+        self.dirty = True
+
+    def environment(self):
+        """
+        Returns the globals of the generated functions.
+        """
+        return {}
+
+    def initial_values(self):
+        return [0] * len(self.netlist.names)
+
+    def input_slot(self, name):
+        """
+        Returns the slot of the signal `name`, which must be an input (a
+        wire the design doesn't drive) or a register.
+        """
+        n = self.netlist
+        slot = n.slot(name)
+        if slot in n.driven and not n.is_reg[slot]:
+            raise ValueError("%s is driven by the design" % name)
+        return slot
+
+    def poke(self, name, value):
+        """
+        Sets the input or register `name` to `value`.
+        """
+        slot = self.input_slot(name)
+        self.values[slot] = value & mask(self.netlist.types[slot].width)
+        self.dirty = True
+
+    def peek(self, name):
+        """
+        Returns the value of the signal `name`, negative for a negative
+        ``SInt``.
+        """
+        n = self.netlist
+        slot = n.slot(name)
+        if self.dirty:
+            self.settle()
+        v = self.values[slot]
+        t = n.types[slot]
+        if isinstance(t, SInt) and t.width > 0 and v >> (t.width - 1):
+            v -= 1 << t.width
+        return v
+
+    def settle(self):
+        """
+        Evaluates the combinational signals.
+        """
+        self._settle(self.values)
+        self.dirty = False
+
+    def step(self, n = 1):
+        """
+        Runs `n` clock cycles.
+        """
+        if self.dirty:
+            self.settle()
+        self._cycle(self.values, n)
+        self.cycles += n
+
+    def reset(self):
+        """
+        Loads the registers declared with a reset value with that value.
+        """
+        if self.dirty:
+            self.settle()
+        self._reset(self.values)
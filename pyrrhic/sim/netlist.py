@@ -0,0 +1,602 @@
+"""
+Flattened Netlists.
+
+Lowers a design, given by the elaborated `ModuleDec`s of its top module and
+of the modules that one instantiates, to ground-typed signals, each a wire
+or a register of known width, with one driving expression per driven
+signal:
+
+  - Bundles and vectors are split into their fields and elements, named
+    as in the IR (``io.input.data``, ``regs[3]``).  A connection of
+    aggregates connects the fields both sides have, by name, with the
+    reversed ones driven from right to left.
+  - A vector element selected by an expression becomes a `Mux` of all the
+    elements where it is read, and a `when` per element where it is
+    connected.
+  - `when`s are expanded into `Mux`es by `passes.whens`, and constant
+    subexpressions folded by `passes.constfold`.
+  - Instances are inlined, their signals named after the path of instance
+    names leading to them: ``c.self_io.start`` is the ``self_io.start`` of
+    the instance ``c`` of the top module, which the top module itself
+    refers to as ``c.io.start``.
+
+Each module is lowered once, however many times it is instantiated.  The
+combinational signals (the driven wires) of the whole design are then
+levelized: ordered so that each one comes after every signal it is
+computed from, and a single pass in that order settles the design.  A
+combinational loop is an error.
+"""
+from pyrrhic.pyrast import *
+from pyrrhic.passes.constfold import const, fold_constants
+from pyrrhic.passes.refs import is_reference
+from pyrrhic.passes.whens import WhenExpander, rebase
+from pyrrhic.passes.widths import io_name, name_of
+
+# Operator nodes a netlist's expressions may hold, besides `Lit` and `Id`
+Operators = (Add, Sub, Eq, Neq, Lt, Gt, Invert, Bits, Cat, Mux)
+
+def mask(width):
+    return (1 << width) - 1
+
+def is_ground(t):
+    return isinstance(t, (UInt, SInt))
+
+def index_of(item):
+    """
+    Returns the vector index `item` as an integer, or `None` if it isn't a
+    constant.
+    """
+    if isinstance(item, (int, long)):
+        return item
+    return const(item)
+
+def ground_parts(t):
+    """
+    Returns the ground-typed parts of the type `t` in declaration order, as
+    (path, type, flipped) triples: `path` is the list of field names and
+    element indices leading down to the part, and `flipped` whether an odd
+    number of reversed fields lie along it.
+    """
+    res = []
+    stack = [([], t, False)]
+    while stack:
+        (path, t, flipped) = stack.pop()
+        if isinstance(t, Bundle):
+            for k in reversed(t.fields.keys()):
+                f = t.fields[k]
+                stack.append((path + [k], f.type,
+                              flipped != (f.orientation == Field.Reverse)))
+        elif isinstance(t, Vec):
+            for i in reversed(range(t.count)):
+                stack.append((path + [i], t.type, flipped))
+        else:
+            res.append((path, t, flipped))
+    return res
+
+def path_name(name, path):
+    """
+    Returns the name of the part of the signal `name` at `path`.
+    """
+    for p in path:
+        if isinstance(p, (int, long)):
+            name += "[%d]" % p
+        else:
+            name += "." + p
+    return name
+
+def extend(e, path):
+    """
+    Returns the reference to the part of the reference `e` at `path`.
+    """
+    for p in path:
+        if isinstance(p, (int, long)):
+            e = SubItem(e, Lit(p))
+        else:
+            e = SubField(e, p)
+    return e
+
+def project(e, path):
+    """
+    Returns the part at `path` of the aggregate expression `e`, a reference
+    or a tree of `Mux`es choosing between references.
+    """
+    if not path:
+        return e
+    # Maps `id(node)` to (node, projected node)
+    done = {}
+    stack = [(e, False)]
+    while stack:
+        (node, visited) = stack.pop()
+        if not isinstance(node, Mux):
+            done[id(node)] = (node, extend(node, path))
+        elif not visited:
+            stack.append((node, True))
+            stack.append((node.__a__, False))
+            stack.append((node.__b__, False))
+        else:
+            done[id(node)] = (node, Mux(node.__sel__, done[id(node.__a__)][1],
+                                        done[id(node.__b__)][1]))
+    return done[id(e)][1]
+
+def names_read(e):
+    """
+    Returns the names of the `Id`s in the expression `e`, each once.
+    """
+    names = []
+    seen = set()
+    stack = [e]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, Id):
+            names.append(name_of(node))
+        else:
+            stack.extend(expr_children(node))
+    return names
+
+class ModuleNetlist(object):
+    """
+    Ground-typed signals and drivers of one module, named as in the module.
+    """
+    def __init__(self, mdec, netlist):
+        self.mdec = mdec
+        self.name = str(mdec.idt)
+        self.netlist = netlist
+        # Declared types by name, and the module instantiated by each
+        # instance name
+        self.types = {}
+        self.inst_modules = {}
+        # (instance name, module name) of each instance, in order
+        self.instances = []
+        # Ground type of every signal declared or read here, by name
+        self.signals = {}
+        # Names of the ground signals declared here, in order, and of the
+        # registers among them
+        self.declared = []
+        self.regs = set()
+        # (signal name, expression) of every driven signal and of every
+        # register with a reset value, and the names each expression reads
+        self.drivers = []
+        self.resets = []
+        self.driver_reads = []
+        self.reset_reads = []
+        # Maps `id(node)` to (node, lowered node)
+        self.converted = {}
+
+    def lower(self):
+        """
+        Lowers the statements of the module.
+        """
+        stack = list(self.mdec.stmts)
+        while stack:
+            s = stack.pop()
+            if isinstance(s, (WireDec, RegDec)):
+                self.types[name_of(s.idt)] = s.type
+            elif isinstance(s, ModuleInst):
+                self.inst_modules[name_of(s.inst_idt)] = str(s.mod_idt)
+            elif isinstance(s, WhenStmt):
+                stack.extend(s.if_stmts)
+                stack.extend(s.else_stmts)
+        lowered = ModuleDec(self.mdec.idt, None,
+                            WhenExpander().expand(self.flatten()))
+        fold_constants([lowered])
+        for s in lowered.stmts:
+            if isinstance(s, ConnectStmt):
+                self.drivers.append((name_of(s.lval), s.rval))
+                self.driver_reads.append(names_read(s.rval))
+            elif isinstance(s, RegDec) and s.onReset is not None:
+                self.resets.append((name_of(s.idt), s.onReset))
+                self.reset_reads.append(names_read(s.onReset))
+
+    def root(self, e):
+        """
+        Returns (name, type, path) for the reference `e`: the name and type of
+        the declaration or instance port it is part of, and the `SubField`s
+        and `SubItem`s leading from there down to `e`, outermost first.
+        """
+        path = []
+        while isinstance(e, (SubField, SubItem)):
+            path.append(e)
+            e = e.__base__
+        path.reverse()
+        if not isinstance(e, Id):
+            raise TypeError("%s: %s is not a reference" % (self.name, e))
+        name = name_of(e)
+        if name in self.types:
+            return (name, self.types[name], path)
+        if name not in self.inst_modules:
+            raise ValueError("%s: %s is not declared" % (self.name, name))
+        if not path or not isinstance(path[0], SubField) or \
+           path[0].__attr__ != "io":
+            raise ValueError("%s: instance %s is only reachable through its "
+                             "io" % (self.name, name))
+        (io, t) = self.netlist.port(self.inst_modules[name])
+        return (name + "." + io, t, path[1:])
+
+    def part_type(self, t, p):
+        """
+        Returns the type of the part of a value of type `t` selected by the
+        `SubField` or `SubItem` `p`.
+        """
+        if isinstance(p, SubField):
+            info = t.field(p.__attr__) if isinstance(t, Bundle) else None
+            if info is None:
+                raise TypeError("%s: %s of type %s has no field %s" % \
+                                (self.name, p.__base__, t, p.__attr__))
+            return info.type
+        if not isinstance(t, Vec):
+            raise TypeError("%s: %s of type %s is not a vector" % \
+                            (self.name, p.__base__, t))
+        return t.type
+
+    def type_of(self, e):
+        """
+        Returns the type of the reference, or `Mux` of references, `e`, or
+        `None` if it is neither.
+        """
+        while isinstance(e, Mux):
+            e = e.__a__
+        if not is_reference(e):
+            return None
+        (name, t, path) = self.root(e)
+        for p in path:
+            t = self.part_type(t, p)
+        return t
+
+    def read(self, e):
+        """
+        Returns the lowered form of the ground-typed reference `e`: the `Id`
+        of the signal it names, or a `Mux` of signals for vector elements
+        selected by expressions.
+        """
+        (name, t, path) = self.root(e)
+        return self.select(name, t, path)
+
+    def select(self, name, t, path):
+        """
+        Returns the lowered form of the part of the signal `name`, of type
+        `t`, selected by `path`.  Only recurses on elements selected by
+        expressions.
+        """
+        for (i, p) in enumerate(path):
+            vec = t
+            t = self.part_type(t, p)
+            if isinstance(p, SubField):
+                name += "." + p.__attr__
+                continue
+            k = index_of(p.__item__)
+            if k is None:
+                idx = self.convert(p.__item__)
+                rest = path[i + 1:]
+                last = vec.count - 1
+                res = self.select("%s[%d]" % (name, last), t, rest)
+                for k in reversed(range(last)):
+                    res = Mux(idx == Lit(k),
+                              self.select("%s[%d]" % (name, k), t, rest), res)
+                return res
+            if k >= vec.count:
+                raise ValueError("%s: index %d of %s is out of range" % \
+                                 (self.name, k, p.__base__))
+            name += "[%d]" % k
+        if not is_ground(t):
+            raise TypeError("%s: %s of type %s is used as a value" % \
+                            (self.name, name, t))
+        if t.width is None:
+            raise ValueError("%s: width of %s is unknown; infer it with "
+                             "passes.infer_widths" % (self.name, name))
+        self.signals[name] = t
+        return Id(name)
+
+    def convert(self, root):
+        """
+        Returns the lowered form of the ground-typed expression `root`, which
+        is left unchanged.
+        """
+        memo = self.converted
+        stack = [(root, None)]
+        while stack:
+            (node, kids) = stack.pop()
+            if kids is None:
+                if id(node) in memo:
+                    continue
+                if is_reference(node):
+                    memo[id(node)] = (node, self.read(node))
+                    continue
+                if not isinstance(node, (Lit,) + Operators):
+                    raise TypeError("%s: can't simulate %s" % (self.name, node))
+                kids = expr_children(node)
+                stack.append((node, kids))
+                stack.extend((k, None) for k in kids)
+                continue
+            new = [memo[id(k)][1] for k in kids]
+            res = node
+            for (k, n) in zip(kids, new):
+                if k is not n:
+                    res = replace_expr_children(node, new, True)
+                    break
+            memo[id(node)] = (node, res)
+        return memo[id(root)][1]
+
+    def split(self, lval):
+        """
+        Returns (index, targets) if the target `lval` contains a vector
+        element selected by an expression: that expression, and `lval` with
+        each index in its place.  Returns `None` otherwise.
+        """
+        chain = []
+        e = lval
+        while isinstance(e, (SubField, SubItem)):
+            chain.append(e)
+            e = e.__base__
+        chain.reverse()
+        for (i, p) in enumerate(chain):
+            if isinstance(p, SubItem) and index_of(p.__item__) is None:
+                t = self.type_of(p.__base__)
+                if not isinstance(t, Vec):
+                    raise TypeError("%s: %s of type %s is not a vector" % \
+                                    (self.name, p.__base__, t))
+                lvals = [rebase(SubItem(p.__base__, Lit(k)), chain[i + 1:])
+                         for k in range(t.count)]
+                return (p.__item__, lvals)
+        return None
+
+    def bulk(self, lval, t, rval):
+        """
+        Returns the ground-typed connections making up the connection of
+        `rval` to `lval`, of the aggregate type `t`.
+        """
+        rt = self.type_of(rval)
+        if rt is None or is_ground(rt):
+            raise TypeError("%s: can't connect %s to %s of type %s" % \
+                            (self.name, rval, lval, t))
+        theirs = set(path_name("", path) for (path, _, _) in ground_parts(rt))
+        res = []
+        for (path, _, flipped) in ground_parts(t):
+            if path_name("", path) not in theirs:
+                continue
+            if not flipped:
+                res.append(ConnectStmt(extend(lval, path), project(rval, path)))
+            elif is_reference(rval):
+                res.append(ConnectStmt(extend(rval, path), extend(lval, path)))
+            else:
+                raise TypeError("%s: %s can't drive the reversed field %s" % \
+                                (self.name, rval, path_name(str(lval), path)))
+        return res
+
+    def declare(self, s, out):
+        """
+        Declares the ground parts of the wire or register declared by `s`,
+        appending their declarations to `out`.
+        """
+        name = name_of(s.idt)
+        reg = isinstance(s, RegDec)
+        for (path, t, _) in ground_parts(s.type):
+            leaf = path_name(name, path)
+            if t.width is None:
+                raise ValueError("%s: width of %s is unknown; infer it with "
+                                 "passes.infer_widths" % (self.name, leaf))
+            self.signals[leaf] = t
+            self.declared.append(leaf)
+            if not reg:
+                out.append(WireDec(Id(leaf), t))
+                continue
+            self.regs.add(leaf)
+            reset = None
+            if s.onReset is not None:
+                reset = self.convert(project(s.onReset, path))
+            out.append(RegDec(Id(leaf), t, reset))
+
+    def flatten(self):
+        """
+        Returns the ground-typed statements of the module, with its `when`s
+        kept.
+        """
+        res = []
+        # (statements, list to append their lowered forms to)
+        tasks = [(self.mdec.stmts, res)]
+        while tasks:
+            (src, dst) = tasks.pop()
+            queue = list(reversed(src))
+            while queue:
+                s = queue.pop()
+                if isinstance(s, ConnectStmt):
+                    split = self.split(s.lval)
+                    if split is not None:
+                        (idx, lvals) = split
+                        idx = self.convert(idx)
+                        for (k, lval) in enumerate(lvals):
+                            w = WhenStmt(idx == Lit(k), [], [])
+                            dst.append(w)
+                            tasks.append(([ConnectStmt(lval, s.rval)],
+                                          w.if_stmts))
+                        continue
+                    t = self.type_of(s.lval)
+                    if t is None:
+                        raise TypeError("%s: can't connect to %s" % \
+                                        (self.name, s.lval))
+                    if is_ground(t):
+                        dst.append(ConnectStmt(self.read(s.lval),
+                                               self.convert(s.rval)))
+                    else:
+                        queue.extend(reversed(self.bulk(s.lval, t, s.rval)))
+                elif isinstance(s, VecStmt):
+                    queue.extend(reversed(s.expand()))
+                elif isinstance(s, WhenStmt):
+                    w = WhenStmt(self.convert(s.cond), [], [])
+                    dst.append(w)
+                    tasks.append((s.if_stmts, w.if_stmts))
+                    tasks.append((s.else_stmts, w.else_stmts))
+                elif isinstance(s, (WireDec, RegDec)):
+                    self.declare(s, dst)
+                elif isinstance(s, ModuleInst):
+                    self.instances.append((name_of(s.inst_idt),
+                                           str(s.mod_idt)))
+        return res
+
+class Netlist(object):
+    """
+    The ground-typed signals of a design, numbered in order of declaration
+    (their *slots*), and the drivers of those that are driven.
+
+    A driver is a (slot, instance, index) triple: the expression driving
+    the signal at `slot` is the one at `index` in the `drivers` (or
+    `resets`) of the `ModuleNetlist` of the (prefix, module netlist)
+    `instance`, where it reads the signals named by `prefix` followed by
+    the names it holds.
+    """
+    def __init__(self, mdecs, top = None):
+        self.modules = {}
+        for m in mdecs:
+            self.modules[str(m.idt)] = m
+        self.top = top_module(mdecs, top)
+        # Lowered modules, and the (io name, io type) of each, by name
+        self.lowered = {}
+        self.ports = {}
+        # (prefix, module netlist) of every instance, the top one first
+        self.instances = []
+        # Name, ground type and kind of each signal, by slot, and the slot
+        # of each name
+        self.names = []
+        self.types = []
+        self.is_reg = []
+        self.slots = {}
+        # The driver of each driven slot
+        self.driven = {}
+        # Drivers of the combinational signals in levelized order, of the
+        # registers' next values, and of their reset values
+        self.comb = []
+        self.next = []
+        self.resets = []
+        self.build()
+
+    def module(self, name):
+        """
+        Returns the `ModuleNetlist` of the module named `name`, lowering it
+        the first time.
+        """
+        mnet = self.lowered.get(name)
+        if mnet is None:
+            if name not in self.modules:
+                raise KeyError("no module named " + name)
+            mnet = ModuleNetlist(self.modules[name], self)
+            mnet.lower()
+            self.lowered[name] = mnet
+        return mnet
+
+    def port(self, name):
+        """
+        Returns the name and type of the ``io`` of the module named `name`.
+        """
+        if name not in self.ports:
+            if name not in self.modules:
+                raise KeyError("no module named " + name)
+            mdec = self.modules[name]
+            io = io_name(mdec)
+            t = None
+            for s in walk_stmts(mdec.stmts):
+                if isinstance(s, (WireDec, RegDec)) and name_of(s.idt) == io:
+                    t = s.type
+                    break
+            if t is None:
+                raise ValueError("module %s has no io" % name)
+            self.ports[name] = (io, t)
+        return self.ports[name]
+
+    def build(self):
+        """
+        Numbers the signals of every instance, and collects their drivers.
+        """
+        stack = [("", self.top)]
+        while stack:
+            (prefix, name) = stack.pop()
+            mnet = self.module(name)
+            self.instances.append((prefix, mnet))
+            for leaf in mnet.declared:
+                self.slots[prefix + leaf] = len(self.names)
+                self.names.append(prefix + leaf)
+                self.types.append(mnet.signals[leaf])
+                self.is_reg.append(leaf in mnet.regs)
+            for (inst, mod) in reversed(mnet.instances):
+                stack.append((prefix + inst + ".", mod))
+        comb = []
+        for inst in self.instances:
+            (prefix, mnet) = inst
+            for (k, (target, e)) in enumerate(mnet.drivers):
+                slot = self.slot(prefix + target)
+                if slot in self.driven:
+                    raise ValueError("%s is driven more than once" % \
+                                     self.names[slot])
+                self.driven[slot] = (slot, inst, k)
+                if not self.is_reg[slot]:
+                    comb.append((slot, inst, k))
+                elif not (isinstance(e, Id) and name_of(e) == target):
+                    self.next.append((slot, inst, k))
+            for (k, (target, e)) in enumerate(mnet.resets):
+                self.resets.append((self.slot(prefix + target), inst, k))
+        self.comb = self.levelize(comb)
+
+    def slot(self, name):
+        """
+        Returns the slot of the signal `name`.
+        """
+        slot = self.slots.get(name)
+        if slot is None:
+            raise KeyError("no signal named " + name)
+        return slot
+
+    def levelize(self, comb):
+        """
+        Returns the combinational drivers `comb` ordered so that each one
+        comes after those of the signals it reads.
+        """
+        index = {}
+        for (i, d) in enumerate(comb):
+            index[d[0]] = i
+        # Drivers reading each driver's signal, and how many of the signals
+        # each one reads are still to be computed
+        users = [[] for d in comb]
+        pending = [0] * len(comb)
+        for (i, (slot, (prefix, mnet), k)) in enumerate(comb):
+            for name in mnet.driver_reads[k]:
+                j = index.get(self.slot(prefix + name))
+                if j is not None:
+                    users[j].append(i)
+                    pending[i] += 1
+        ready = [i for i in reversed(range(len(comb))) if pending[i] == 0]
+        order = []
+        while ready:
+            i = ready.pop()
+            order.append(comb[i])
+            for u in users[i]:
+                pending[u] -= 1
+                if pending[u] == 0:
+                    ready.append(u)
+        if len(order) < len(comb):
+            loop = sorted(self.names[comb[i][0]] for i in range(len(comb))
+                          if pending[i] > 0)
+            raise ValueError("combinational loop through " + ", ".join(loop))
+        return order
+
+def top_module(mdecs, top = None):
+    """
+    Returns the name of the top module of the design made of `mdecs`:
+    `top` if given, and otherwise the only module no other one
+    instantiates.
+    """
+    names = [str(m.idt) for m in mdecs]
+    if top is not None:
+        if top not in names:
+            raise KeyError("no module named " + top)
+        return top
+    instantiated = set()
+    for m in mdecs:
+        for s in walk_stmts(m.stmts):
+            if isinstance(s, ModuleInst):
+                instantiated.add(str(s.mod_idt))
+    roots = [n for n in names if n not in instantiated]
+    if len(roots) != 1:
+        raise ValueError("%d top-level modules (%s); name the one to "
+                         "simulate" % (len(roots), ", ".join(roots)))
+    return roots[0]
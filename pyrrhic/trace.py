@@ -0,0 +1,137 @@
+"""
+Level-Gated Structured Tracing.
+
+The builder reports what it does (updates logged, contexts created, ids
+renamed, ...) through trace points of the form
+
+    if trace.enabled and trace.on(trace.BUILDER, trace.DEBUG):
+        trace.emit(trace.BUILDER, trace.DEBUG, "update", stmt = str(s))
+
+With tracing off, `enabled` is false and a trace point costs one global
+lookup: the message is never built.  When on, records go either to stderr
+as text or to a file as JSON lines.
+"""
+import json, sys, time
+
+# Levels, in increasing order of verbosity
+OFF, INFO, DEBUG = range(3)
+LevelNames = { "off": OFF, "info": INFO, "debug": DEBUG }
+
+# Categories
+BUILDER = "builder"   # Updates and declarations logged to builder contexts
+CONTEXT = "context"   # Module classes and instances entering the builder
+RENAME = "rename"     # Renaming of ids and module instances
+Categories = [BUILDER, CONTEXT, RENAME]
+
+# True iff at least one category is enabled.  Checked first by every trace
+# point so that disabled tracing costs next to nothing.
+enabled = False
+
+# Maps each enabled category to its level
+_levels = {}
+
+# Object with a `write(category, level, event, fields)` method
+_sink = None
+
+class TextSink(object):
+    """
+    Writes trace records to a stream as human-readable lines.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, category, level, event, fields):
+        line = "[" + category + "] " + event
+        for k in sorted(fields):
+            line += " " + k + "=" + str(fields[k])
+        self.stream.write(line + "\n")
+
+    def close(self):
+        self.stream.flush()
+
+class JSONSink(object):
+    """
+    Writes trace records to a file, one JSON object per line.
+    """
+    def __init__(self, path):
+        self.stream = open(path, "w")
+
+    def write(self, category, level, event, fields):
+        rec = { "time": time.time(), "category": category, "level": level,
+                "event": event }
+        rec.update(fields)
+        self.stream.write(json.dumps(rec, default = str) + "\n")
+
+    def close(self):
+        self.stream.close()
+
+def parse_spec(spec):
+    """
+    Parses a comma-separated list of ``category[:level]`` items (``all``
+    standing for every category) into a dict of levels.  The level defaults
+    to ``debug``.  Raises `ValueError` for unknown categories or levels.
+    """
+    levels = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        (cat, _, level) = item.partition(":")
+        level = level or "debug"
+        if level not in LevelNames:
+            raise ValueError("unknown trace level: " + level)
+        level = LevelNames[level]
+        if cat == "all":
+            for c in Categories:
+                levels[c] = level
+        elif cat in Categories:
+            levels[cat] = level
+        else:
+            raise ValueError("unknown trace category: " + cat)
+    return levels
+
+def configure(levels, path = None):
+    """
+    Enables tracing, for every thread of the process.
+
+    Parameters
+    ----------
+    levels (dict or str): Maps categories to levels, or a specification
+                          accepted by `parse_spec`
+    path (str): File receiving JSON-lines records, or `None` to write text
+                to stderr
+    """
+    global enabled, _levels, _sink
+    if isinstance(levels, str):
+        levels = parse_spec(levels)
+    disable()
+    _levels = dict((c, l) for (c, l) in levels.items() if l > OFF)
+    if path == None:
+        _sink = TextSink(sys.stderr)
+    else:
+        _sink = JSONSink(path)
+    enabled = len(_levels) > 0
+
+def disable():
+    """
+    Turns tracing off and closes the current sink.
+    """
+    global enabled, _levels, _sink
+    enabled = False
+    _levels = {}
+    if _sink != None:
+        _sink.close()
+        _sink = None
+
+def on(category, level = DEBUG):
+    """
+    Returns `True` iff records of `category` at `level` are being traced.
+    """
+    return _levels.get(category, OFF) >= level
+
+def emit(category, level, event, **fields):
+    """
+    Writes a trace record if `category` is traced at `level`.
+    """
+    if enabled and _levels.get(category, OFF) >= level:
+        _sink.write(category, level, event, fields)
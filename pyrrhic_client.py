@@ -0,0 +1,85 @@
+#!/usr/bin/python
+"""
+Thin Client for the PyRRHIC Compile Server.
+
+Sends a compile request to a server started with ``pyrrhic.py --serve`` and
+prints the IR it returns.  Only the standard library is imported, so a
+request costs little more than the elaboration itself.
+"""
+import argparse, json, os, socket, sys, tempfile
+
+def default_socket_path():
+    # Must match `pyrrhic.server.default_socket_path`
+    return os.path.join(tempfile.gettempdir(), "pyrrhic-%d.sock" % os.getuid())
+
+def request(path, req):
+    """
+    Sends `req` to the server listening on `path` and returns its response.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req) + "\n")
+        chunks = []
+        while True:
+            data = sock.recv(1 << 16)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    try:
+        return json.loads("".join(chunks))
+    except ValueError:
+        # The request's child process died before answering in full
+        return {"ok": False, "error": "the server closed the connection "
+                                      "without answering\n"}
+
+parser = argparse.ArgumentParser(prog = "pyrrhic_client")
+parser.add_argument("sources", nargs = "*", help = "PyRRHIC sources")
+parser.add_argument("--socket", metavar = "PATH",
+                    help = "socket of the server (default: %s)" % \
+                        default_socket_path())
+parser.add_argument("--top", metavar = "MODULE",
+                    help = "only output MODULE and the modules under it")
+parser.add_argument("-o", "--output", metavar = "FILE",
+                    help = "have the server write the IR to FILE")
+parser.add_argument("--locations", action = "store_true",
+                    help = "annotate the IR with @[file line] source "
+                           "locations")
+parser.add_argument("--hash-cons", action = "store_true",
+                    help = "share one node between structurally equal "
+                           "expressions")
+parser.add_argument("--shutdown", action = "store_true",
+                    help = "stop the server")
+args = parser.parse_args()
+
+path = args.socket or default_socket_path()
+if args.shutdown:
+    req = {"command": "shutdown"}
+elif not args.sources:
+    parser.error("no sources given")
+else:
+    output = None
+    if args.output:
+        output = os.path.abspath(args.output)
+    req = {"sources": [os.path.abspath(s) for s in args.sources],
+           "top": args.top,
+           "output": output,
+           "locations": args.locations,
+           "hash_cons": args.hash_cons}
+
+try:
+    res = request(path, req)
+except socket.error, e:
+    sys.stderr.write("pyrrhic_client: can't reach server at %s: %s\n" % \
+                     (path, e))
+    sys.exit(2)
+
+if res.get("log"):
+    sys.stderr.write(res["log"])
+if not res["ok"]:
+    sys.stderr.write(res["error"])
+    sys.exit(1)
+if "ir" in res:
+    sys.stdout.write(res["ir"])